@@ -1,16 +1,29 @@
 import argparse
+import bisect
+import copy
+import errno
+import functools
+import heapq
+import io
+import itertools
+import json
 import logging
+import math
 import os
+import re
+import select
 import shutil
+import struct
 import time
 import stat
-from profilehooks import profile
-
-"""
-Create some kind of "percentage" calculation to give the user an idea of how close it is to being complete. Will be very
-complex and requre guessing due to not being able to know ahead of time how many files/folders/data will need to be
-processed
-"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+# Modules only some runs need (profiling, compression, hashing, databases, the C library, ...) are imported where they
+# are used instead of here, so that runs which don't need them start faster. See testing/benchmark_startup.py
 
 
 class StatHelper:
@@ -19,17 +32,30 @@ class StatHelper:
     Provides better performance than calling the various os.path.* methods multiple times on the same file, due to only
     having to call os.stat() once.
     """
-    def __init__(self, path_name):
+    def __init__(self, path_name, dir_entry=None, exists=True, filesystem=None):
+        """
+        If a DirEntry from os.scandir() is given, its cached stats are used instead of calling os.stat() again, and
+        otherwise the item is stat'ed through the given filesystem backend. If exists is False, the path is known not to
+        exist (e.g. it was missing from a directory listing) and no stats are collected at all.
+        """
         self.path_name = path_name
+        self._exists = exists
+        self._has_permission = True
+        # Whether the item is a small file stored in a pack file instead of a normal file
+        self.packed = getattr(dir_entry, 'packed', False)
+        # Whether the item is a compressed copy of a file, with the original size in place of its own
+        self.compressed = getattr(dir_entry, 'compressed', False)
+        if not exists:
+            return
         try:
-            # Try to get the stats
-            self.stats = os.stat(path_name)
-            self._exists = True
-            self._has_permission = True
+            # Try to get the stats. DirEntry caches its stats, so each entry is only ever stat'ed once
+            if dir_entry is not None:
+                self.stats = dir_entry.stat()
+            else:
+                self.stats = filesystem.stat(path_name)
         except FileNotFoundError:
             # The file does not exist
             self._exists = False
-            self._has_permission = True
         except PermissionError:
             # The program does not have read access to the file or directory
             self._has_permission = False
@@ -75,294 +101,3934 @@ class StatHelper:
         """Whether the file has write access"""
         return self.stats.st_mode & stat.S_IWRITE
 
-    def getmode(self):
-        return self.stats.st_mode
+    def getmode(self):
+        return self.stats.st_mode
+
+
+class Timer:
+    @classmethod
+    def format_time(cls, elapsed_time):
+        temp = int(elapsed_time * 1000)
+        millis = temp % 1000
+        temp //= 1000
+        seconds = temp % 60
+        temp //= 60
+        minutes = temp % 60
+        temp //= 60
+        hours = temp
+        return "{}:{:0>2d}:{:0>2d}.{:0>4d}".format(hours, minutes, seconds, millis)
+
+    def __init__(self):
+        self.start_time = 0
+        self.last_lap = 0
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.last_lap = self.start_time
+
+    def lap(self):
+        last_lap_time = self.last_lap
+        self.last_lap = time.perf_counter()
+        return self.last_lap - last_lap_time
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+
+class CopyPool:
+    """
+    Runs file copies on a pool of worker threads, so that a single slow file does not stall the traversal and fast
+    destinations are kept busy. The number of pending copies is bounded so memory use stays flat on very large trees.
+    """
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copy')
+        self.num_slots = workers * 4
+        self.slots = threading.BoundedSemaphore(self.num_slots)
+        self.error = None
+
+    def submit(self, fn, *fn_args):
+        """Queue a copy job, blocking while too many copies are already pending"""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *fn_args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._job_done)
+
+    def _job_done(self, future):
+        # Keep the first unexpected error so it can be raised in the main thread
+        if not future.cancelled() and future.exception() is not None and self.error is None:
+            self.error = future.exception()
+        self.slots.release()
+
+    def wait(self):
+        """Wait for all queued copies to finish, leaving the pool running for more"""
+        for _ in range(self.num_slots):
+            self.slots.acquire()
+        for _ in range(self.num_slots):
+            self.slots.release()
+        if self.error is not None:
+            raise self.error
+
+    def shutdown(self, cancel=False):
+        """Wait for all running copies to finish. If cancel is set, pending copies that have not started are dropped"""
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+        if self.error is not None and not cancel:
+            raise self.error
+
+
+class FanOutWrite:
+    """
+    One of the destinations a file read once is copied to, when backing up to several destinations. The file is written
+    to a temp file next to the destination file, which is renamed into place once written, like write_atomically()
+    does. A destination that can't be written to is given up on without stopping the others.
+    """
+    def __init__(self, job, dest_file_stats):
+        self.job = job
+        self.dest_file_stats = dest_file_stats
+        # A compressed destination file is replaced by a plain one
+        self.path_name = dest_file_stats.path_name
+        if dest_file_stats.compressed:
+            self.path_name = self.path_name[:-len(COMPRESSED_SUFFIX)]
+        self.temp_path_name = os.path.join(os.path.dirname(self.path_name), '{}{}.{}'.format(
+            TEMP_PREFIX, os.getpid(), next(temp_counter)))
+        self.file = None
+        self.started = False
+        self.failed = False
+        self.finished = False
+
+    def open(self):
+        if self.job.journal is not None:
+            self.job.journal.copy_started(self.temp_path_name)
+        self.started = True
+        self.file = self.job.filesystem.open(self.temp_path_name, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+        throttle_io(self.job, len(data))
+
+    def finish(self, source_file_stats):
+        """Put the written file in place with the source's times and permissions, replacing the old copy"""
+        self.file.close()
+        self.job.filesystem.copystat(source_file_stats.path_name, self.temp_path_name)
+        self.job.filesystem.replace(self.temp_path_name, self.path_name)
+        self.finished = True
+        if self.path_name != self.dest_file_stats.path_name and self.dest_file_stats.exists():
+            self.job.filesystem.remove(self.dest_file_stats.path_name)
+
+    def attempt(self, action, *action_args):
+        """Do a step of the copy unless the destination was given up on. Returns whether it was done"""
+        if self.failed:
+            return False
+        try:
+            action(*action_args)
+            return True
+        except (PermissionError, FileNotFoundError) as e:
+            self.fail(e)
+            return False
+
+    def fail(self, error):
+        """Give up on the destination, counting the file as not copied to it"""
+        if self.failed:
+            return
+        self.failed = True
+        if isinstance(error, PermissionError):
+            logger.warning("Cannot copy file here, access denied: '{}'".format(self.dest_file_stats.path_name))
+        else:
+            # Likely due to the destination file path being too long for the OS to handle
+            logger.warning("Cannot copy file here, destination path too long: '{}'".format(
+                self.dest_file_stats.path_name))
+        count_not_copied(self.job, self.dest_file_stats.path_name)
+
+    def close(self):
+        """Remove the temp file unless it was put in place"""
+        if not self.started:
+            return
+        if not self.finished:
+            if self.file is not None:
+                self.file.close()
+            try:
+                self.job.filesystem.remove(self.temp_path_name)
+            except OSError:
+                pass
+        if self.job.journal is not None:
+            self.job.journal.copy_finished(self.temp_path_name)
+
+
+def relative_path(root, path_name):
+    """Split an absolute path under root into the folder (relative to root) and the name"""
+    return os.path.split(path_name[len(root):].lstrip(os.sep))
+
+
+class ManifestEntry:
+    """Stands in for the os.DirEntry of a destination item, using the stats recorded in the manifest"""
+    def __init__(self, folder_path, name, mode, size, mtime):
+        self.name = name
+        self.path = os.path.join(folder_path, name)
+        self._stats = os.stat_result((mode, 0, 0, 0, 0, 0, size, 0, mtime, 0))
+
+    def is_dir(self):
+        return stat.S_ISDIR(self._stats.st_mode)
+
+    def stat(self):
+        return self._stats
+
+
+class PackEntry(ManifestEntry):
+    """Stands in for the os.DirEntry of a small file stored in a pack file, using the stats from the pack index"""
+    packed = True
+
+
+class CompressedEntry:
+    """
+    Stands in for the os.DirEntry of a compressed destination file, under the name of the original file and with the
+    original size, so that it can be compared to the source file as if it weren't compressed
+    """
+    compressed = True
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.name = entry.name[:-len(COMPRESSED_SUFFIX)]
+        self.path = entry.path
+        self._stats = None
+
+    def is_dir(self, follow_symlinks=True):
+        return False
+
+    def stat(self, follow_symlinks=True):
+        if self._stats is None:
+            stats = self.entry.stat()
+            if isinstance(self.entry, ManifestEntry):
+                # The manifest already records the original size
+                self._stats = stats
+            else:
+                _, _, original_size = read_compressed_header(self.path)
+                self._stats = os.stat_result((stats.st_mode, stats.st_ino, stats.st_dev, stats.st_nlink, stats.st_uid,
+                                              stats.st_gid, original_size, stats.st_atime, stats.st_mtime,
+                                              stats.st_ctime))
+        return self._stats
+
+
+def read_only_uri(path_name):
+    """
+    Return the URI that SQLite opens a database file read-only with. pathlib is used instead of urllib.request's
+    pathname2url, which takes longer to import than the rest of a run where nothing changed.
+    """
+    import pathlib
+    return pathlib.Path(os.path.abspath(path_name)).as_uri() + '?mode=ro'
+
+
+class Manifest:
+    """
+    A record of every item in the destination as of the last successful run, stored in the destination root. Allows
+    the destination to be diffed against the source without listing and stat'ing it again. A new manifest is written
+    alongside the old one during each run, and only replaces it once the run completes successfully.
+    """
+    def __init__(self, dest_path, path=None, record_path=None):
+        self.root = dest_path
+        self.path = path or os.path.join(dest_path, MANIFEST_NAME)
+        # The new manifest is normally written over the old one, but can be written to another file instead
+        self.record_path = record_path or self.path
+        self.new_path = self.record_path + '.new'
+        self.previous = None
+        self.current = None
+        self.pending = []
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+
+    def open_previous(self):
+        """Open the manifest left by the last successful run. Returns whether there is a usable manifest"""
+        import sqlite3
+        if not os.path.exists(self.path):
+            return False
+        try:
+            self.previous = sqlite3.connect(read_only_uri(self.path), uri=True, check_same_thread=False)
+            self.previous.execute("SELECT COUNT(*) FROM files WHERE folder = ''").fetchone()
+        except sqlite3.DatabaseError as e:
+            logger.warning("Cannot read destination manifest, scanning the destination instead ({})".format(e))
+            self.previous = None
+            return False
+        return True
+
+    def list_folder(self, folder_path):
+        """Return a dict mapping the name of each item recorded in a destination folder to its ManifestEntry"""
+        folder = os.path.join(*relative_path(self.root, folder_path))
+        # Folders may be listed from several scanner threads at once
+        with self.read_lock:
+            rows = self.previous.execute("SELECT name, mode, size, mtime FROM files WHERE folder = ?",
+                                         (folder,)).fetchall()
+        return {name: ManifestEntry(folder_path, name, mode, size, mtime) for name, mode, size, mtime in rows}
+
+    def start(self):
+        """Start recording the manifest for this run"""
+        import sqlite3
+        if os.path.exists(self.new_path):
+            os.remove(self.new_path)
+        self.current = sqlite3.connect(self.new_path, check_same_thread=False)
+        # The new manifest only replaces the old one once it is complete, so it doesn't need to be crash-safe
+        self.current.execute("PRAGMA journal_mode = OFF")
+        self.current.execute("PRAGMA synchronous = OFF")
+        self.current.execute("CREATE TABLE files (folder TEXT, name TEXT, mode INTEGER, size INTEGER, mtime REAL, "
+                             "hash BLOB, PRIMARY KEY (folder, name)) WITHOUT ROWID")
+
+    def record(self, path_name, stats):
+        """Record that an item is present in the destination with the given stats. May be called from copy workers"""
+        if self.current is None:
+            return
+        folder, name = relative_path(self.root, path_name)
+        with self.lock:
+            self.pending.append((folder, name, stats.st_mode, stats.st_size, stats.st_mtime))
+            if len(self.pending) >= MANIFEST_BATCH_SIZE:
+                self._flush()
+
+    def record_folder(self, path_name):
+        """Record that a folder is present in the destination"""
+        self.record(path_name, os.stat_result((stat.S_IFDIR | 0o777, 0, 0, 0, 0, 0, 0, 0, 0.0, 0)))
+
+    def _flush(self):
+        self.current.executemany("INSERT OR REPLACE INTO files (folder, name, mode, size, mtime) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 self.pending)
+        self.pending = []
+
+    def finish(self, success):
+        """Close the manifests. If the run was successful, the new manifest replaces the old one"""
+        if self.previous is not None:
+            self.previous.close()
+            self.previous = None
+        if self.current is None:
+            return
+        with self.lock:
+            self._flush()
+            self.current.commit()
+            self.current.close()
+            self.current = None
+        if success:
+            os.replace(self.new_path, self.record_path)
+        else:
+            os.remove(self.new_path)
+
+
+class PackStore:
+    """
+    Stores small files in append-only pack files in the destination, instead of as one destination file each, with an
+    index recording where each file is and its stats. Replacing a file appends the new contents and points the index at
+    them. Pack files are started anew once they reach PACK_FILE_SIZE.
+    """
+    def __init__(self, dest_path, writable):
+        import sqlite3
+        self.root = dest_path
+        self.folder_path = os.path.join(dest_path, PACK_NAME)
+        self.writable = writable
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pack_file = None
+        self.pack_number = 0
+        index_path = os.path.join(self.folder_path, 'index.db')
+        if writable:
+            os.makedirs(self.folder_path, exist_ok=True)
+            self.db = sqlite3.connect(index_path, check_same_thread=False)
+        elif os.path.exists(index_path):
+            self.db = sqlite3.connect(read_only_uri(index_path), uri=True, check_same_thread=False)
+        else:
+            # Simulating without any packs yet, so nothing is packed
+            self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        if not writable and self.db.execute("SELECT name FROM sqlite_master WHERE name = 'packed'").fetchone():
+            return
+        self.db.execute("CREATE TABLE IF NOT EXISTS packed (folder TEXT, name TEXT, mode INTEGER, size INTEGER, "
+                        "mtime REAL, pack INTEGER, offset INTEGER, PRIMARY KEY (folder, name)) WITHOUT ROWID")
+        # Carry on appending to the newest pack file
+        self.pack_number = self.db.execute("SELECT COALESCE(MAX(pack), 0) FROM packed").fetchone()[0]
+
+    def pack_path(self, pack_number):
+        return os.path.join(self.folder_path, 'pack-{:06d}.dat'.format(pack_number))
+
+    def list_folder(self, folder_path):
+        """Return a dict mapping the name of each file packed from a destination folder to its PackEntry"""
+        folder = os.path.join(*relative_path(self.root, folder_path))
+        with self.lock:
+            self._flush()
+            rows = self.db.execute("SELECT name, mode, size, mtime FROM packed WHERE folder = ?", (folder,)).fetchall()
+        return {name: PackEntry(folder_path, name, mode, size, mtime) for name, mode, size, mtime in rows}
+
+    def read(self, path_name):
+        """Return the contents of a packed file"""
+        folder, name = relative_path(self.root, path_name)
+        with self.lock:
+            self._flush()
+            pack_number, offset, size = self.db.execute("SELECT pack, offset, size FROM packed WHERE folder = ? AND "
+                                                        "name = ?", (folder, name)).fetchone()
+            if self.pack_file is not None:
+                self.pack_file.flush()
+        with open(self.pack_path(pack_number), 'rb') as pack_file:
+            pack_file.seek(offset)
+            return pack_file.read(size)
+
+    def extract(self, path_name, target_path_name):
+        """Write a packed file out to a normal file, with its modification time"""
+        folder, name = relative_path(self.root, path_name)
+        with self.lock:
+            mtime = self.db.execute("SELECT mtime FROM packed WHERE folder = ? AND name = ?",
+                                    (folder, name)).fetchone()[0]
+        with open(target_path_name, 'wb') as target_file:
+            target_file.write(self.read(path_name))
+        os.utime(target_path_name, (mtime, mtime))
+
+    def append(self, path_name, data, stats):
+        """Add the contents of a file to the current pack file, replacing any earlier packed version"""
+        folder, name = relative_path(self.root, path_name)
+        with self.lock:
+            if self.pack_file is None or self.pack_file.tell() + len(data) > PACK_FILE_SIZE:
+                if self.pack_file is not None:
+                    self.pack_file.close()
+                    self.pack_number += 1
+                self.pack_file = open(self.pack_path(self.pack_number), 'ab')
+            offset = self.pack_file.tell()
+            self.pack_file.write(data)
+            self.pending.append(("INSERT OR REPLACE INTO packed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (folder, name, stats.st_mode, len(data), stats.st_mtime, self.pack_number, offset)))
+            if len(self.pending) >= MANIFEST_BATCH_SIZE:
+                self._flush()
+
+    def forget(self, path_name):
+        """Remove a file from the index. Its contents stay in the pack file"""
+        if not self.writable:
+            return
+        with self.lock:
+            self.pending.append(("DELETE FROM packed WHERE folder = ? AND name = ?",
+                                 relative_path(self.root, path_name)))
+
+    def _flush(self):
+        for statement, values in self.pending:
+            self.db.execute(statement, values)
+        self.pending = []
+
+    def sync(self):
+        """Write out the pack file and index. The pack file is synced first so the index never points at lost data"""
+        with self.lock:
+            if self.pack_file is not None:
+                self.pack_file.flush()
+                os.fsync(self.pack_file.fileno())
+            if self.writable:
+                self._flush()
+                self.db.commit()
+
+    def close(self, save=True):
+        """Write out the pack file and index if saving, and close them"""
+        if save:
+            self.sync()
+        with self.lock:
+            if self.pack_file is not None:
+                self.pack_file.close()
+                self.pack_file = None
+            self.db.close()
+
+
+class SnapshotStore:
+    """
+    Keeps each run as a new dated snapshot of the source in the destination, instead of a single mirror. File contents
+    are stored once in an object store named by their digest, and hardlinked into every snapshot that has them, so
+    unchanged files cost a link instead of a copy and identical files are only stored once. Each snapshot is built in a
+    '.partial' folder which is only renamed once the run succeeds, so only complete snapshots are used as the base of
+    the next one. The manifest of each snapshot is kept in a folder of its own next to the snapshots, so that the
+    snapshots hold nothing but the files of the source.
+    """
+    def __init__(self, job, dest_path):
+        self.job = job
+        self.root = os.path.join(dest_path, SNAPSHOTS_NAME)
+        self.objects_path = os.path.join(dest_path, OBJECTS_NAME)
+        self.manifests_path = os.path.join(self.root, SNAPSHOT_MANIFESTS_NAME)
+        self.counter = itertools.count()
+        self.names = []
+        if os.path.isdir(self.root):
+            self.names = sorted(name for name in os.listdir(self.root)
+                                if not name.endswith('.partial') and name != SNAPSHOT_MANIFESTS_NAME)
+        self.name = time.strftime(SNAPSHOT_NAME_FORMAT)
+        if self.name in self.names:
+            self.name = '{}_{}'.format(self.name, len(self.names))
+        self.path = os.path.join(self.root, self.name + '.partial')
+        # Compare against the latest snapshot. The first snapshot is compared against itself, so everything is copied
+        self.previous_path = os.path.join(self.root, self.names[-1]) if self.names else self.path
+        self.previous_manifest_path = self.manifest_path(self.names[-1] if self.names else self.name)
+
+    def start(self):
+        """Create the new snapshot, removing any snapshots and objects left behind by runs that didn't finish"""
+        temp_path = os.path.join(self.objects_path, 'tmp')
+        if os.path.isdir(temp_path):
+            remove_item(self.job, temp_path, True)
+        os.makedirs(temp_path)
+        for name in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            if name.endswith('.partial'):
+                logger.debug("Removing unfinished snapshot: '{}'".format(name))
+                remove_item(self.job, os.path.join(self.root, name), True)
+        os.makedirs(self.path)
+        os.makedirs(self.manifests_path, exist_ok=True)
+
+    def manifest_path(self, name):
+        """Return the path of the manifest of a snapshot"""
+        return os.path.join(self.manifests_path, name + '.db')
+
+    def target_path(self, path_name):
+        """Return where an item of the previous snapshot goes in the new snapshot"""
+        return os.path.normpath(os.path.join(self.path, os.path.relpath(path_name, self.previous_path)))
+
+    def make_folder(self, path_name):
+        """Create a folder of the new snapshot"""
+        os.makedirs(self.target_path(path_name), exist_ok=True)
+
+    def object_path(self, digest):
+        hex_digest = digest.hex()
+        return os.path.join(self.objects_path, hex_digest[:2], hex_digest[2:])
+
+    def link(self, existing_path_name, path_name):
+        """
+        Hardlink an existing file into the new snapshot at the place of an item of the previous snapshot. Copies the
+        file instead if it already has as many links as the filesystem allows
+        """
+        target_path_name = self.target_path(path_name)
+        try:
+            os.link(existing_path_name, target_path_name)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            shutil.copy2(existing_path_name, target_path_name)
+
+    def store(self, source_file_stats, path_name):
+        """
+        Add a file to the new snapshot at the place of an item of the previous snapshot, copying it into the object
+        store unless its contents are there already. Returns the copy strategy used, or None if it was deduplicated
+        """
+        digest = self.job.hash_cache.lookup(source_file_stats) if self.job.hash_cache is not None else None
+        if digest is None:
+            digest, data_read = hash_file(self.job, source_file_stats.path_name)
+            with self.job.info_lock:
+                self.job.info_data['misc']['hashes_made'] += 1
+                self.job.info_data['misc']['data_hashed'] += data_read
+            if self.job.hash_cache is not None:
+                self.job.hash_cache.store(source_file_stats, digest)
+        object_path_name = self.object_path(digest)
+        strategy = None
+        if not os.path.exists(object_path_name):
+            # Copy to a temporary file first so a half-written object is never found by its digest
+            temp_path_name = os.path.join(self.objects_path, 'tmp', '{}-{}'.format(os.getpid(), next(self.counter)))
+            strategy = copy_file_data(self.job, source_file_stats, StatHelper(temp_path_name, exists=False))
+            shutil.copystat(source_file_stats.path_name, temp_path_name)
+            os.makedirs(os.path.dirname(object_path_name), exist_ok=True)
+            os.replace(temp_path_name, object_path_name)
+        self.link(object_path_name, path_name)
+        return strategy
+
+    def finish(self, success):
+        """Keep the new snapshot if the run succeeded, then remove the oldest snapshots beyond the number to keep"""
+        if not success:
+            return
+        os.rename(self.path, os.path.join(self.root, self.name))
+        logger.info("Saved snapshot '{}'".format(self.name))
+        self.names.append(self.name)
+        if self.job.args.keepsnapshots is None or len(self.names) <= self.job.args.keepsnapshots:
+            return
+        for name in self.names[:-self.job.args.keepsnapshots]:
+            logger.info("Removing old snapshot '{}'".format(name))
+            remove_item(self.job, os.path.join(self.root, name), True)
+            if os.path.exists(self.manifest_path(name)):
+                os.remove(self.manifest_path(name))
+        self.prune_objects()
+
+    def prune_objects(self):
+        """Delete objects no longer linked into any snapshot"""
+        num_pruned = 0
+        for folder in scan_folder(self.job, self.objects_path).values():
+            for entry in scan_folder(self.job, folder.path).values():
+                if entry.stat(follow_symlinks=False).st_nlink == 1:
+                    os.remove(entry.path)
+                    num_pruned += 1
+        logger.info("Pruned {} unused objects".format(num_pruned))
+
+
+class Journal:
+    """
+    A crash-safe record of the progress of a run, kept in the destination root until the run completes, so that an
+    interrupted run can be resumed. Folders are recorded as complete once all of their copies have finished, and the
+    temp files of copies in flight are recorded so they can be cleaned up. Changes are committed in batches at
+    checkpoints, after the copied data has been flushed to disk, so a folder is never recorded as complete before its
+    files are safely written. A folder where anything failed (a file that couldn't be read or copied, a conflict that
+    couldn't be resolved, ...) is never recorded as complete, so a resumed run tries it again.
+    """
+    def __init__(self, job, dest_path):
+        self.job = job
+        self.dest_path = dest_path
+        self.path = os.path.join(dest_path, JOURNAL_NAME)
+        self.db = None
+        # Folders completed by an interrupted run, and whether there was an interrupted run at all
+        self.completed = set()
+        self.interrupted = False
+        # Folders of this run where something failed
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.last_checkpoint = time.monotonic()
+
+    def open(self, source_path, resume):
+        """Start the journal for this run, picking up from the journal of an interrupted run if there is one"""
+        import sqlite3
+        self.interrupted = os.path.exists(self.path)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = FULL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS in_flight (temp_path TEXT PRIMARY KEY) WITHOUT ROWID")
+        if self.interrupted:
+            # Copies that were in flight never finished, so their temp files are of no use
+            for temp_path, in self.db.execute("SELECT temp_path FROM in_flight").fetchall():
+                try:
+                    os.remove(temp_path)
+                except FileNotFoundError:
+                    pass
+            self.db.execute("DELETE FROM in_flight")
+            row = self.db.execute("SELECT value FROM run WHERE key = 'source'").fetchone()
+            if not resume:
+                logger.info("Not resuming the interrupted run, starting over")
+            elif row is None or row[0] != source_path:
+                logger.warning("Journal in the destination is from a backup of another source, starting over")
+            else:
+                self.completed = {folder for folder, in self.db.execute("SELECT folder FROM folders")}
+            if not self.completed:
+                self.db.execute("DELETE FROM folders")
+        self.db.execute("INSERT OR REPLACE INTO run VALUES ('source', ?)", (source_path,))
+        self.db.commit()
+        if self.completed:
+            logger.info("Resuming interrupted run, {} folders were already completed".format(len(self.completed)))
+
+    def is_complete(self, current_folder):
+        """Return whether a folder was completed by the interrupted run being resumed"""
+        return current_folder in self.completed
+
+    def copy_started(self, temp_path_name):
+        """Record a copy in flight, by the temp file it is written to. May be called from copy workers"""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO in_flight VALUES (?)", (temp_path_name,))
+
+    def copy_finished(self, temp_path_name):
+        """Record that a copy is no longer in flight. May be called from copy workers"""
+        with self.lock:
+            self.db.execute("DELETE FROM in_flight WHERE temp_path = ?", (temp_path_name,))
+
+    def folder_failed(self, current_folder):
+        """Record that something in a folder failed, so it is never recorded as complete. May be called from workers"""
+        with self.lock:
+            self.failed.add(current_folder)
+
+    def item_failed(self, path_name):
+        """Record that an item in the destination failed to be copied or resolved. May be called from copy workers"""
+        self.folder_failed(relative_path(self.dest_path, path_name)[0])
+
+    def folder_done(self, current_folder):
+        """
+        Record that all of a folder's items were processed, and make a checkpoint if one is due. Its copies may still
+        be queued, so it is only recorded as complete once the checkpoint has waited for them, and only if none failed
+        """
+        with self.lock:
+            if current_folder not in self.failed:
+                self.db.execute("INSERT OR REPLACE INTO folders VALUES (?)", (current_folder,))
+        if time.monotonic() - self.last_checkpoint >= self.job.args.checkpointinterval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Wait for queued copies, flush everything written so far to disk, then commit the journal. Folders where a copy
+        failed after they were processed are taken back out first
+        """
+        start_time = time.perf_counter()
+        if self.job.copy_pool is not None:
+            self.job.copy_pool.wait()
+        if self.job.pack_store is not None:
+            self.job.pack_store.sync()
+        sync_filesystem(self.dest_path)
+        with self.lock:
+            self.db.executemany("DELETE FROM folders WHERE folder = ?", ((folder,) for folder in self.failed))
+            self.db.commit()
+        self.last_checkpoint = time.monotonic()
+        with self.job.info_lock:
+            self.job.info_data['time_spent']['checkpointing'] += time.perf_counter() - start_time
+            self.job.info_data['misc']['checkpoints'] += 1
+
+    def finish(self, success):
+        """
+        Close the journal. It is removed if the run completed, or else checkpointed one last time so the next run can
+        resume, which needs all copies to have finished
+        """
+        if success:
+            self.db.close()
+            os.remove(self.path)
+        else:
+            self.checkpoint()
+            self.db.close()
+        self.db = None
+
+    def abandon(self):
+        """Close the journal without committing anything since the last checkpoint"""
+        with self.lock:
+            self.db.rollback()
+            self.db.close()
+        self.db = None
+
+
+class HashCache:
+    """
+    A persistent cache of file content digests, keyed by the device and inode of each file and only valid while the
+    file's size and modification time are unchanged. The metadata change time is checked as well, since unlike the
+    modification time it cannot be set back after the file is changed. Lets copymode 3 skip reading files that were
+    already hashed by a previous run. The least recently used entries are evicted once the cache holds more than
+    max_entries. Several jobs can use the same cache at once, as each batch of entries is committed as it is written.
+    """
+    def __init__(self, job, path, max_entries):
+        import sqlite3
+        self.job = job
+        self.path = path
+        self.max_entries = max_entries
+        self.run_id = int(time.time())
+        self.pending = []
+        self.used = []
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+                        "ctime_ns INTEGER, digest BLOB, last_used INTEGER, PRIMARY KEY (dev, ino))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+
+    def lookup(self, file_stats):
+        """Return the cached digest of a file, or None if it isn't cached or the file has changed since"""
+        stats = file_stats.stats
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, ctime_ns, digest FROM hashes WHERE dev = ? AND ino = ?",
+                                  (stats.st_dev, stats.st_ino)).fetchone()
+            if row is not None and row[:3] == (stats.st_size, stats.st_mtime_ns, stats.st_ctime_ns):
+                self.used.append((self.run_id, stats.st_dev, stats.st_ino))
+                hit = True
+            else:
+                hit = False
+        with self.job.info_lock:
+            self.job.info_data['misc']['hash_cache_hits' if hit else 'hash_cache_misses'] += 1
+        return row[3] if hit else None
+
+    def store(self, file_stats, digest):
+        """Cache the digest of a file"""
+        stats = file_stats.stats
+        with self.lock:
+            self.pending.append((stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns, stats.st_ctime_ns,
+                                 digest, self.run_id))
+            if len(self.pending) >= MANIFEST_BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", self.pending)
+        self.db.executemany("UPDATE hashes SET last_used = ? WHERE dev = ? AND ino = ?", self.used)
+        self.db.commit()
+        self.pending = []
+        self.used = []
+
+    def close(self, save=True):
+        """Write out pending entries and evict the least recently used ones if the cache is too large"""
+        with self.lock:
+            if save:
+                self._flush()
+                count = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+                if count > self.max_entries:
+                    self.db.execute("DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_used "
+                                    "LIMIT ?)", (count - self.max_entries,))
+                self.db.commit()
+            self.db.close()
+
+
+class ProgressReporter:
+    """
+    Samples the counters of a job from a background thread at a regular interval and logs the progress of the run:
+    files and data processed, throughput since the last sample, and if the totals are known from a pre-count, how much
+    is left and an estimated time to completion.
+    """
+    def __init__(self, job, interval, total_files=None, total_size=None, name=None):
+        self.job = job
+        self.interval = interval
+        # Destination to name in each message, when backing up to several
+        self.name = name
+        self.total_files = total_files
+        self.total_size = total_size
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self.start_time = 0
+        self.last_time = 0
+        self.last_files = 0
+        self.last_size = 0
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.last_time = self.start_time
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        """Log the current progress"""
+        with self.job.info_lock:
+            files_done = self.job.info_data['files']['num_processed']
+            size_done = self.job.info_data['files']['size_copied'] + self.job.info_data['files']['size_skipped']
+        now = time.perf_counter()
+        sample_time = now - self.last_time
+        files_rate = (files_done - self.last_files) / sample_time
+        size_rate = (size_done - self.last_size) / sample_time
+        self.last_time, self.last_files, self.last_size = now, files_done, size_done
+
+        message = "Progress{}: {} files, {} processed ({:.1f} files/s, {}/s)".format(
+            " to '{}'".format(self.name) if self.name is not None else "", files_done, format_data_size(size_done),
+            files_rate, format_data_size(size_rate))
+        if self.total_files:
+            # Estimate the time left from the average rate so far, by data if possible, otherwise by files
+            elapsed_time = now - self.start_time
+            size_left = max(self.total_size - size_done, 0)
+            files_left = max(self.total_files - files_done, 0)
+            if size_done > 0:
+                eta = size_left * elapsed_time / size_done
+            elif files_done > 0:
+                eta = files_left * elapsed_time / files_done
+            else:
+                eta = None
+            message += ", {:.2f}% done, {} in {} files remaining, ETA {}".format(
+                100 * (size_done / self.total_size if self.total_size else files_done / self.total_files),
+                format_data_size(size_left), files_left, Timer.format_time(eta) if eta is not None else "unknown")
+        logger.info(message)
+
+
+class FolderScanner:
+    """
+    Lists and stats folders ahead of the decision stage on a pool of threads, so that the round trip time of each
+    listing on a network filesystem overlaps with the others. Only the folders next in line to be processed are scanned
+    ahead, so memory stays bounded no matter how many folders are pending.
+    """
+    def __init__(self, scanners):
+        self.executor = ThreadPoolExecutor(max_workers=scanners, thread_name_prefix='scan')
+        self.lookahead = scanners * 2
+        self.scans = {}
+
+    def prefetch(self, source_path, pending_folders):
+        """Start scanning the folders at the top of the pending folder stack, for the jobs still to back them up"""
+        for current_folder, depth, jobs in pending_folders[-self.lookahead:]:
+            jobs = unfinished_jobs(jobs, current_folder)
+            if not jobs or (current_folder, tuple(jobs)) in self.scans:
+                continue
+            self.scans[(current_folder, tuple(jobs))] = self.executor.submit(
+                scan_folders, jobs, source_path, current_folder, True)
+
+    def take(self, current_folder, jobs):
+        """Return the scan started for a folder and jobs, or None if it wasn't scanned ahead"""
+        return self.scans.pop((current_folder, tuple(jobs)), None)
+
+    def discard(self):
+        """Drop the scans that were never taken, waiting for any that already started, leaving the pool running"""
+        for scan in self.scans.values():
+            if not scan.cancel():
+                scan.exception()
+        self.scans = {}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.scans = {}
+
+
+class Profiler:
+    """
+    Collects the extra timings shown with --profile: how long each file took to copy, kept as a latency histogram per
+    file size bucket, and the slowest folders and files. The histograms have a fixed number of logarithmic bins, so
+    memory use doesn't grow with the number of files, and percentiles are accurate to within a bin (about 19%).
+    """
+    def __init__(self, num_slowest):
+        self.num_slowest = num_slowest
+        self.histograms = [[0] * PROFILE_LATENCY_BINS for _ in range(len(PROFILE_SIZE_BUCKETS) + 1)]
+        # Min-heaps of (seconds, path), so the fastest of the slowest is the one replaced
+        self.slowest_files = []
+        self.slowest_folders = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def latency_bin(cls, elapsed_time):
+        """Return the histogram bin for a latency"""
+        if elapsed_time <= PROFILE_MIN_LATENCY:
+            return 0
+        latency_bin = int(math.log2(elapsed_time / PROFILE_MIN_LATENCY) * PROFILE_BINS_PER_DOUBLING) + 1
+        return min(latency_bin, PROFILE_LATENCY_BINS - 1)
+
+    @classmethod
+    def bin_latency(cls, latency_bin):
+        """Return the latency at the top of a histogram bin"""
+        return PROFILE_MIN_LATENCY * 2 ** (latency_bin / PROFILE_BINS_PER_DOUBLING)
+
+    def keep_slowest(self, slowest, elapsed_time, path_name):
+        """Add an item to a list of the slowest items if it is slower than the ones already there"""
+        if len(slowest) < self.num_slowest:
+            heapq.heappush(slowest, (elapsed_time, path_name))
+        elif slowest and elapsed_time > slowest[0][0]:
+            heapq.heapreplace(slowest, (elapsed_time, path_name))
+
+    def record_file(self, path_name, size, elapsed_time):
+        """Record how long a file took to copy. May be called from any thread"""
+        size_bucket = bisect.bisect_right(PROFILE_SIZE_BUCKETS, size)
+        latency_bin = self.latency_bin(elapsed_time)
+        with self.lock:
+            self.histograms[size_bucket][latency_bin] += 1
+            self.keep_slowest(self.slowest_files, elapsed_time, path_name)
+
+    def record_folder(self, path_name, elapsed_time):
+        """Record how long processing a folder took, not counting its subfolders"""
+        with self.lock:
+            self.keep_slowest(self.slowest_folders, elapsed_time, path_name)
+
+    def percentile(self, histogram, fraction):
+        """Return the latency below which the given fraction of the files in a histogram were copied"""
+        target = fraction * sum(histogram)
+        count = 0
+        for latency_bin, bin_count in enumerate(histogram):
+            count += bin_count
+            if count >= target:
+                return self.bin_latency(latency_bin)
+        return self.bin_latency(len(histogram) - 1)
+
+    def log_report(self, info_data, total_time_spent):
+        """
+        Log the time spent in each phase, from the counters of the backup, then the latency percentiles and the slowest
+        folders and files
+        """
+        logger.info("Time spent in each phase (copies, hashing and throttling are summed across threads):")
+        for phase, name in PROFILE_PHASES:
+            logger.info("  {:<14}{} ({:.2f}% of total time)".format(
+                name,
+                Timer.format_time(info_data['time_spent'][phase]),
+                100 * (info_data['time_spent'][phase] / total_time_spent),
+            ))
+        bucket_edges = [0] + PROFILE_SIZE_BUCKETS
+        if any(map(any, self.histograms)):
+            logger.info("Copy latency by file size:")
+        for size_bucket, histogram in enumerate(self.histograms):
+            num_files = sum(histogram)
+            if num_files == 0:
+                continue
+            if size_bucket < len(PROFILE_SIZE_BUCKETS):
+                size_range = "{} - {}".format(format_data_size(bucket_edges[size_bucket]),
+                                              format_data_size(bucket_edges[size_bucket + 1]))
+            else:
+                size_range = "{} and up".format(format_data_size(bucket_edges[size_bucket]))
+            logger.info("  {:<22}{} files, p50 {:.3f}ms, p99 {:.3f}ms".format(
+                size_range,
+                num_files,
+                1000 * self.percentile(histogram, 0.5),
+                1000 * self.percentile(histogram, 0.99),
+            ))
+        for slowest, kind in ((self.slowest_folders, "folders"), (self.slowest_files, "files")):
+            if slowest:
+                logger.info("Slowest {}:".format(kind))
+            for elapsed_time, path_name in sorted(slowest, reverse=True):
+                logger.info("  {:>10.3f}ms '{}'".format(1000 * elapsed_time, path_name))
+
+
+class FilterRules:
+    """
+    Decides which items are left out of the backup. Name rules are gitignore-style glob patterns matched against the
+    path of each item relative to the source folder, and are all compiled into a single regular expression for files
+    and one for folders, so checking an item costs one match no matter how many rules there are. The expressions are
+    matched against the name and the path joined by a NUL, so rules that only look at the name fail on its first few
+    characters instead of being tried at every '/' in the path. As in .gitignore, the last rule that matches an item
+    wins, '!' marks a rule that includes items again, a trailing '/' only matches folders, and a pattern without a '/'
+    in the middle matches in any folder. Files can also be filtered by size and age, which needs their stats, so those
+    filters are only checked once the name rules have let a file through.
+    Excluded folders are never scanned, and excluded items in the destination are left alone.
+    """
+    def __init__(self, job, rules, min_size=None, max_size=None, min_age=None, max_age=None):
+        self.job = job
+        # Whether each rule includes rather than excludes, by the name of its group in the compiled expressions
+        self.includes = {}
+        file_patterns = []
+        folder_patterns = []
+        for index, rule in enumerate(rules):
+            include = rule.startswith('!')
+            if include:
+                rule = rule[1:]
+            folders_only = rule.endswith('/')
+            rule = rule.rstrip('/')
+            # Patterns with a '/' anywhere but the end are anchored to the source folder and match the path, the rest
+            # match the name
+            if '/' in rule:
+                pattern = '[^\\0]*\\0' + glob_to_regex(rule.lstrip('/'))
+            else:
+                pattern = glob_to_regex(rule) + '\\0.*'
+            # Later rules come first, so the first alternative that matches is the last rule that matches
+            group = '(?P<r{}>{})'.format(index, pattern)
+            self.includes['r{}'.format(index)] = include
+            folder_patterns.insert(0, group)
+            if not folders_only:
+                file_patterns.insert(0, group)
+        self.file_matcher = re.compile('|'.join(file_patterns), re.DOTALL) if file_patterns else None
+        self.folder_matcher = re.compile('|'.join(folder_patterns), re.DOTALL) if folder_patterns else None
+        self.min_size = min_size
+        self.max_size = max_size
+        # Ages are turned into the latest and earliest modified times a file can have
+        now = time.time()
+        self.max_mtime = now - min_age if min_age is not None else None
+        self.min_mtime = now - max_age if max_age is not None else None
+
+    def excluded(self, relative_path, is_dir):
+        """Return whether the name rules exclude an item, given its path relative to the source folder"""
+        matcher = self.folder_matcher if is_dir else self.file_matcher
+        if matcher is None:
+            return False
+        if os.sep != '/':
+            relative_path = relative_path.replace(os.sep, '/')
+        match = matcher.fullmatch(relative_path[relative_path.rfind('/') + 1:] + '\0' + relative_path)
+        return match is not None and not self.includes[match.lastgroup]
+
+    def folder_excluded(self, relative_folder):
+        """Return whether a folder is excluded by the name rules, either itself or through a folder above it"""
+        relative_path = ''
+        for name in relative_folder.split(os.sep) if relative_folder else []:
+            relative_path = os.path.join(relative_path, name)
+            if self.excluded(relative_path, True):
+                return True
+        return False
+
+    def filters_stats(self):
+        """Return whether any filters need the stats of files"""
+        return any(limit is not None for limit in (self.min_size, self.max_size, self.max_mtime, self.min_mtime))
+
+    def excluded_by_stats(self, stats):
+        """Return whether the size or age filters exclude a file with the given stats"""
+        return ((self.min_size is not None and stats.st_size < self.min_size)
+                or (self.max_size is not None and stats.st_size > self.max_size)
+                or (self.max_mtime is not None and stats.st_mtime > self.max_mtime)
+                or (self.min_mtime is not None and stats.st_mtime < self.min_mtime))
+
+    def filter_folder(self, current_folder, source_entries, dest_entries):
+        """
+        Remove the excluded items from the listings of a folder. Items excluded from the source are removed from the
+        destination listing too, so they aren't taken for conflicts. May be run from a scanner thread.
+        """
+        num_files = num_folders = size_filtered = 0
+        check_stats = self.filters_stats()
+        for name, source_entry in list(source_entries.items()):
+            try:
+                is_dir = source_entry.is_dir()
+                if self.excluded(os.path.join(current_folder, name), is_dir):
+                    size = 0
+                elif check_stats and not is_dir:
+                    stats = source_entry.stat()
+                    if not self.excluded_by_stats(stats):
+                        continue
+                    size = stats.st_size
+                else:
+                    continue
+            except OSError:
+                # Errors are reported when the entry is processed
+                continue
+            del source_entries[name]
+            dest_entries.pop(name, None)
+            if is_dir:
+                num_folders += 1
+            else:
+                num_files += 1
+                size_filtered += size
+        # Leave alone destination items that would have been excluded, had they been in the source
+        for name, dest_entry in list(dest_entries.items()):
+            if name not in source_entries:
+                try:
+                    if self.excluded(os.path.join(current_folder, name), dest_entry.is_dir()):
+                        del dest_entries[name]
+                except OSError:
+                    continue
+        with self.job.info_lock:
+            self.job.info_data['files']['num_filtered'] += num_files
+            self.job.info_data['files']['size_filtered'] += size_filtered
+            self.job.info_data['folders']['num_filtered'] += num_folders
+
+
+class Verifier:
+    """
+    Collects the files to verify once the backup is done: every file in the destination, a random share of them, or
+    only the files copied by this run. Files are added as they are copied or skipped, from any thread, and checked
+    together at the end by verify_backup(). In sample mode only the sampled files are kept, so memory use is a fraction
+    of that of a full verification.
+    """
+    def __init__(self, mode, percent):
+        import random
+        self.mode = mode
+        self.share = percent / 100
+        self.random = random.Random()
+        self.files = []
+        self.lock = threading.Lock()
+
+    def add(self, source_file_stats, dest_path_name, copied, kind=None):
+        """
+        Add a backed up file to check. kind is 'packed' or 'compressed' if the destination holds it another way. The
+        size and modified time of the source are kept, so that a source changed since it was backed up can be told apart
+        from a bad copy
+        """
+        if self.mode == 'changed' and not copied:
+            return
+        with self.lock:
+            if self.mode == 'sample' and self.random.random() >= self.share:
+                return
+            self.files.append((source_file_stats.path_name, source_file_stats.stats.st_size,
+                               source_file_stats.stats.st_mtime_ns, dest_path_name, kind))
+
+    def take(self):
+        """Return the files collected so far, and start collecting anew"""
+        with self.lock:
+            files, self.files = self.files, []
+        return files
+
+
+class Throttle:
+    """
+    Limits the rate of I/O with token buckets for bytes and operations per second. One throttle is shared by every
+    thread doing I/O, so the copy workers and scanners all count against the same limits. I/O is paid for after it is
+    done: a thread that takes the bucket below empty sleeps until its debt is paid off, so threads queue up fairly.
+    The limits can be set to apply only at certain times of day, and can be backed off when I/O gets slower than usual,
+    a sign that other workloads are contending for the disk or network.
+    """
+    def __init__(self, job, bytes_per_second, ops_per_second, schedule, adaptive):
+        self.job = job
+        # Configured limits, and the limits in effect after backing off. None means unlimited
+        self.limits = {'bytes': bytes_per_second, 'ops': ops_per_second}
+        self.rates = dict(self.limits)
+        self.tokens = {kind: (limit or 0) * THROTTLE_BURST for kind, limit in self.limits.items()}
+        self.last_refill = time.monotonic()
+        self.schedule = schedule
+        self.adaptive = adaptive
+        # Smoothed and lowest seen I/O latency, in seconds per MB
+        self.latency = None
+        self.baseline = None
+        self.last_adjustment = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def active(self):
+        """Return whether the limits apply at the current time of day"""
+        if self.schedule is None:
+            return True
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end in self.schedule:
+            # Windows that end before they start wrap past midnight
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return True
+        return False
+
+    def consume(self, num_bytes, ops):
+        """Pay for I/O that was just done, sleeping if it went over the limits. May be called from any thread"""
+        now = time.monotonic()
+        # The time since this thread was last let through was spent doing the I/O being paid for
+        latency = None
+        last_grant = getattr(self.local, 'last_grant', None)
+        if self.adaptive and last_grant is not None and num_bytes >= THROTTLE_MIN_SAMPLE:
+            latency = (now - last_grant) / (num_bytes / 1048576)
+        wait = 0
+        if self.active():
+            with self.lock:
+                for kind in self.tokens:
+                    if self.rates[kind] is not None:
+                        self.tokens[kind] = min(self.tokens[kind] + (now - self.last_refill) * self.rates[kind],
+                                                self.rates[kind] * THROTTLE_BURST)
+                self.last_refill = now
+                if latency is not None:
+                    self.adapt(latency, now)
+                for kind, amount in (('bytes', num_bytes), ('ops', ops)):
+                    if self.rates[kind] is not None:
+                        self.tokens[kind] -= amount
+                        if self.tokens[kind] < 0:
+                            wait = max(wait, -self.tokens[kind] / self.rates[kind])
+        if wait > 0:
+            time.sleep(wait)
+            with self.job.info_lock:
+                self.job.info_data['time_spent']['throttled'] += wait
+        self.local.last_grant = time.monotonic()
+
+    def adapt(self, latency, now):
+        """
+        Back the rates off when I/O latency rises well above the lowest latency seen, and raise them back towards the
+        limits while it is normal. Called with the lock held
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * THROTTLE_SMOOTHING
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        if now - self.last_adjustment < THROTTLE_ADJUST_INTERVAL:
+            return
+        self.last_adjustment = now
+        congested = self.latency > self.baseline * THROTTLE_LATENCY_FACTOR
+        for kind, limit in self.limits.items():
+            if limit is None:
+                continue
+            if congested:
+                self.rates[kind] = max(self.rates[kind] * THROTTLE_BACKOFF, limit * THROTTLE_MIN_SHARE)
+            else:
+                self.rates[kind] = min(self.rates[kind] + limit * THROTTLE_RECOVERY, limit)
+        if congested:
+            logger.debug("I/O latency is up ({:.1f}ms/MB, usually {:.1f}ms/MB), backing off".format(
+                self.latency * 1000, self.baseline * 1000))
+            with self.job.info_lock:
+                self.job.info_data['misc']['throttle_backoffs'] += 1
+
+
+class InotifyWatcher:
+    """
+    Watches every folder of the source tree for changes with inotify. Only available on Linux, and limited by the
+    number of watches the user is allowed (fs.inotify.max_user_watches).
+    """
+    def __init__(self, job, source_path):
+        import ctypes
+        self.job = job
+        self.source_path = source_path
+        self.libc = load_libc()
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.get_errno(), "Cannot start inotify")
+        # Relative folder watched by each watch descriptor
+        self.watches = {}
+        try:
+            self.add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, top_folder):
+        """Watch a folder and every folder below it"""
+        pending_folders = [top_folder]
+        while pending_folders:
+            current_folder = pending_folders.pop()
+            folder_path = os.path.join(self.source_path, current_folder)
+            watch = self.libc.inotify_add_watch(self.fd, os.fsencode(folder_path), INOTIFY_WATCH_MASK)
+            if watch < 0:
+                error = self.get_errno()
+                # The folder may have gone again already, which will show up as its own event
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, "Cannot watch folder ({})".format(os.strerror(error)), folder_path)
+            self.watches[watch] = current_folder
+            try:
+                entries = scan_folder(self.job, folder_path)
+            except OSError:
+                continue
+            for entry in entries.values():
+                if entry.is_dir(follow_symlinks=False):
+                    pending_folders.append(os.path.join(current_folder, entry.name))
+
+    def remove_tree(self, top_folder):
+        """Stop watching a folder that was moved away, and every folder below it"""
+        for watch, current_folder in list(self.watches.items()):
+            if current_folder == top_folder or current_folder.startswith(top_folder + os.sep):
+                self.libc.inotify_rm_watch(self.fd, watch)
+                del self.watches[watch]
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds (forever if None) for changes. Returns the changed folders as a set of
+        (relative folder, whether the whole folder tree needs syncing)
+        """
+        changes = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changes
+        data = os.read(self.fd, INOTIFY_READ_SIZE)
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so sync everything
+                logger.warning("Too many changes to keep track of, syncing the whole tree")
+                changes.add(('', True))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(watch, None)
+                continue
+            if watch not in self.watches:
+                continue
+            current_folder = self.watches[watch]
+            item_folder = os.path.join(current_folder, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # A new folder: watch it and sync all of it, since files may have been added before it was watched
+                self.add_tree(item_folder)
+                changes.add((item_folder, True))
+            else:
+                if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                    self.remove_tree(item_folder)
+                changes.add((current_folder, False))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Finds changes by listing and stat'ing the whole source tree every interval, for when inotify can't be used. Only a
+    digest of each folder's listing is kept between scans.
+    """
+    def __init__(self, job, source_path, interval):
+        self.job = job
+        self.source_path = source_path
+        self.interval = interval
+        self.folders = self.scan_tree()
+
+    def scan_tree(self):
+        """Return a dict mapping each relative folder in the source to a digest of the names, sizes and times in it"""
+        import hashlib
+        folders = {}
+        pending_folders = ['']
+        while pending_folders:
+            current_folder = pending_folders.pop()
+            try:
+                entries = scan_folder(self.job, os.path.join(self.source_path, current_folder))
+            except OSError:
+                continue
+            digest = hashlib.blake2b()
+            for name in sorted(entries):
+                entry = entries[name]
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_folders.append(os.path.join(current_folder, name))
+                        digest.update(os.fsencode(name) + b'/\0')
+                    else:
+                        stats = entry.stat(follow_symlinks=False)
+                        digest.update(os.fsencode('{}\0{}\0{}\0'.format(name, stats.st_size, stats.st_mtime_ns)))
+                except OSError:
+                    continue
+            folders[current_folder] = digest.digest()
+        return folders
+
+    def wait(self, timeout):
+        """Sleep until the next scan, then return the folders that changed since the last one"""
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        folders = self.scan_tree()
+        changes = set()
+        for current_folder, digest in folders.items():
+            if current_folder not in self.folders:
+                changes.add((current_folder, True))
+            elif digest != self.folders[current_folder]:
+                changes.add((current_folder, False))
+        for current_folder in self.folders:
+            if current_folder not in folders:
+                changes.add((os.path.dirname(current_folder), False))
+        self.folders = folders
+        return changes
+
+    def close(self):
+        self.folders = {}
+
+
+class LocalFileSystem:
+    """
+    The filesystem backend for local paths, passing each call on to os and shutil. The tree is walked and copied
+    through a backend, so that it can be swapped for one holding files in memory or one simulating a slow network
+    filesystem. Backends that aren't local can't be used with the features that keep their own files in the
+    destination (the manifest, journal, pack files, snapshots, compression, delta copies, the trash and watching),
+    and file contents are always copied through userspace.
+    """
+    # Whether paths are real paths that the operating system can see, and whether file contents can be copied between
+    # file descriptors by the kernel
+    local = True
+    native_copies = True
+
+    def scandir(self, path):
+        """Return a list of os.DirEntry-like items for the contents of a folder"""
+        with os.scandir(path) as entries:
+            return list(entries)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def lexists(self, path):
+        return os.path.lexists(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def makedirs(self, path, exist_ok=False):
+        os.makedirs(path, exist_ok=exist_ok)
+
+    def open(self, path, mode):
+        """Open a file in binary mode, either 'rb' or 'wb'"""
+        return open(path, mode)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rmtree(self, path):
+        shutil.rmtree(path, onerror=remove_read_only)
+
+    def rename(self, source_path, dest_path):
+        os.rename(source_path, dest_path)
+
+    def replace(self, source_path, dest_path):
+        os.replace(source_path, dest_path)
+
+    def move(self, source_path, dest_path):
+        shutil.move(source_path, dest_path)
+
+    def copystat(self, source_path, dest_path):
+        shutil.copystat(source_path, dest_path)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+
+class MemoryNode:
+    """A file or folder in a MemoryFileSystem"""
+    def __init__(self, ino, is_dir):
+        self.ino = ino
+        self.mode = (stat.S_IFDIR | 0o755) if is_dir else (stat.S_IFREG | 0o644)
+        self.data = b''
+        self.mtime_ns = self.atime_ns = self.ctime_ns = time.time_ns()
+        # Names of the items in a folder
+        self.children = set() if is_dir else None
+
+    def is_dir(self):
+        return self.children is not None
+
+    def stat(self):
+        times = (self.atime_ns, self.mtime_ns, self.ctime_ns)
+        return os.stat_result((self.mode, self.ino, MEMORY_DEVICE, 1, 0, 0, len(self.data)) +
+                              tuple(time_ns // 1000000000 for time_ns in times) +
+                              tuple(time_ns / 1000000000 for time_ns in times) + times)
+
+
+class MemoryEntry:
+    """Stands in for the os.DirEntry of an item in a MemoryFileSystem. Stats are taken when first asked for"""
+    def __init__(self, path, node):
+        self.name = os.path.basename(path)
+        self.path = path
+        self.node = node
+        self._stats = None
+
+    def is_dir(self, follow_symlinks=True):
+        return self.node.is_dir()
+
+    def is_file(self, follow_symlinks=True):
+        return not self.node.is_dir()
+
+    def is_symlink(self):
+        return False
+
+    def stat(self, follow_symlinks=True):
+        if self._stats is None:
+            self._stats = self.node.stat()
+        return self._stats
+
+
+class MemoryFile(io.BytesIO):
+    """A file in a MemoryFileSystem opened for writing. Its contents are stored when it is closed"""
+    def __init__(self, node):
+        super().__init__()
+        self.node = node
+
+    def close(self):
+        if not self.closed:
+            self.node.data = self.getvalue()
+            self.node.mtime_ns = self.node.ctime_ns = time.time_ns()
+        super().close()
+
+
+class MemoryFileSystem:
+    """
+    A filesystem backend that holds everything in memory, for tests and benchmarks that shouldn't depend on real disks.
+    Paths are absolute, and folders have to be made before anything is put in them, as on a real filesystem. Safe to
+    use from several threads at once.
+    """
+    local = False
+    native_copies = False
+
+    def __init__(self):
+        self.inodes = itertools.count(1)
+        self.nodes = {'/': MemoryNode(next(self.inodes), is_dir=True)}
+        self.lock = threading.RLock()
+
+    @classmethod
+    def error(cls, error_class, error_number, path):
+        return error_class(error_number, os.strerror(error_number), path)
+
+    def node(self, path):
+        """Return the node at a path"""
+        try:
+            return self.nodes[os.path.normpath(path)]
+        except KeyError:
+            raise self.error(FileNotFoundError, errno.ENOENT, path) from None
+
+    def add_node(self, path, is_dir):
+        """Add an item to its folder, which has to exist. Returns the new node"""
+        path = os.path.normpath(path)
+        parent = self.node(os.path.dirname(path))
+        if not parent.is_dir():
+            raise self.error(NotADirectoryError, errno.ENOTDIR, path)
+        node = MemoryNode(next(self.inodes), is_dir)
+        self.nodes[path] = node
+        parent.children.add(os.path.basename(path))
+        return node
+
+    def scandir(self, path):
+        with self.lock:
+            node = self.node(path)
+            if not node.is_dir():
+                raise self.error(NotADirectoryError, errno.ENOTDIR, path)
+            return [MemoryEntry(os.path.join(path, name), self.nodes[os.path.join(os.path.normpath(path), name)])
+                    for name in node.children]
+
+    def stat(self, path):
+        with self.lock:
+            return self.node(path).stat()
+
+    def exists(self, path):
+        return os.path.normpath(path) in self.nodes
+
+    def lexists(self, path):
+        return self.exists(path)
+
+    def isdir(self, path):
+        node = self.nodes.get(os.path.normpath(path))
+        return node is not None and node.is_dir()
+
+    def mkdir(self, path):
+        with self.lock:
+            if self.exists(path):
+                raise self.error(FileExistsError, errno.EEXIST, path)
+            self.add_node(path, is_dir=True)
+
+    def makedirs(self, path, exist_ok=False):
+        with self.lock:
+            if self.exists(path):
+                if not exist_ok or not self.isdir(path):
+                    raise self.error(FileExistsError, errno.EEXIST, path)
+                return
+            parent_path = os.path.dirname(os.path.normpath(path))
+            if not self.exists(parent_path):
+                self.makedirs(parent_path)
+            self.add_node(path, is_dir=True)
+
+    def open(self, path, mode):
+        with self.lock:
+            if mode == 'rb':
+                node = self.node(path)
+                if node.is_dir():
+                    raise self.error(IsADirectoryError, errno.EISDIR, path)
+                node.atime_ns = time.time_ns()
+                return io.BytesIO(node.data)
+            if mode != 'wb':
+                raise ValueError("Memory files can only be opened with 'rb' or 'wb', not '{}'".format(mode))
+            if self.exists(path):
+                node = self.node(path)
+                if node.is_dir():
+                    raise self.error(IsADirectoryError, errno.EISDIR, path)
+                node.data = b''
+            else:
+                node = self.add_node(path, is_dir=False)
+            return MemoryFile(node)
+
+    def remove(self, path):
+        with self.lock:
+            if self.node(path).is_dir():
+                raise self.error(IsADirectoryError, errno.EISDIR, path)
+            self.remove_node(path)
+
+    def remove_node(self, path):
+        """Remove an item, and everything in it if it is a folder"""
+        path = os.path.normpath(path)
+        node = self.nodes.pop(path)
+        for name in node.children or ():
+            self.remove_node(os.path.join(path, name))
+        parent = self.nodes.get(os.path.dirname(path))
+        if parent is not None and parent is not node:
+            parent.children.discard(os.path.basename(path))
+
+    def rmtree(self, path):
+        with self.lock:
+            self.node(path)
+            self.remove_node(path)
+
+    def rename(self, source_path, dest_path):
+        with self.lock:
+            source_path = os.path.normpath(source_path)
+            dest_path = os.path.normpath(dest_path)
+            node = self.node(source_path)
+            if self.exists(dest_path):
+                if node.is_dir() or self.isdir(dest_path):
+                    raise self.error(FileExistsError, errno.EEXIST, dest_path)
+                self.remove_node(dest_path)
+            dest_parent = self.node(os.path.dirname(dest_path))
+            # Move the item and everything in it to the new path
+            moved_paths = [path for path in self.nodes
+                           if path == source_path or path.startswith(source_path.rstrip('/') + '/')]
+            for path in moved_paths:
+                self.nodes[dest_path + path[len(source_path):]] = self.nodes.pop(path)
+            self.nodes[os.path.dirname(source_path)].children.discard(os.path.basename(source_path))
+            dest_parent.children.add(os.path.basename(dest_path))
+
+    def replace(self, source_path, dest_path):
+        self.rename(source_path, dest_path)
+
+    def move(self, source_path, dest_path):
+        self.rename(source_path, dest_path)
+
+    def copystat(self, source_path, dest_path):
+        with self.lock:
+            source_node = self.node(source_path)
+            dest_node = self.node(dest_path)
+            dest_node.mode = stat.S_IFMT(dest_node.mode) | stat.S_IMODE(source_node.mode)
+            dest_node.atime_ns = source_node.atime_ns
+            dest_node.mtime_ns = source_node.mtime_ns
+
+    def chmod(self, path, mode):
+        with self.lock:
+            node = self.node(path)
+            node.mode = stat.S_IFMT(node.mode) | stat.S_IMODE(mode)
+
+    def utime(self, path, times):
+        """Set the access and modified times of an item, as (atime, mtime) in seconds"""
+        with self.lock:
+            node = self.node(path)
+            node.atime_ns, node.mtime_ns = (int(value * 1000000000) for value in times)
+
+
+class LatencyFileSystem:
+    """
+    Wraps another filesystem backend, waiting before each call to simulate a slow filesystem, such as a far away
+    network share. The delay is made of a fixed latency per call, plus time for the data read or written if a
+    bandwidth is given. Used to test how the backup copes with high latency without needing a slow filesystem.
+    """
+    # File contents have to pass through the delays, so they are never copied by the kernel
+    native_copies = False
+
+    def __init__(self, backend, latency, bandwidth=None):
+        self.backend = backend
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.local = backend.local
+
+    def __getattr__(self, name):
+        # Every call is passed on after the delay
+        method = getattr(self.backend, name)
+
+        def delayed(*method_args, **method_kwargs):
+            time.sleep(self.latency)
+            return method(*method_args, **method_kwargs)
+        return delayed
+
+    def scandir(self, path):
+        time.sleep(self.latency)
+        return [LatencyEntry(entry, self.latency) for entry in self.backend.scandir(path)]
+
+    def open(self, path, mode):
+        time.sleep(self.latency)
+        return LatencyFile(self.backend.open(path, mode), self.bandwidth)
+
+
+class LatencyEntry:
+    """
+    An item listed by a LatencyFileSystem. The listing already gives the type of each item, as on most filesystems, but
+    stat'ing it waits for the latency
+    """
+    def __init__(self, entry, latency):
+        self.entry = entry
+        self.name = entry.name
+        self.path = entry.path
+        self.latency = latency
+        self._stats = None
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks=True):
+        if self._stats is None:
+            time.sleep(self.latency)
+            self._stats = self.entry.stat(follow_symlinks=follow_symlinks)
+        return self._stats
+
+
+class LatencyFile:
+    """A file opened through a LatencyFileSystem. Reads and writes take as long as the bandwidth allows, if it is set"""
+    def __init__(self, file, bandwidth):
+        self.file = file
+        self.bandwidth = bandwidth
+
+    def delay(self, num_bytes):
+        if self.bandwidth:
+            time.sleep(num_bytes / self.bandwidth)
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.delay(len(data))
+        return data
+
+    def readinto(self, buffer):
+        read = self.file.readinto(buffer)
+        self.delay(read)
+        return read
+
+    def write(self, data):
+        self.delay(len(data))
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+
+class BackupStats:
+    """
+    The outcome of a Backup job: its status code, which == 0 if the backup succeeded, and a result for each destination
+    holding the paths, status, total time, and counters in the layout of INFO_DATA of the backup to it (followed by
+    those of each job in the batch file, if the job was given one)
+    """
+    def __init__(self, status, results):
+        self.status = status
+        self.results = results
+
+    @property
+    def info_data(self):
+        """Counters of the backup to the first destination, for jobs with only one"""
+        return self.results[0]['info_data'] if self.results else None
+
+
+class Job:
+    """
+    The state of the backup to one destination: its options, the filesystem backend it goes through, its counters and
+    timer, and the pools, stores and caches it uses. A source backed up to several destinations has a job for each.
+    Every function taking part in a backup is given its job, so that nothing is kept at module level and several
+    backups can run at the same time in one process.
+    """
+    def __init__(self, args, filesystem, copy_pool=None, folder_scanner=None):
+        self.args = args
+        # Filesystem backend that the tree is walked and copied through
+        self.filesystem = filesystem
+        # Counters of the backup, and the lock guarding them against concurrent updates from copy workers and scanners
+        self.info_data = copy.deepcopy(INFO_DATA)
+        self.info_lock = threading.Lock()
+        self.timer = Timer()
+        # Pool used to run copies in parallel, and pool used to scan folders ahead of processing them, if enabled. Both
+        # can be handed on to the next job of a batch
+        self.copy_pool = copy_pool
+        self.folder_scanner = folder_scanner
+        # Destination folder, the folder the source is compared against (the destination itself, or the previous
+        # snapshot when making snapshots), and the folder conflicts are archived to
+        self.dest_path = None
+        self.compare_path = None
+        self.archive_path = None
+        # Manifest of the destination. Used instead of scanning the destination if it has one from a previous run
+        self.manifest = None
+        # Cache of file digests used by copymode 3, if enabled
+        self.hash_cache = None
+        # Trash folder that deleted conflicts are moved to, if enabled
+        self.trash_path = None
+        # Store for small files in the destination, if packing is enabled
+        self.pack_store = None
+        # Snapshot being made in the destination, if making snapshots
+        self.snapshot_store = None
+        # Journal of the progress of the run, if the run can be resumed
+        self.journal = None
+        # Throttle shared by all I/O, if limits are set
+        self.throttle = None
+        # Rules deciding which items are left out of the backup, if any are set
+        self.filter_rules = None
+        # Collects detailed timings, if profiling
+        self.profiler = None
+        # Collects the files to check after the backup, if verifying
+        self.verifier = None
+        # Copy strategy to use and buffer size for userspace copies of large files, from the options or the settings
+        # saved by --calibrate for the folders being backed up
+        self.copy_strategy = 'auto'
+        self.copy_buffer_size = COPY_LARGE_BUFFER_SIZE
+
+
+class Backup:
+    """
+    A backup job for use from other programs. Options are given as keyword arguments named like the command line
+    options (e.g. copymode=3, workers=4, exclude=['*.tmp']) and have the same defaults. Values given as strings are
+    parsed like the command line would, so bwlimit='20M' works as well as bwlimit=20971520. Options that can be given
+    several times take a list, or a single string. Values of the wrong type raise TypeError, and values that can't be
+    parsed or aren't one of the choices of the option raise ValueError. Everything is done through the filesystem
+    backend, local files by default. The destination can be a list of several destinations, which are backed up to
+    together, reading the source once.
+    Each run keeps all of its state (the options, counters, pools and stores) to itself, so backups can be run at the
+    same time from several threads of one process, as long as they don't back up to the same destination.
+    """
+    def __init__(self, source, destination, filesystem=None, **options):
+        parser = build_parser()
+        # Paths can also be given as path objects, and several destinations as a list of paths
+        destinations = [destination] if isinstance(destination, (str, os.PathLike)) else list(destination)
+        self.config = parser.parse_args(['--', os.fspath(source)] + [os.fspath(path) for path in destinations])
+        actions = {action.dest: action for action in parser._actions}
+        for name, value in options.items():
+            if name not in actions or name in ('source', 'destination', 'help'):
+                raise TypeError("Unknown backup option '{}'".format(name))
+            setattr(self.config, name, self._parse_option(actions[name], value))
+        self.filesystem = filesystem if filesystem is not None else LocalFileSystem()
+
+    @staticmethod
+    def _parse_option(action, value):
+        """Check an option value against its command line option, parsing it if given as a string"""
+        name = action.dest
+        if isinstance(action, argparse._AppendAction):
+            # A single value is a list of one, rather than a string to be split into its characters
+            if isinstance(value, str):
+                value = [value]
+            if not isinstance(value, (list, tuple)) or not all(isinstance(item, str) for item in value):
+                raise TypeError("Backup option '{}' takes a string or a list of strings".format(name))
+            return list(value)
+        if isinstance(action, (argparse._StoreTrueAction, argparse._StoreFalseAction)):
+            if not isinstance(value, bool):
+                raise TypeError("Backup option '{}' takes True or False".format(name))
+            return value
+        if value is None and action.default is None:
+            return value
+        if isinstance(value, str) and action.type not in (None, str):
+            value = action.type(value)
+        elif action.type is str and not isinstance(value, str):
+            raise TypeError("Backup option '{}' takes a string".format(name))
+        elif action.type is int and (not isinstance(value, int) or isinstance(value, bool)):
+            raise TypeError("Backup option '{}' takes an integer".format(name))
+        elif action.type in (float, parse_data_size, parse_duration) and (not isinstance(value, (int, float)) or
+                                                                          isinstance(value, bool)):
+            raise TypeError("Backup option '{}' takes a number".format(name))
+        if action.choices is not None and value not in action.choices:
+            raise ValueError("Invalid value for backup option '{}': {!r} (choose from {})".format(
+                name, value, ", ".join(repr(choice) for choice in action.choices)))
+        return value
+
+    def run(self):
+        """Run the backup. Returns its BackupStats"""
+        status, results = run_backups(self.config, self.filesystem)
+        return BackupStats(status, results)
+
+
+LOG_FORMAT = "%(asctime)s:%(name)s:%(levelname)s: %(message)s"
+LOG_LEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR,
+              'CRITICAL': logging.CRITICAL}
+
+# Counters of a backup as they are before it starts. Each Job counts into its own copy
+INFO_DATA = {
+    'files': {
+        'num_processed': 0,
+        'num_copied': 0,
+        'size_copied': 0,
+        'num_skipped': 0,
+        'size_skipped': 0,
+        'num_deleted': 0,
+        'not_copied': 0,
+        'size_written': 0,
+        'num_delta_copied': 0,
+        'num_packed': 0,
+        'size_packed': 0,
+        'num_linked': 0,
+        'num_deduplicated': 0,
+        'size_deduplicated': 0,
+        'num_filtered': 0,
+        'size_filtered': 0,
+    },
+    'folders': {
+        'num_created': 0,
+        'num_deleted': 0,
+        'num_filtered': 0,
+    },
+    'copy_strategies': {
+        'reflink': 0,
+        'copy_file_range': 0,
+        'sendfile': 0,
+        'userspace': 0,
+    },
+    'compression': {
+        'num_compressed': 0,
+        'size_original': 0,
+        'size_compressed': 0,
+        'num_incompressible': 0,
+        'cpu_time': 0,
+    },
+    'time_spent': {
+        'copying': 0,
+        'resolving': 0,
+        'scanning': 0,
+        'stats': 0,
+        'hashing': 0,
+        'deciding': 0,
+        'checkpointing': 0,
+        'throttled': 0,
+        'verifying': 0,
+    },
+    'verify': {
+        'num_verified': 0,
+        'size_verified': 0,
+        'num_failed': 0,
+        'num_changed': 0,
+    },
+    'misc': {
+        'conflicts_resolved': 0,
+        'hashes_made': 0,
+        'data_hashed': 0,
+        'hash_cache_hits': 0,
+        'hash_cache_misses': 0,
+        'checkpoints': 0,
+        'throttle_backoffs': 0,
+    },
+    'errors': {
+
+    },
+}
+# Size of the blocks read from each file when comparing file contents
+COMPARE_CHUNK_SIZE = 1048576
+# ioctl request used to clone a file on copy-on-write filesystems (Linux FICLONE)
+FICLONE = 0x40049409
+# Maximum number of bytes copied by one copy_file_range() or sendfile() call
+COPY_RANGE_CHUNK = 1073741824
+# Copies by file size: files smaller than COPY_SMALL_SIZE are read and written in one go, and files of at least
+# COPY_LARGE_SIZE have their space allocated up front, are kept out of the page cache, and are copied through a buffer
+# of COPY_LARGE_BUFFER_SIZE (unless set by --copybuffer or --calibrate) when copied in userspace. Larger buffers were
+# slower on a local disk when measured, so they are left for --calibrate to pick where they pay off
+COPY_SMALL_SIZE = 16384
+COPY_LARGE_SIZE = 16777216
+COPY_LARGE_BUFFER_SIZE = 1048576
+# fallocate() mode that allocates space without changing the size of the file (Linux FALLOC_FL_KEEP_SIZE)
+FALLOC_FL_KEEP_SIZE = 0x01
+# Calibration: size of the source file it tries to find to copy, how many items of the source it looks through for
+# one, the buffer sizes tried for userspace copies, and the number of times each copy is timed
+CALIBRATE_FILE_SIZE = 134217728
+CALIBRATE_MAX_SCANNED = 100000
+CALIBRATE_BUFFER_SIZES = [131072, 1048576, 4194304, 8388608, 16777216]
+CALIBRATE_RUNS = 2
+# Name of the file in the user's config folder holding the copy settings saved by --calibrate
+CALIBRATION_NAME = 'calibration.json'
+# Errors raised by a copy strategy that mean it can't be used between two filesystems, rather than a real failure
+COPY_UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY,
+                           errno.EBADF, errno.EPERM}
+# Files smaller than this are always copied in full when delta copying
+DELTA_MIN_SIZE = 16777216
+# Number of blocks checked before deciding whether a delta copy is still worthwhile, and the fraction of changed blocks
+# above which the rest of the file is written without comparing
+DELTA_PROBE_BLOCKS = 16
+DELTA_MAX_CHANGED = 0.5
+# Copy strategies that have failed as unsupported, as (strategy name, source device, destination device)
+unsupported_copy_strategies = set()
+# Reusable read buffers for comparing file contents, one pair per thread
+compare_buffers = threading.local()
+# Buffer of each copying thread for userspace copies of large files
+copy_buffers = threading.local()
+# Read buffer of each verifying thread
+verify_buffers = threading.local()
+
+# Name of the folder in the destination root that deleted conflicts are moved to before being purged
+TRASH_NAME = '.sibackup_trash'
+
+# inotify events watched for in watch mode, and how the events read from inotify are laid out
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                      IN_ONLYDIR)
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 65536
+
+# Phases shown by --profile, as (time_spent counter, name). Deciding includes the hashing done to compare files
+PROFILE_PHASES = [('scanning', 'Scan'), ('stats', 'Stat'), ('deciding', 'Decide'), ('hashing', 'Hash'),
+                  ('copying', 'Copy'), ('resolving', 'Resolve'), ('throttled', 'Throttled'),
+                  ('checkpointing', 'Checkpoint')]
+# Upper bounds of the file size buckets that copy latencies are grouped by
+PROFILE_SIZE_BUCKETS = [4096, 65536, 1048576, 16777216, 268435456]
+# Latency histograms start at PROFILE_MIN_LATENCY seconds, with PROFILE_BINS_PER_DOUBLING bins each time the latency
+# doubles, up to about 70 minutes
+PROFILE_MIN_LATENCY = 0.000001
+PROFILE_BINS_PER_DOUBLING = 4
+PROFILE_LATENCY_BINS = 130
+# Number of functions listed from the cProfile results
+PROFILE_TOP_FUNCTIONS = 25
+
+# Device number given to the items in a MemoryFileSystem
+MEMORY_DEVICE = 0x6d656d
+
+# Size of the blocks read from each file when verifying, large so that files are read sequentially in few requests
+VERIFY_CHUNK_SIZE = 8388608
+
+# Units of the durations given to the age filters, in seconds
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# Seconds of I/O the throttle lets through in a burst, and the size of the chunks copied in while throttling so that
+# I/O is spread out evenly instead of coming in huge bursts
+THROTTLE_BURST = 1
+THROTTLE_CHUNK_SIZE = 1048576
+# Adaptive throttling: smallest I/O used to measure latency, how quickly the smoothed latency follows new measurements,
+# how often the rates are adjusted, how far above the lowest latency seen counts as congested, how much the rates are
+# multiplied by when congested, the least share of the limits they can go down to, and the share of the limits they
+# recover by at each adjustment
+THROTTLE_MIN_SAMPLE = 65536
+THROTTLE_SMOOTHING = 0.2
+THROTTLE_ADJUST_INTERVAL = 1
+THROTTLE_LATENCY_FACTOR = 2
+THROTTLE_BACKOFF = 0.7
+THROTTLE_MIN_SHARE = 0.05
+THROTTLE_RECOVERY = 0.05
+
+# How many times the watch delay a sync can be held off by files that keep changing
+WATCH_MAX_DELAY_FACTOR = 10
+
+# Suffix and header of compressed destination files. The header holds the codec used and the original size of the file
+COMPRESSED_SUFFIX = '.sibackupz'
+COMPRESSED_HEADER = struct.Struct('>4sBQ')
+COMPRESSED_MAGIC = b'SIBZ'
+
+# Codecs that can be used to compress files, as (ID stored in the header, default level)
+COMPRESSION_CODECS = {'zlib': (1, 6), 'lzma': (2, 6), 'zstd': (3, 3)}
+
+# Amount of the start of a file that is compressed to judge whether the file is worth compressing, and the compressed
+# size (relative to the sample) above which the file is stored as it is
+COMPRESS_SAMPLE_SIZE = 65536
+COMPRESS_SAMPLE_MAX_RATIO = 0.95
+
+# Extensions of files that are already compressed, and so are never worth compressing again
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.apk', '.avi', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg', '.lz4',
+    '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp', '.xlsx', '.xz',
+    '.zip', '.zst', COMPRESSED_SUFFIX,
+}
+
+# Name of the folder in the destination root holding pack files, and the size at which a new pack file is started
+PACK_NAME = '.sibackup_packs'
+PACK_FILE_SIZE = 268435456
+
+# Names of the folders in the destination holding snapshots and the objects they link to, and how snapshots are named
+SNAPSHOTS_NAME = 'snapshots'
+OBJECTS_NAME = 'objects'
+SNAPSHOT_NAME_FORMAT = '%Y-%m-%d_%H%M%S'
+# Name of the folder among the snapshots that holds the manifest of each snapshot
+SNAPSHOT_MANIFESTS_NAME = '.manifests'
+
+# Name of the journal kept in the destination root while a run is in progress, and the prefix of the temp files that
+# files are copied to before being renamed into place
+JOURNAL_NAME = '.sibackup_journal.db'
+TEMP_PREFIX = '.sibackup_tmp.'
+
+# Name of the manifest file kept in the destination root, and how many records to write to it at once
+MANIFEST_NAME = '.sibackup_manifest.db'
+MANIFEST_BATCH_SIZE = 10000
+
+# Logger of the module, shared by every job
+logger = logging.getLogger(__name__)
+
+# The C library, loaded by load_libc() the first time one of its functions is needed. False where it can't be loaded
+libc = None
+
+# Counters that name the items moved to the trash and the temp files that files are copied to, together with the
+# process ID. They are shared by every job in the process, so that jobs never pick the same name
+trash_counter = itertools.count()
+temp_counter = itertools.count()
+
+
+def format_data_size(data_size):
+    data_size_values = [1, 1024, 1048576, 1073741824, 1099511627776]
+    data_size_names = ['B', 'KB', 'MB', 'GB', 'TB']
+
+    # Special case: if the size is empty, return 0B
+    if data_size == 0:
+        return "0B"
+
+    # Check each tier in reverse: If the data size is greater than one unit of that value, it will be used as the base
+    for i in range(len(data_size_values) - 1, -1, -1):
+        data_size_value = data_size_values[i]
+        if data_size >= data_size_value:
+            return "{:.3f}{}".format(
+                data_size / data_size_value,
+                data_size_names[i],
+            )
+
+
+def parse_data_size(text):
+    """Parse a data size such as '500K' or '10MB', in the same units as format_data_size"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', text, re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid data size '{}'".format(text))
+    return float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' ')
+
+
+def parse_duration(text):
+    """Parse a length of time such as '90s', '12h' or '30d' into seconds. A number alone is taken as days"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*', text, re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid duration '{}'".format(text))
+    return float(match.group(1)) * DURATION_UNITS[match.group(2).lower() or 'd']
+
+
+def glob_to_regex(pattern):
+    """
+    Translate a gitignore-style glob into a regular expression. '*' and '?' don't match across folders, while '**'
+    matches any number of folders.
+    """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:[^\\0]*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '[^\\0]*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/\\0]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/\\0]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            contents = pattern[i + 1:end].replace('\\', '\\\\')
+            if contents.startswith('!'):
+                contents = '^' + contents[1:]
+            regex += '[' + contents + ']'
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+def read_batch_file(path_name):
+    """
+    Read the jobs in a batch file, one per line: a source followed by one or more destinations, separated by spaces.
+    Paths holding spaces can be quoted like in a shell. Blank lines and comments starting with '#' are skipped.
+    Returns a list of (source, [destinations])
+    """
+    import shlex
+    jobs = []
+    with open(path_name, 'r', encoding='utf8') as batch_file:
+        for line_number, line in enumerate(batch_file, 1):
+            paths = shlex.split(line, comments=True)
+            if not paths:
+                continue
+            if len(paths) < 2:
+                raise ValueError("Line {} needs a source and at least one destination".format(line_number))
+            jobs.append((paths[0], paths[1:]))
+    return jobs
+
+
+def read_filter_file(path_name):
+    """Read the rules in a gitignore-style file, skipping blank lines and comments"""
+    with open(path_name, 'r') as filter_file:
+        lines = [line.rstrip('\n') for line in filter_file]
+    return [line.rstrip() for line in lines if line.strip() and not line.startswith('#')]
+
+
+def parse_schedule(text):
+    """Parse a list of times of day such as '08:00-12:00,13:00-18:00' into (start, end) minutes past midnight"""
+    schedule = []
+    for window in text.split(','):
+        match = re.fullmatch(r'\s*(\d{1,2}):(\d\d)\s*-\s*(\d{1,2}):(\d\d)\s*', window)
+        if match is None:
+            raise ValueError("Invalid time window '{}'".format(window))
+        start_hour, start_minute, end_hour, end_minute = (int(group) for group in match.groups())
+        if max(start_hour, end_hour) > 23 or max(start_minute, end_minute) > 59:
+            raise ValueError("Invalid time window '{}'".format(window))
+        schedule.append((start_hour * 60 + start_minute, end_hour * 60 + end_minute))
+    return schedule
+
+
+def throttle_io(job, num_bytes, ops=1):
+    """Count I/O that was just done against the limits, waiting if they were exceeded. Does nothing unless throttling"""
+    if job.throttle is not None:
+        job.throttle.consume(num_bytes, ops)
+
+
+def sim_text(job):
+    """Return a string to signify that nothing has actually happened if set to simulate, otherwise return nothing"""
+    return "<Simulate>: " if job.args.simulate else ""
+
+
+def conflict_text(job, present_tense):
+    """Return a string to represent what type of conflict resolution was used"""
+    if job.args.conflictmode == 0:
+        return "ignoring" if present_tense else "ignored"
+    elif job.args.conflictmode == 1:
+        return "archiving" if present_tense else "archived"
+    else:  # args.conflictmode == 2
+        return "deleting" if present_tense else "deleted"
+
+
+def scan_folder(job, path):
+    """Return a dict mapping the name of each item in a folder to its os.DirEntry"""
+    listing = {entry.name: entry for entry in job.filesystem.scandir(path)}
+    throttle_io(job, 0)
+    return listing
+
+
+def scan_folders(jobs, source_path, current_folder, prefetch_stats=False):
+    """
+    List a source folder once, and the same folder in the destination of each job. Returns a list with a
+    (source_entries, dest_entries, dest_missing) for each job, each with a source listing of its own to filter. The
+    source entries are shared, so a source file stat'ed for one job is stat'ed for all of them.
+    May be run from a scanner thread.
+    """
+    start_time = time.perf_counter()
+    source_entries = scan_folder(jobs[0], os.path.join(source_path, current_folder))
+    scan_time = time.perf_counter() - start_time
+    return [scan_dest_folder(job, dict(source_entries), current_folder, scan_time, prefetch_stats) for job in jobs]
+
+
+def scan_dest_folder(job, source_entries, current_folder, scan_time=0, prefetch_stats=False):
+    """
+    List the destination folder of a job matching a listed source folder. The destination listing comes from the
+    manifest if there is one. Items left out by the filter rules are removed from both listings before anything is
+    stat'ed. Returns (source_entries, dest_entries, dest_missing). If prefetch_stats is set, the source files and their
+    destination counterparts are stat'ed too, so that their stats are already cached when they are processed. The time
+    given is what listing the source took, and is counted as scanning time.
+    May be run from a scanner thread.
+    """
+    start_time = time.perf_counter()
+    current_dest_path = os.path.join(job.compare_path, current_folder)
+    dest_missing = not job.filesystem.exists(current_dest_path)
+    if dest_missing:
+        # The destination folder will be created (or would have been if not simulating), so it will be empty
+        dest_entries = {}
+    elif job.manifest.previous is not None:
+        # Use the destination listing recorded by the last run instead of scanning the destination again
+        dest_entries = job.manifest.list_folder(current_dest_path)
+    else:
+        dest_entries = scan_folder(job, current_dest_path)
+    # List compressed files under the name of the original file, unless a normal file has that name
+    for name in [name for name in dest_entries if name.endswith(COMPRESSED_SUFFIX)]:
+        original_name = name[:-len(COMPRESSED_SUFFIX)]
+        if original_name and original_name not in dest_entries and not dest_entries[name].is_dir():
+            dest_entries[original_name] = CompressedEntry(dest_entries.pop(name))
+    if job.pack_store is not None:
+        # Add the files packed from this folder. A normal file with the same name replaced the packed one
+        for name, pack_entry in job.pack_store.list_folder(current_dest_path).items():
+            if name in dest_entries:
+                job.pack_store.forget(pack_entry.path)
+            else:
+                dest_entries[name] = pack_entry
+    if job.filter_rules is not None:
+        job.filter_rules.filter_folder(current_folder, source_entries, dest_entries)
+    scan_time += time.perf_counter() - start_time
+
+    stats_time = 0
+    if prefetch_stats:
+        start_time = time.perf_counter()
+        for name, source_entry in source_entries.items():
+            try:
+                if not source_entry.is_dir():
+                    source_entry.stat()
+                    if name in dest_entries:
+                        dest_entries[name].stat()
+            except OSError:
+                # Errors are not cached, so they will be raised again and reported when the entry is processed
+                continue
+        stats_time = time.perf_counter() - start_time
+
+    with job.info_lock:
+        job.info_data['time_spent']['scanning'] += scan_time
+        job.info_data['time_spent']['stats'] += stats_time
+    return source_entries, dest_entries, dest_missing
+
+
+def diff_folders(source_entries, dest_entries):
+    """
+    Merge the source and destination listings of a folder into a single diff without any extra syscalls.
+    Returns a lazy iterator of (source_entry, dest_entry) pairs for every item in the source, where dest_entry is None
+    if the item is not present in the destination, and a list of destination entries that are not present in the
+    source.
+    """
+    pairs = ((source_entry, dest_entries.get(name)) for name, source_entry in source_entries.items())
+    conflicts = [dest_entry for name, dest_entry in dest_entries.items() if name not in source_entries]
+    return pairs, conflicts
+
+
+def copy_file(job, source_file_stats, dest_file_stats):
+    """
+    Copies a file from the source folder to the destination folder. If a copy pool is running, the copy is handed off
+    to one of its workers and this returns immediately.
+    """
+    logger.debug("{}Copying '{}'".format(sim_text(job), source_file_stats.path_name))
+    # Small files go into the pack files, unless there is already a normal destination file
+    if (job.pack_store is not None and source_file_stats.getsize() < job.args.packthreshold and
+            (dest_file_stats.packed or not dest_file_stats.exists())):
+        if not job.args.simulate:
+            pack_file(job, source_file_stats, dest_file_stats)
+        else:  # Simulate only
+            with job.info_lock:
+                job.info_data['files']['num_copied'] += 1
+                job.info_data['files']['size_copied'] += source_file_stats.getsize()
+                job.info_data['files']['num_packed'] += 1
+                job.info_data['files']['size_packed'] += source_file_stats.getsize()
+    elif not job.args.simulate:
+        file_job = snapshot_file_job if job.snapshot_store is not None else copy_file_job
+        if job.copy_pool is not None:
+            job.copy_pool.submit(file_job, job, source_file_stats, dest_file_stats)
+        else:
+            file_job(job, source_file_stats, dest_file_stats)
+    else:  # Simulate only
+        with job.info_lock:
+            job.info_data['files']['num_copied'] += 1
+            job.info_data['files']['size_copied'] += source_file_stats.getsize()
+
+
+def write_atomically(job, path_name, source_file_stats, write_function, *write_args):
+    """
+    Write a destination file from a source file by writing a temp file next to it with write_function(job, source
+    stats, temp stats, *write_args), then renaming it into place with the source's times and permissions. A destination
+    file is never left half-written, even if the process is killed. Returns what write_function returned
+    """
+    temp_path_name = os.path.join(os.path.dirname(path_name), '{}{}.{}'.format(TEMP_PREFIX, os.getpid(),
+                                                                                next(temp_counter)))
+    if job.journal is not None:
+        job.journal.copy_started(temp_path_name)
+    try:
+        result = write_function(job, source_file_stats, StatHelper(temp_path_name, exists=False), *write_args)
+        job.filesystem.copystat(source_file_stats.path_name, temp_path_name)
+        job.filesystem.replace(temp_path_name, path_name)
+    except BaseException:
+        try:
+            job.filesystem.remove(temp_path_name)
+        except OSError:
+            pass
+        raise
+    finally:
+        if job.journal is not None:
+            job.journal.copy_finished(temp_path_name)
+    return result
+
+
+def load_libc():
+    """Return the C library, loading it through ctypes the first time. Returns None where it can't be loaded"""
+    global libc
+    if libc is None:
+        import ctypes
+        try:
+            # The C library is already loaded into the interpreter, so its functions can be used without searching for
+            # it with ctypes.util.find_library(), which starts other programs and slows down startup
+            libc = ctypes.CDLL(None, use_errno=True)
+        except (OSError, TypeError):  # Not available on Windows
+            libc = False
+        else:
+            # fallocate() from the C library, to allocate the space of large files without writing to it. Only on Linux
+            if hasattr(libc, 'fallocate'):
+                libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return libc or None
+
+
+def sync_filesystem(path_name):
+    """Flush everything written to the filesystem holding a path to disk, with syncfs() where available"""
+    syncfs = getattr(load_libc(), 'syncfs', None)
+    if syncfs is None:
+        os.sync()
+        return
+    fd = os.open(path_name, os.O_RDONLY)
+    try:
+        if syncfs(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)
+
+
+def pack_file(job, source_file_stats, dest_file_stats):
+    """Adds a small file to the pack files instead of copying it to its own destination file"""
+    try:
+        start_time = time.perf_counter()
+        with open(source_file_stats.path_name, 'rb') as source_file:
+            data = source_file.read()
+        throttle_io(job, len(data))
+        job.pack_store.append(dest_file_stats.path_name, data, source_file_stats.stats)
+        copy_time = time.perf_counter() - start_time
+        if job.profiler is not None:
+            job.profiler.record_file(source_file_stats.path_name, len(data), copy_time)
+        with job.info_lock:
+            job.info_data['time_spent']['copying'] += copy_time
+            job.info_data['files']['num_copied'] += 1
+            job.info_data['files']['size_copied'] += source_file_stats.getsize()
+            job.info_data['files']['size_written'] += len(data)
+            job.info_data['files']['num_packed'] += 1
+            job.info_data['files']['size_packed'] += len(data)
+        if job.verifier is not None:
+            job.verifier.add(source_file_stats, dest_file_stats.path_name, True, 'packed')
+    except OSError as e:
+        logger.warning("Cannot pack file ({}): '{}'".format(e, source_file_stats.path_name))
+        count_not_copied(job, dest_file_stats.path_name)
+
+
+def count_not_copied(job, dest_path_name):
+    """Count a file that couldn't be copied, and keep its folder from being recorded as complete in the journal"""
+    with job.info_lock:
+        job.info_data['files']['not_copied'] += 1
+    if job.journal is not None:
+        job.journal.item_failed(dest_path_name)
+
+
+def copy_file_job(job, source_file_stats, dest_file_stats):
+    """Performs the actual copy of a file. May be run from a copy worker thread"""
+    try:
+        # The shared timer is only used by the traversal, so time the copy on its own
+        start_time = time.perf_counter()
+        # A compressed destination file has a different name from the original, so find the name of the original
+        plain_path_name = dest_file_stats.path_name
+        if dest_file_stats.compressed:
+            plain_path_name = plain_path_name[:-len(COMPRESSED_SUFFIX)]
+        codec = None
+        if job.args.compress is not None and worth_compressing(job, source_file_stats):
+            codec = job.args.compress
+        size_written = None
+        if codec is not None:
+            written_path_name = plain_path_name + COMPRESSED_SUFFIX
+            size_written = write_atomically(job, written_path_name, source_file_stats, compress_file, codec)
+        else:
+            written_path_name = plain_path_name
+            # Delta copies update the destination file in place, so unlike full copies they are not atomic
+            if (job.args.delta and dest_file_stats.exists() and not dest_file_stats.packed and
+                    not dest_file_stats.compressed and source_file_stats.getsize() >= DELTA_MIN_SIZE):
+                size_written = delta_copy(job, source_file_stats.path_name, dest_file_stats.path_name)
+            if size_written is None:
+                strategy = write_atomically(job, plain_path_name, source_file_stats, copy_file_data)
+                with job.info_lock:
+                    job.info_data['copy_strategies'][strategy] += 1
+        # Remove the old copy if it was stored the other way (compressed or not)
+        if written_path_name != dest_file_stats.path_name and dest_file_stats.exists() and not dest_file_stats.packed:
+            job.filesystem.remove(dest_file_stats.path_name)
+        copy_time = time.perf_counter() - start_time
+        if job.profiler is not None:
+            job.profiler.record_file(source_file_stats.path_name, source_file_stats.getsize(), copy_time)
+        with job.info_lock:
+            job.info_data['time_spent']['copying'] += copy_time
+            job.info_data['files']['num_copied'] += 1
+            job.info_data['files']['size_copied'] += source_file_stats.getsize()
+            if size_written is None:
+                job.info_data['files']['size_written'] += source_file_stats.getsize()
+            else:
+                job.info_data['files']['size_written'] += size_written
+                if codec is None:
+                    job.info_data['files']['num_delta_copied'] += 1
+        job.manifest.record(written_path_name, source_file_stats.stats)
+        # The file has outgrown the pack files, so the packed version is no longer needed
+        if dest_file_stats.packed:
+            job.pack_store.forget(dest_file_stats.path_name)
+        if job.verifier is not None:
+            job.verifier.add(source_file_stats, written_path_name, True, 'compressed' if codec is not None else None)
+    except PermissionError:
+        logger.warning("Cannot copy file here, access denied: '{}'".format(dest_file_stats.path_name))
+        count_not_copied(job, dest_file_stats.path_name)
+    except FileNotFoundError:
+        # If this error happens here, it's likely meaning that the destination file could not be found.
+        # This is likely due to the destination file path being too long for the OS to handle.
+        logger.warning("Cannot copy file here, destination path too long: '{}'".format(dest_file_stats.path_name))
+        count_not_copied(job, dest_file_stats.path_name)
+
+
+def snapshot_file_job(job, source_file_stats, dest_file_stats):
+    """Adds a new or changed file to the new snapshot through the object store. May be run from a copy worker thread"""
+    try:
+        start_time = time.perf_counter()
+        strategy = job.snapshot_store.store(source_file_stats, dest_file_stats.path_name)
+        copy_time = time.perf_counter() - start_time
+        if job.profiler is not None:
+            job.profiler.record_file(source_file_stats.path_name, source_file_stats.getsize(), copy_time)
+        with job.info_lock:
+            job.info_data['time_spent']['copying'] += copy_time
+            job.info_data['files']['num_copied'] += 1
+            job.info_data['files']['size_copied'] += source_file_stats.getsize()
+            if strategy is not None:
+                job.info_data['copy_strategies'][strategy] += 1
+                job.info_data['files']['size_written'] += source_file_stats.getsize()
+            else:
+                job.info_data['files']['num_deduplicated'] += 1
+                job.info_data['files']['size_deduplicated'] += source_file_stats.getsize()
+        # Record the stats of the stored file, since a deduplicated file keeps the times of the first copy
+        job.manifest.record(dest_file_stats.path_name,
+                            os.stat(job.snapshot_store.target_path(dest_file_stats.path_name)))
+        if job.verifier is not None:
+            job.verifier.add(source_file_stats, job.snapshot_store.target_path(dest_file_stats.path_name), True)
+    except OSError as e:
+        logger.warning("Cannot add file to snapshot ({}): '{}'".format(e, source_file_stats.path_name))
+        count_not_copied(job, dest_file_stats.path_name)
+
+
+def fan_out_file(targets, source_file_stats):
+    """
+    Copies a file to the destinations of several jobs, given as (job, destination stats) pairs, reading it only once.
+    If a copy pool is running, the copy is handed off to one of its workers and this returns immediately.
+    """
+    job = targets[0][0]
+    logger.debug("{}Copying '{}' to {} destinations".format(sim_text(job), source_file_stats.path_name, len(targets)))
+    if job.args.simulate:
+        for job, _ in targets:
+            with job.info_lock:
+                job.info_data['files']['num_copied'] += 1
+                job.info_data['files']['size_copied'] += source_file_stats.getsize()
+    elif not source_file_stats.isfile():
+        # Special files (FIFOs etc.) can't be read once for all destinations, so they are left to copy_file_data(),
+        # which knows how to refuse them
+        for job, dest_file_stats in targets:
+            copy_file(job, source_file_stats, dest_file_stats)
+    elif job.copy_pool is not None:
+        job.copy_pool.submit(fan_out_file_job, targets, source_file_stats)
+    else:
+        fan_out_file_job(targets, source_file_stats)
+
+
+def fan_out_file_job(targets, source_file_stats):
+    """
+    Performs the copy of a file to several destinations. Each block of the source is read once and written to every
+    destination in turn, so the copies go at the pace of the slowest destination, but only for this file. The other copy
+    workers carry on with their own files. Copies made this way always go through userspace, since the kernel can only
+    copy a file to one destination at a time. May be run from a copy worker thread
+    """
+    start_time = time.perf_counter()
+    writes = [FanOutWrite(job, dest_file_stats) for job, dest_file_stats in targets]
+    try:
+        for write in writes:
+            write.attempt(write.open)
+        # Read into a buffer kept for the next file, in chunks small enough to throttle if any destination is throttled
+        if any(write.job.throttle is not None for write in writes):
+            buffer_size = THROTTLE_CHUNK_SIZE
+        elif source_file_stats.getsize() >= COPY_LARGE_SIZE:
+            buffer_size = max(write.job.copy_buffer_size for write in writes)
+        else:
+            buffer_size = COMPARE_CHUNK_SIZE
+        if len(getattr(copy_buffers, 'buffer', b'')) < buffer_size:
+            copy_buffers.buffer = bytearray(buffer_size)
+        view = memoryview(copy_buffers.buffer)[:buffer_size]
+        try:
+            with writes[0].job.filesystem.open(source_file_stats.path_name, 'rb') as source_file:
+                while not all(write.failed for write in writes):
+                    read = source_file.readinto(view)
+                    if not read:
+                        break
+                    for write in writes:
+                        write.attempt(write.write, view[:read])
+        except (PermissionError, FileNotFoundError) as e:
+            for write in writes:
+                write.fail(e)
+        for write in writes:
+            if not write.attempt(write.finish, source_file_stats):
+                continue
+            job = write.job
+            copy_time = time.perf_counter() - start_time
+            if job.profiler is not None:
+                job.profiler.record_file(source_file_stats.path_name, source_file_stats.getsize(), copy_time)
+            with job.info_lock:
+                job.info_data['time_spent']['copying'] += copy_time
+                job.info_data['files']['num_copied'] += 1
+                job.info_data['files']['size_copied'] += source_file_stats.getsize()
+                job.info_data['files']['size_written'] += source_file_stats.getsize()
+                job.info_data['copy_strategies']['userspace'] += 1
+            job.manifest.record(write.path_name, source_file_stats.stats)
+            if job.verifier is not None:
+                job.verifier.add(source_file_stats, write.path_name, True)
+    finally:
+        for write in writes:
+            write.close()
+
+
+def copy_with_reflink(job, source_file, dest_file, size):
+    """
+    Clone the source file into the destination, sharing its blocks on a copy-on-write filesystem. Like the other
+    strategies, it is given the size of the file, which only the userspace copy uses
+    """
+    fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+    # No data is copied, so only count it as an operation
+    throttle_io(job, 0)
+
+
+def copy_with_copy_file_range(job, source_file, dest_file, size):
+    """Copy the file contents inside the kernel with copy_file_range()"""
+    chunk_size = THROTTLE_CHUNK_SIZE if job.throttle is not None else COPY_RANGE_CHUNK
+    offset = 0
+    while True:
+        copied = os.copy_file_range(source_file.fileno(), dest_file.fileno(), chunk_size, offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+        throttle_io(job, copied)
+
+
+def copy_with_sendfile(job, source_file, dest_file, size):
+    """Copy the file contents inside the kernel with sendfile()"""
+    chunk_size = THROTTLE_CHUNK_SIZE if job.throttle is not None else COPY_RANGE_CHUNK
+    offset = 0
+    while True:
+        copied = os.sendfile(dest_file.fileno(), source_file.fileno(), offset, chunk_size)
+        if copied == 0:
+            break
+        offset += copied
+        throttle_io(job, copied)
+
+
+def copy_with_userspace(job, source_file, dest_file, size):
+    """
+    Copy the file contents through a userspace buffer. Works everywhere. Large files are copied through a buffer that is
+    kept for the next file, sized by --copybuffer or --calibrate, unless throttling, where I/O is kept to small chunks
+    """
+    if job.throttle is not None:
+        buffer_size = THROTTLE_CHUNK_SIZE
+    elif size >= COPY_LARGE_SIZE:
+        buffer_size = job.copy_buffer_size
+    else:
+        shutil.copyfileobj(source_file, dest_file, COMPARE_CHUNK_SIZE)
+        return
+    if len(getattr(copy_buffers, 'buffer', b'')) < buffer_size:
+        copy_buffers.buffer = bytearray(buffer_size)
+    view = memoryview(copy_buffers.buffer)[:buffer_size]
+    while True:
+        read = source_file.readinto(view)
+        if not read:
+            break
+        dest_file.write(view[:read])
+        throttle_io(job, read)
+
+
+# Ways of copying file contents, in order of preference. Each is tried in turn until one works for the file
+COPY_STRATEGIES = []
+if fcntl is not None and hasattr(fcntl, 'ioctl'):
+    COPY_STRATEGIES.append(('reflink', copy_with_reflink))
+if hasattr(os, 'copy_file_range'):
+    COPY_STRATEGIES.append(('copy_file_range', copy_with_copy_file_range))
+if hasattr(os, 'sendfile'):
+    COPY_STRATEGIES.append(('sendfile', copy_with_sendfile))
+COPY_STRATEGIES.append(('userspace', copy_with_userspace))
+
+
+def preallocate(dest_file, size):
+    """
+    Allocate the space of a destination file before copying to it, without changing its size, so that it is laid out
+    in as few pieces as possible and a full disk is found before copying. fallocate() is used rather than
+    posix_fallocate(), which writes zeros to every block where the filesystem can't allocate space by itself.
+    """
+    import ctypes
+    if load_libc().fallocate(dest_file.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def advise(file, advice):
+    """Hint to the kernel how a whole file will be used, e.g. 'POSIX_FADV_SEQUENTIAL', where it takes hints"""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(file.fileno(), 0, 0, getattr(os, advice))
+
+
+def copy_file_data(job, source_file_stats, dest_file_stats):
+    """
+    Copy the contents of a file using the first copy strategy that works for it, skipping strategies already known not
+    to work between the two filesystems. Small files are read and written in one go instead, since setting up any
+    other way of copying them takes longer than the copy itself. Large files have their space allocated up front, and
+    are read sequentially and dropped from the page cache once copied, so that a backup doesn't push everything else out
+    of memory. Returns the name of the strategy used.
+    """
+    size = source_file_stats.getsize()
+    # Backends that can't hand out file descriptors only have files to read and write
+    if not job.filesystem.native_copies:
+        with job.filesystem.open(source_file_stats.path_name, 'rb') as source_file, \
+                job.filesystem.open(dest_file_stats.path_name, 'wb') as dest_file:
+            copy_with_userspace(job, source_file, dest_file, size)
+        return 'userspace'
+
+    # Special files (FIFOs etc.) are left to shutil, which knows how to refuse them
+    if not source_file_stats.isfile():
+        shutil.copyfile(source_file_stats.path_name, dest_file_stats.path_name)
+        return 'userspace'
+
+    with open(source_file_stats.path_name, 'rb') as source_file, open(dest_file_stats.path_name, 'wb') as dest_file:
+        if size < COPY_SMALL_SIZE and job.copy_strategy in ('auto', 'userspace'):
+            data = source_file.read()
+            dest_file.write(data)
+            throttle_io(job, len(data))
+            return 'userspace'
+
+        large = size >= COPY_LARGE_SIZE
+        if large:
+            advise(source_file, 'POSIX_FADV_SEQUENTIAL')
+        devices = (source_file_stats.stats.st_dev, os.fstat(dest_file.fileno()).st_dev)
+        for name, strategy in COPY_STRATEGIES:
+            if job.copy_strategy not in ('auto', name) and name != 'userspace':
+                continue
+            if (name, devices) in unsupported_copy_strategies:
+                continue
+            try:
+                # A clone shares the blocks of the source, so it needs no space of its own
+                if (large and name != 'reflink' and hasattr(load_libc(), 'fallocate') and
+                        ('fallocate', devices) not in unsupported_copy_strategies):
+                    try:
+                        preallocate(dest_file, size)
+                    except OSError as e:
+                        if e.errno not in COPY_UNSUPPORTED_ERRORS:
+                            raise
+                        logger.debug("Cannot allocate space up front here ({})".format(e))
+                        unsupported_copy_strategies.add(('fallocate', devices))
+                strategy(job, source_file, dest_file, size)
+                # The source's pages are no use once copied. The destination's are left alone, as dropping them
+                # would mean waiting for them to be written out first
+                if large:
+                    advise(source_file, 'POSIX_FADV_DONTNEED')
+                return name
+            except OSError as e:
+                if e.errno not in COPY_UNSUPPORTED_ERRORS or name == 'userspace':
+                    raise
+                logger.debug("Copy strategy {} is not supported here ({}), trying the next one".format(name, e))
+                unsupported_copy_strategies.add((name, devices))
+                # Start over with an empty destination
+                source_file.seek(0)
+                dest_file.seek(0)
+                dest_file.truncate()
+
+
+def calibration_path(job):
+    """Return the file the copy settings found by --calibrate are kept in"""
+    if job.args.calibrationfile is not None:
+        return os.path.abspath(job.args.calibrationfile)
+    config_dir = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+    return os.path.join(config_dir, 'sibackup', CALIBRATION_NAME)
+
+
+def read_calibrations(path_name):
+    """
+    Read the copy settings saved by --calibrate, as a dict mapping 'source -> destination' to the settings for backups
+    between the two folders. Returns an empty dict if nothing was saved yet
+    """
+    try:
+        with open(path_name, 'r', encoding='utf8') as calibration_file:
+            return json.load(calibration_file)
+    except FileNotFoundError:
+        return {}
+
+
+def find_calibration_file(job, source_path):
+    """
+    Find a file in the source to time copies with: of the first CALIBRATE_MAX_SCANNED items, the file closest in size
+    to CALIBRATE_FILE_SIZE that is large enough for the large file settings to apply. Returns (path, size), or None if
+    there is no such file
+    """
+    found = None
+    num_scanned = 0
+    pending_folders = [source_path]
+    while pending_folders and num_scanned < CALIBRATE_MAX_SCANNED:
+        try:
+            entries = scan_folder(job, pending_folders.pop())
+        except OSError:
+            continue
+        for entry in entries.values():
+            num_scanned += 1
+            if entry.is_dir(follow_symlinks=False):
+                pending_folders.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                size = entry.stat().st_size
+                if size >= COPY_LARGE_SIZE and (found is None or
+                                                abs(size - CALIBRATE_FILE_SIZE) < abs(found[1] - CALIBRATE_FILE_SIZE)):
+                    found = (entry.path, size)
+    return found
+
+
+def calibrate_copies(job, source_path, dest_path):
+    """
+    Time copying a large file of the source to the destination with each copy strategy, and with each buffer size for
+    userspace copies, then save the fastest for later backups between the two folders. Each copy is read from storage
+    and flushed back to it, so the page cache doesn't hide the speed of either. Returns the status code
+    """
+
+    found = find_calibration_file(job, source_path)
+    if found is None:
+        logger.critical("No file of at least {} found in the source to calibrate with. Aborting".format(
+            format_data_size(COPY_LARGE_SIZE)))
+        return 1
+    test_path_name, test_size = found
+    logger.info("Calibrating copies with '{}' ({})".format(test_path_name, format_data_size(test_size)))
+
+    # Each copy strategy, and userspace copies with each buffer size
+    candidates = [(name, strategy, None) for name, strategy in COPY_STRATEGIES if name != 'userspace']
+    candidates += [('userspace', copy_with_userspace, buffer_size) for buffer_size in CALIBRATE_BUFFER_SIZES]
+    temp_path_name = os.path.join(dest_path, '{}{}.calibrate'.format(TEMP_PREFIX, os.getpid()))
+    timings = []
+    try:
+        for name, strategy, buffer_size in candidates:
+            if buffer_size is not None:
+                job.copy_buffer_size = buffer_size
+            best_time = None
+            for run in range(CALIBRATE_RUNS):
+                with open(test_path_name, 'rb') as source_file, open(temp_path_name, 'wb') as dest_file:
+                    advise(source_file, 'POSIX_FADV_DONTNEED')
+                    start_time = time.perf_counter()
+                    try:
+                        strategy(job, source_file, dest_file, test_size)
+                    except OSError as e:
+                        if e.errno not in COPY_UNSUPPORTED_ERRORS:
+                            raise
+                        logger.info("{}: not supported here ({})".format(name, e))
+                        break
+                    dest_file.flush()
+                    os.fsync(dest_file.fileno())
+                    copy_time = time.perf_counter() - start_time
+                best_time = copy_time if best_time is None else min(best_time, copy_time)
+            else:
+                logger.info("{}{}: {}/s".format(
+                    name, " with a {} buffer".format(format_data_size(buffer_size)) if buffer_size is not None else "",
+                    format_data_size(test_size / max(best_time, PROFILE_MIN_LATENCY))))
+                timings.append((best_time, name, buffer_size))
+    finally:
+        job.copy_buffer_size = COPY_LARGE_BUFFER_SIZE
+        try:
+            os.remove(temp_path_name)
+        except FileNotFoundError:
+            pass
+
+    # Userspace copies always work, so they were always timed
+    _, best_strategy, _ = min(timings)
+    _, _, best_buffer_size = min(timing for timing in timings if timing[1] == 'userspace')
+    settings = {'strategy': best_strategy, 'buffer_size': best_buffer_size}
+    path_name = calibration_path(job)
+    try:
+        calibrations = read_calibrations(path_name)
+    except ValueError:
+        logger.warning("Copy calibration file is damaged, starting it over: '{}'".format(path_name))
+        calibrations = {}
+    calibrations['{} -> {}'.format(source_path, dest_path)] = settings
+    try:
+        os.makedirs(os.path.dirname(path_name), exist_ok=True)
+        temp_path = path_name + '.tmp'
+        with open(temp_path, 'w', encoding='utf8') as calibration_file:
+            calibration_file.write(json.dumps(calibrations, indent=4, sort_keys=True) + '\n')
+        os.replace(temp_path, path_name)
+    except OSError as e:
+        logger.critical("Cannot save copy calibration ({}): '{}'. Aborting".format(e, path_name))
+        return 1
+    logger.info("Saved copy settings to '{}': {} copies, {} buffer for userspace copies".format(
+        path_name, best_strategy, format_data_size(best_buffer_size)))
+    return 0
+
+
+def delta_copy(job, source_path_name, dest_path_name):
+    """
+    Update an existing destination file in place, comparing it to the source block by block and only rewriting the
+    blocks that differ. If most of the first blocks have changed, the rest of the file is written without comparing.
+    Returns the number of bytes written, or None if the destination could not be opened and a full copy is needed.
+    """
+    source_buffer, dest_buffer = get_compare_buffers()
+    source_view = memoryview(source_buffer)
+
+    try:
+        dest_file = open(dest_path_name, 'r+b', buffering=0)
+    except FileNotFoundError:
+        return None
+    size_written = 0
+    blocks_checked = 0
+    blocks_changed = 0
+    comparing = True
+    with open(source_path_name, 'rb') as source_file, dest_file:
+        offset = 0
+        while True:
+            source_read = source_file.readinto(source_buffer)
+            if source_read == 0:
+                break
+            throttle_io(job, source_read)
+            if comparing:
+                dest_read = dest_file.readinto(dest_buffer)
+                throttle_io(job, dest_read)
+                blocks_checked += 1
+                if source_read == dest_read and source_buffer[:source_read] == dest_buffer[:dest_read]:
+                    offset += source_read
+                    continue
+                blocks_changed += 1
+                # Stop comparing if so much has changed that reading the destination is a waste
+                if blocks_checked >= DELTA_PROBE_BLOCKS and blocks_changed / blocks_checked > DELTA_MAX_CHANGED:
+                    logger.debug("Too many changed blocks, writing the rest of the file: '{}'".format(dest_path_name))
+                    comparing = False
+                dest_file.seek(offset)
+            dest_file.write(source_view[:source_read])
+            throttle_io(job, source_read)
+            size_written += source_read
+            offset += source_read
+        dest_file.truncate(offset)
+    shutil.copystat(source_path_name, dest_path_name)
+    return size_written
+
+
+def worth_compressing(job, source_file_stats):
+    """
+    Return whether a file is worth compressing. Files with the extension of a compressed format are not, and otherwise
+    a sample from the start of the file is compressed quickly to estimate how well the whole file would compress
+    """
+    if not source_file_stats.isfile() or source_file_stats.getsize() == 0:
+        return False
+    if os.path.splitext(source_file_stats.path_name)[1].lower() in COMPRESSED_EXTENSIONS:
+        worth = False
+    else:
+        with open(source_file_stats.path_name, 'rb') as source_file:
+            sample = source_file.read(COMPRESS_SAMPLE_SIZE)
+        import zlib
+        worth = len(zlib.compress(sample, 1)) < len(sample) * COMPRESS_SAMPLE_MAX_RATIO
+    if not worth:
+        with job.info_lock:
+            job.info_data['compression']['num_incompressible'] += 1
+    return worth
+
+
+def import_zstandard():
+    """Return the zstandard module, or None if it is not installed. It is optional, and only needed for zstd"""
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def new_compressor(job, codec):
+    """Return a compressor object for a codec, at the level chosen by the user or the codec's default"""
+    level = job.args.compresslevel if job.args.compresslevel is not None else COMPRESSION_CODECS[codec][1]
+    if codec == 'zlib':
+        import zlib
+        return zlib.compressobj(level)
+    elif codec == 'lzma':
+        import lzma
+        return lzma.LZMACompressor(preset=level)
+    else:
+        return import_zstandard().ZstdCompressor(level=level).compressobj()
+
+
+def new_decompressor(codec_id):
+    """Return a decompressor object for the codec with the given ID"""
+    if codec_id == COMPRESSION_CODECS['zlib'][0]:
+        import zlib
+        return zlib.decompressobj()
+    elif codec_id == COMPRESSION_CODECS['lzma'][0]:
+        import lzma
+        return lzma.LZMADecompressor()
+    elif codec_id == COMPRESSION_CODECS['zstd'][0] and import_zstandard() is not None:
+        return import_zstandard().ZstdDecompressor().decompressobj()
+    raise OSError(errno.EINVAL, "Unsupported compression codec {}".format(codec_id))
+
+
+def read_compressed_header(path_name):
+    """Return the (magic, codec ID, original size) header of a compressed file"""
+    with open(path_name, 'rb') as file:
+        header = file.read(COMPRESSED_HEADER.size)
+    if len(header) < COMPRESSED_HEADER.size or not header.startswith(COMPRESSED_MAGIC):
+        raise OSError(errno.EINVAL, "Not a compressed file", path_name)
+    return COMPRESSED_HEADER.unpack(header)
+
+
+def compress_file(job, source_file_stats, dest_file_stats, codec):
+    """
+    Write a compressed copy of a file, behind a header holding the codec and the original size. Returns the size of
+    the compressed file. May be run from a copy worker thread
+    """
+    buffer, _ = get_compare_buffers()
+    view = memoryview(buffer)
+    compressor = new_compressor(job, codec)
+    # Compression runs on the copy workers, so measure the CPU time of this thread alone
+    start_cpu_time = time.thread_time()
+    original_size = 0
+    with open(source_file_stats.path_name, 'rb') as source_file, open(dest_file_stats.path_name, 'wb') as dest_file:
+        dest_file.seek(COMPRESSED_HEADER.size)
+        while True:
+            read = source_file.readinto(buffer)
+            if not read:
+                break
+            original_size += read
+            dest_file.write(compressor.compress(view[:read]))
+            throttle_io(job, read)
+        dest_file.write(compressor.flush())
+        compressed_size = dest_file.tell()
+        # Write the header last, with the size that was actually read
+        dest_file.seek(0)
+        dest_file.write(COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, COMPRESSION_CODECS[codec][0], original_size))
+    with job.info_lock:
+        job.info_data['compression']['num_compressed'] += 1
+        job.info_data['compression']['size_original'] += original_size
+        job.info_data['compression']['size_compressed'] += compressed_size
+        job.info_data['compression']['cpu_time'] += time.thread_time() - start_cpu_time
+    return compressed_size
+
+
+def read_decompressed(path_name):
+    """Yield the original contents of a compressed file, one block at a time"""
+    _, codec_id, _ = read_compressed_header(path_name)
+    decompressor = new_decompressor(codec_id)
+    with open(path_name, 'rb') as file:
+        file.seek(COMPRESSED_HEADER.size)
+        while True:
+            data = file.read(COMPARE_CHUNK_SIZE)
+            if not data:
+                return
+            yield decompressor.decompress(data)
+
+
+def compare_compressed(source_path_name, dest_path_name):
+    """Return whether a file matches a compressed file once decompressed, and the number of bytes read"""
+    data_read = 0
+    with open(source_path_name, 'rb') as source_file:
+        for data in read_decompressed(dest_path_name):
+            source_data = source_file.read(len(data))
+            data_read += len(source_data)
+            if source_data != data:
+                return False, data_read
+        return not source_file.read(1), data_read
+
+
+def get_compare_buffers():
+    """Return the pair of read buffers used by the current thread for comparing and hashing files"""
+    if not hasattr(compare_buffers, 'source'):
+        compare_buffers.source = bytearray(COMPARE_CHUNK_SIZE)
+        compare_buffers.dest = bytearray(COMPARE_CHUNK_SIZE)
+    return compare_buffers.source, compare_buffers.dest
+
+
+def hash_file(job, path_name):
+    """Return the digest of a file's contents, and the number of bytes read"""
+    import hashlib
+    buffer, _ = get_compare_buffers()
+    view = memoryview(buffer)
+
+    hasher = hashlib.blake2b()
+    data_read = 0
+    with job.filesystem.open(path_name, 'rb') as file:
+        while True:
+            read = file.readinto(buffer)
+            data_read += read
+            throttle_io(job, read)
+            hasher.update(view[:read])
+            if read < COMPARE_CHUNK_SIZE:
+                return hasher.digest(), data_read
+
+
+def compare_file_contents(job, source_path_name, dest_path_name, digest=False):
+    """
+    Compare the contents of two files, reading both together in large blocks into reusable buffers and stopping at the
+    first block that differs instead of reading both files in full. Returns whether the files match, their digest if
+    they do and digest is set (otherwise None), and the number of bytes read.
+    """
+    source_buffer, dest_buffer = get_compare_buffers()
+    source_view = memoryview(source_buffer)
+
+    # Both files are identical up to the current block, so only one of them needs to be hashed. Hashing is only worth
+    # its cost when the digest is kept in the hash cache
+    hasher = None
+    if digest:
+        import hashlib
+        hasher = hashlib.blake2b()
+    data_read = 0
+    with job.filesystem.open(source_path_name, 'rb') as source_file, \
+            job.filesystem.open(dest_path_name, 'rb') as dest_file:
+        while True:
+            source_read = source_file.readinto(source_buffer)
+            dest_read = dest_file.readinto(dest_buffer)
+            data_read += source_read + dest_read
+            throttle_io(job, source_read + dest_read, ops=2)
+            if source_read != dest_read:
+                return False, None, data_read
+            if source_read < COMPARE_CHUNK_SIZE:
+                # Last block. Only compare the part of the buffers that was filled
+                if source_buffer[:source_read] != dest_buffer[:dest_read]:
+                    return False, None, data_read
+                if hasher is None:
+                    return True, None, data_read
+                hasher.update(source_view[:source_read])
+                return True, hasher.digest(), data_read
+            if source_buffer != dest_buffer:
+                return False, None, data_read
+            if hasher is not None:
+                hasher.update(source_view)
+
+
+def compare_file_digests(job, source_file_stats, dest_file_stats):
+    """
+    Return (whether the files match, amount of data read), using digests from the hash cache in place of reading a file
+    where possible
+    """
+    source_digest = None
+    dest_digest = None
+    data_read = 0
+    if job.hash_cache is not None:
+        # Stats taken from the manifest don't identify the file on disk, so get the real destination stats
+        if not dest_file_stats.stats.st_ino:
+            dest_file_stats = StatHelper(dest_file_stats.path_name, filesystem=job.filesystem)
+            if not dest_file_stats.exists():
+                raise FileNotFoundError("Destination file is missing")
+        source_digest = job.hash_cache.lookup(source_file_stats)
+        dest_digest = job.hash_cache.lookup(dest_file_stats)
+
+    if source_digest is not None and dest_digest is not None:
+        match = source_digest == dest_digest
+    elif source_digest is not None:
+        dest_digest, data_read = hash_file(job, dest_file_stats.path_name)
+        match = source_digest == dest_digest
+    elif dest_digest is not None:
+        source_digest, data_read = hash_file(job, source_file_stats.path_name)
+        match = source_digest == dest_digest
+    else:
+        match, source_digest, data_read = compare_file_contents(job, source_file_stats.path_name,
+                                                                dest_file_stats.path_name, job.hash_cache is not None)
+        dest_digest = source_digest
+
+    # Remember the digests of matching files for the next run
+    if match and job.hash_cache is not None:
+        job.hash_cache.store(source_file_stats, source_digest)
+        job.hash_cache.store(dest_file_stats, dest_digest)
+    return match, data_read
+
+
+def compare_files(job, source_file_stats, dest_file_stats):
+    """
+    Return whether the source and destination files have the same contents. Digests from the hash cache are used in
+    place of reading a file where possible. If neither file is cached, both are read together and compared block by
+    block, stopping at the first difference.
+    """
+    start_time = time.perf_counter()
+    data_read = 0
+    try:
+        if dest_file_stats.packed:
+            # Packed files are small, so just compare their whole contents
+            with open(source_file_stats.path_name, 'rb') as source_file:
+                source_data = source_file.read()
+            dest_data = job.pack_store.read(dest_file_stats.path_name)
+            data_read = len(source_data) + len(dest_data)
+            match = source_data == dest_data
+        elif dest_file_stats.compressed:
+            match, data_read = compare_compressed(source_file_stats.path_name, dest_file_stats.path_name)
+        else:
+            match, data_read = compare_file_digests(job, source_file_stats, dest_file_stats)
+    except OSError as e:
+        # If either file can't be read, assume they differ and let copying deal with the error
+        logger.debug("Cannot compare file contents ({}): '{}'".format(e, source_file_stats.path_name))
+        match = False
+
+    with job.info_lock:
+        job.info_data['time_spent']['hashing'] += time.perf_counter() - start_time
+        job.info_data['misc']['hashes_made'] += 1
+        job.info_data['misc']['data_hashed'] += data_read
+    return match
+
+
+def read_digest(job, path_name, from_storage=False):
+    """
+    Return the digest of a file's contents, and the number of bytes read. The file is read sequentially in large blocks,
+    and the pages read are dropped from the page cache as it goes, so verifying a large tree doesn't push everything
+    else out of memory. If from_storage is set, the file is flushed and its cached pages are dropped before reading, so
+    that its contents come back from storage rather than from memory.
+    """
+    import hashlib
+    if not hasattr(verify_buffers, 'buffer'):
+        verify_buffers.buffer = bytearray(VERIFY_CHUNK_SIZE)
+    buffer = verify_buffers.buffer
+    view = memoryview(buffer)
+    # Page cache hints only apply to real files
+    advise = job.filesystem.local and hasattr(os, 'posix_fadvise')
+
+    hasher = hashlib.blake2b()
+    data_read = 0
+    with job.filesystem.open(path_name, 'rb') as file:
+        if advise:
+            fd = file.fileno()
+            if from_storage:
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                return hasher.digest(), data_read
+            if advise:
+                os.posix_fadvise(fd, data_read, read, os.POSIX_FADV_DONTNEED)
+            data_read += read
+            throttle_io(job, read)
+            hasher.update(view[:read])
+
+
+def source_changed(job, source_path_name, size, mtime_ns):
+    """Return whether a source file no longer has the size and modified time it had when it was backed up"""
+    try:
+        stats = job.filesystem.stat(source_path_name)
+    except OSError:
+        # A source that is gone or can't be read any more can't be compared against either
+        return True
+    return stats.st_size != size or stats.st_mtime_ns != mtime_ns
+
+
+def verify_file(job, source_path_name, size, mtime_ns, dest_path_name, kind):
+    """
+    Check that a destination file still has the contents of its source, reading both again. Returns whether they match.
+    A destination file that doesn't match is removed, so that the next run copies it again. Files whose source has
+    changed (or gone) since they were backed up are left alone, as the source no longer tells whether the backup is
+    good. May be run from a verifying thread
+    """
+    source_digest = None
+    match = False
+    data_read = 0
+    read_error = None
+    changed = source_changed(job, source_path_name, size, mtime_ns)
+    if not changed:
+        try:
+            if kind == 'packed':
+                with open(source_path_name, 'rb') as source_file:
+                    source_data = source_file.read()
+                dest_data = job.pack_store.read(dest_path_name)
+                match, data_read = source_data == dest_data, len(source_data) + len(dest_data)
+            elif kind == 'compressed':
+                match, data_read = compare_compressed(source_path_name, dest_path_name)
+            else:
+                source_digest, source_read = read_digest(job, source_path_name)
+                dest_digest, dest_read = read_digest(job, dest_path_name, from_storage=True)
+                match, data_read = source_digest == dest_digest, source_read + dest_read
+        except OSError as e:
+            read_error = e
+        # The source may have changed while it was being read
+        changed = not match and source_changed(job, source_path_name, size, mtime_ns)
+
+    if changed:
+        logger.debug("Source file changed since it was backed up, not verified: '{}'".format(source_path_name))
+        with job.info_lock:
+            job.info_data['verify']['num_changed'] += 1
+            job.info_data['verify']['size_verified'] += data_read
+        return True
+    if read_error is not None:
+        logger.error("Cannot read file back to verify it ({}): '{}'".format(read_error, dest_path_name))
+        with job.info_lock:
+            job.info_data['verify']['num_failed'] += 1
+        return False
+
+    with job.info_lock:
+        job.info_data['verify']['num_verified'] += 1
+        job.info_data['verify']['size_verified'] += data_read
+        if not match:
+            job.info_data['verify']['num_failed'] += 1
+    if match:
+        return True
+
+    logger.error("File doesn't match its source, removing it so it is copied again: '{}'".format(dest_path_name))
+    try:
+        if kind == 'packed':
+            job.pack_store.forget(dest_path_name)
+        else:
+            job.filesystem.remove(dest_path_name)
+            # The snapshot links the file to an object named by the source's digest, which has to go too, or the next
+            # snapshot would link the same bad object again
+            if job.snapshot_store is not None:
+                os.remove(job.snapshot_store.object_path(source_digest))
+    except OSError as e:
+        logger.warning("Cannot remove file that doesn't match ({}): '{}'".format(e, dest_path_name))
+    return False
+
+
+def verify_backup(job):
+    """
+    Check the files collected by the verifier, once all copies have finished, on as many threads as there are copy
+    workers. Returns the number of files that don't match their source
+    """
+    files = job.verifier.take()
+    if not files:
+        return 0
+    logger.info("Verifying {} files...".format(len(files)))
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=job.args.workers, thread_name_prefix='verify') as executor:
+        num_mismatched = sum(not match for match in executor.map(functools.partial(verify_file, job), *zip(*files)))
+    with job.info_lock:
+        job.info_data['time_spent']['verifying'] += time.perf_counter() - start_time
+    return num_mismatched
+
+
+def count_source(job, source_path):
+    """
+    Quickly count the files and data in the source tree, so that progress can be reported against the totals.
+    Respects the depth limit and the filter rules, and skips folders that can't be read.
+    """
+    total_files = 0
+    total_size = 0
+    pending_folders = [('', 0)]
+    while pending_folders:
+        current_folder, depth = pending_folders.pop()
+        try:
+            entries = job.filesystem.scandir(os.path.join(source_path, current_folder))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+                relative_path = os.path.join(current_folder, entry.name)
+                if job.filter_rules is not None and job.filter_rules.excluded(relative_path, is_dir):
+                    continue
+                if is_dir:
+                    if job.args.depth is None or depth + 1 <= job.args.depth:
+                        pending_folders.append((relative_path, depth + 1))
+                else:
+                    stats = entry.stat()
+                    if job.filter_rules is not None and job.filter_rules.excluded_by_stats(stats):
+                        continue
+                    total_files += 1
+                    total_size += stats.st_size
+            except OSError:
+                continue
+    return total_files, total_size
+
+
+def write_report(report_path, report_format, results, simulate):
+    """
+    Write the counters of the run to a file, either as JSON or in the Prometheus text format (for the node exporter's
+    textfile collector). Each result holds the source, destination, status, total time and counters of one backup.
+    With several backups (from --batch), the JSON report is a list with one object per backup. The file is replaced
+    atomically so it is never read half-written.
+    """
+    if report_format == 'json':
+        reports = [{
+            'source': result['source'],
+            'destination': result['destination'],
+            'simulate': simulate,
+            'status': result['status'],
+            'finished': time.time(),
+            'total_time': result['total_time'],
+            'info_data': result['info_data'],
+        } for result in results]
+        report_text = json.dumps(reports[0] if len(reports) == 1 else reports, indent=4, sort_keys=True) + '\n'
+    else:  # report_format == 'prometheus'
+        lines = []
+        for result in results:
+            # Label values need backslashes and quotes escaped
+            labels = '{{source="{}",destination="{}"}}'.format(*(
+                path.replace('\\', '\\\\').replace('"', '\\"')
+                for path in (result['source'], result['destination'])))
+            lines += [
+                'sibackup_status{} {}'.format(labels, result['status']),
+                'sibackup_last_run_timestamp_seconds{} {}'.format(labels, time.time()),
+                'sibackup_duration_seconds{} {}'.format(labels, result['total_time']),
+            ]
+            for section, counters in sorted(result['info_data'].items()):
+                for name, value in sorted(counters.items()):
+                    if section == 'time_spent':
+                        name = name + '_seconds'
+                    lines.append('sibackup_{}_{}{} {}'.format(section, name, labels, value))
+        report_text = '\n'.join(lines) + '\n'
+
+    temp_path = report_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf8') as report_file:
+        report_file.write(report_text)
+    os.replace(temp_path, report_path)
+
+
+def write_code_profile(code_profile, profile_path, log_functions):
+    """
+    Save the cProfile results of the run for pstats or other viewers, and log the functions that took longest if
+    log_functions is set
+    """
+    try:
+        code_profile.dump_stats(profile_path)
+        logger.info("Saved profile to '{}'".format(profile_path))
+    except OSError as e:
+        logger.error("Cannot write profile '{}': {}".format(profile_path, e))
+    if log_functions:
+        import pstats
+        stats_text = io.StringIO()
+        pstats.Stats(code_profile, stream=stats_text).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        logger.info("Functions that took longest, by cumulative time:\n{}".format(stats_text.getvalue().strip()))
+
+
+def remove_read_only(action, name, exc):
+    """Error handler for shutil.rmtree that gives read-only items write access and tries again"""
+    os.chmod(name, stat.S_IWRITE)
+    action(name)
+
+
+def remove_item(job, item_path, is_dir):
+    """Delete a file, or a folder and everything in it"""
+    if is_dir:
+        job.filesystem.rmtree(item_path)
+    else:
+        job.filesystem.remove(item_path)
+
+
+def resolve_conflicts(job, conflict_batch):
+    """
+    Archive or delete a batch of conflicts, given as (stats, archive path) pairs where the archive path is None for
+    conflicts to delete. Archiving renames the conflict into the archive when it is on the same device. When using the
+    trash, deleting only renames the conflict into the trash, to be purged once copying is done.
+    May be run from a worker thread.
+    """
+    start_time = time.perf_counter()
+    resolved = 0
+    for conflict_item_stats, archive_item_path in conflict_batch:
+        conflict_item_path = conflict_item_stats.path_name
+        try:
+            # Make sure that the conflict has write permissions
+            if not conflict_item_stats.haswrite():
+                logger.debug("File does not have write access, setting it: '{}'".format(conflict_item_path))
+                job.filesystem.chmod(conflict_item_path, stat.S_IWRITE)
+
+            if archive_item_path is not None:
+                if job.filesystem.lexists(archive_item_path):
+                    logger.warning("Cannot archive conflict, already in the archive: '{}'".format(conflict_item_path))
+                    job.manifest.record(conflict_item_path, conflict_item_stats.stats)
+                    continue
+                try:
+                    job.filesystem.rename(conflict_item_path, archive_item_path)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    # The archive is on another device, so the conflict has to be copied there
+                    job.filesystem.move(conflict_item_path, archive_item_path)
+            elif job.trash_path is not None:
+                try:
+                    os.rename(conflict_item_path, os.path.join(job.trash_path, '{}.{}'.format(os.getpid(),
+                                                                                          next(trash_counter))))
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    # The trash is on another device, so delete the conflict right away
+                    remove_item(job, conflict_item_path, conflict_item_stats.isdir())
+            else:
+                remove_item(job, conflict_item_path, conflict_item_stats.isdir())
+            resolved += 1
+        except PermissionError:
+            logger.warning("Cannot {} conflict, access denied: '{}'".format(
+                "archive" if archive_item_path is not None else "delete", conflict_item_path))
+            job.manifest.record(conflict_item_path, conflict_item_stats.stats)
+            if job.journal is not None:
+                job.journal.item_failed(conflict_item_path)
+        except OSError as e:
+            logger.warning("Cannot {} conflict ({}): '{}'".format(
+                "archive" if archive_item_path is not None else "delete", e, conflict_item_path))
+            job.manifest.record(conflict_item_path, conflict_item_stats.stats)
+            if job.journal is not None:
+                job.journal.item_failed(conflict_item_path)
+
+    with job.info_lock:
+        job.info_data['time_spent']['resolving'] += time.perf_counter() - start_time
+        job.info_data['misc']['conflicts_resolved'] += resolved
+
+
+def purge_trash(job, trash_folder_path):
+    """Delete everything in the trash folder and the folder itself, deleting several items at once"""
+    logger.debug("Purging trash: '{}'".format(trash_folder_path))
+    start_time = time.perf_counter()
+    with os.scandir(trash_folder_path) as entries:
+        trash_items = [(entry.path, entry.is_dir(follow_symlinks=False)) for entry in entries]
+    with ThreadPoolExecutor(max_workers=job.args.workers, thread_name_prefix='purge') as executor:
+        for future in [executor.submit(remove_item, job, item_path, is_dir) for item_path, is_dir in trash_items]:
+            try:
+                future.result()
+            except OSError as e:
+                logger.warning("Cannot purge item from trash: {}".format(e))
+    try:
+        os.rmdir(trash_folder_path)
+    except OSError as e:
+        logger.warning("Cannot remove trash folder: {}".format(e))
+    with job.info_lock:
+        job.info_data['time_spent']['resolving'] += time.perf_counter() - start_time
+
+
+def restore_backup(job, backup_path, target_path):
+    """
+    Restores a backup made with packing or compression to the target folder. Normal files are copied as they are and
+    compressed files are decompressed, then every packed file is written back out as a normal file. Returns the status
+    code of the restore.
+    """
+    logger.info("{}Restoring '{}' to '{}'".format(sim_text(job), backup_path, target_path))
+    # Conflicts archived from the backup, and temp files left by copies that never finished, were never in the source
+    archive_path = os.path.normpath(os.path.join(backup_path, job.args.archivepath))
+    pending_folders = ['']
+    while pending_folders:
+        current_folder = pending_folders.pop()
+        target_folder_path = os.path.join(target_path, current_folder)
+        if not job.args.simulate:
+            os.makedirs(target_folder_path, exist_ok=True)
+        for entry in scan_folder(job, os.path.join(backup_path, current_folder)).values():
+            if not current_folder and entry.name.startswith((MANIFEST_NAME, TRASH_NAME, PACK_NAME, JOURNAL_NAME)):
+                continue
+            if entry.name.startswith(TEMP_PREFIX) or os.path.normpath(entry.path) == archive_path:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                pending_folders.append(os.path.join(current_folder, entry.name))
+                continue
+            logger.debug("{}Restoring file: '{}'".format(sim_text(job), entry.path))
+            if entry.name.endswith(COMPRESSED_SUFFIX):
+                target_path_name = os.path.join(target_folder_path, entry.name[:-len(COMPRESSED_SUFFIX)])
+                if not job.args.simulate:
+                    with open(target_path_name, 'wb') as target_file:
+                        for data in read_decompressed(entry.path):
+                            target_file.write(data)
+                    shutil.copystat(entry.path, target_path_name)
+                job.info_data['files']['size_copied'] += read_compressed_header(entry.path)[2]
+                job.info_data['compression']['num_compressed'] += 1
+            else:
+                if not job.args.simulate:
+                    shutil.copy2(entry.path, os.path.join(target_folder_path, entry.name))
+                job.info_data['files']['size_copied'] += entry.stat(follow_symlinks=False).st_size
+            job.info_data['files']['num_copied'] += 1
+
+    # Write out the packed files, in the order they are stored so the pack files are read from start to end
+    if os.path.exists(os.path.join(backup_path, PACK_NAME, 'index.db')):
+        store = PackStore(backup_path, writable=False)
+        rows = store.db.execute("SELECT folder, name, size FROM packed ORDER BY pack, offset").fetchall()
+        for folder, name, size in rows:
+            logger.debug("{}Unpacking file: '{}'".format(sim_text(job), os.path.join(folder, name)))
+            if not job.args.simulate:
+                os.makedirs(os.path.join(target_path, folder), exist_ok=True)
+                store.extract(os.path.join(backup_path, folder, name), os.path.join(target_path, folder, name))
+            job.info_data['files']['num_copied'] += 1
+            job.info_data['files']['size_copied'] += size
+            job.info_data['files']['num_packed'] += 1
+            job.info_data['files']['size_packed'] += size
+        store.close(save=False)
 
+    logger.info("{}Restored {} in {} files ({} unpacked, {} decompressed) in {}".format(
+        sim_text(job),
+        format_data_size(job.info_data['files']['size_copied']),
+        job.info_data['files']['num_copied'],
+        job.info_data['files']['num_packed'],
+        job.info_data['compression']['num_compressed'],
+        Timer.format_time(job.timer.elapsed()),
+    ))
+    return 0
 
-class Timer:
-    @classmethod
-    def format_time(cls, elapsed_time):
-        temp = int(elapsed_time * 1000)
-        millis = temp % 1000
-        temp //= 1000
-        seconds = temp % 60
-        temp //= 60
-        minutes = temp % 60
-        temp //= 60
-        hours = temp
-        return "{}:{:0>2d}:{:0>2d}.{:0>4d}".format(hours, minutes, seconds, millis)
 
-    def __init__(self):
-        self.start_time = 0
-        self.last_lap = 0
+def copy_tree(jobs, source_path, pending_folders=None):
+    """
+    Processes the whole source tree, one folder at a time, for the destination of each job. The tree is walked depth
+    first using an explicit stack of folders still to visit instead of recursion, so very deep trees can't hit the
+    recursion limit, and only the names of the pending folders are kept in memory rather than the full listings of
+    every folder above the current one. Each pending folder is kept as (relative folder, depth, jobs), with the jobs
+    that still back it up, since a destination that a folder couldn't be created in leaves out everything below it.
+    The walk can be started from other folders than the root by giving them as pending folders.
+    """
+    if pending_folders is None:
+        pending_folders = [('', 0, jobs)]
+    folder_scanner = jobs[0].folder_scanner
+    while pending_folders:
+        # Scan the next few folders in the background while this one is processed
+        if folder_scanner is not None:
+            folder_scanner.prefetch(source_path, pending_folders)
+        current_folder, depth, folder_jobs = pending_folders.pop()
+        # Folders completed before the run was interrupted only need listing to find their subfolders
+        unfinished_folder_jobs = unfinished_jobs(folder_jobs, current_folder)
+        if len(unfinished_folder_jobs) < len(folder_jobs):
+            queue_subfolders([job for job in folder_jobs if job not in unfinished_folder_jobs], source_path,
+                             current_folder, depth, pending_folders)
+        if not unfinished_folder_jobs:
+            continue
+        if current_folder:
+            logger.debug("Travelling into subfolder: '{}'".format(os.path.join(source_path, current_folder)))
+        start_time = time.perf_counter()
+        status = copy_folder(unfinished_folder_jobs, source_path, current_folder, depth, pending_folders)
+        for job in unfinished_folder_jobs:
+            if job.profiler is not None:
+                job.profiler.record_folder(os.path.join(source_path, current_folder), time.perf_counter() - start_time)
+        # If there's an error, abort
+        if status != 0:
+            return status
+        for job in unfinished_folder_jobs:
+            if job.journal is not None:
+                job.journal.folder_done(current_folder)
+    return 0
 
-    def start(self):
-        self.start_time = time.perf_counter()
-        self.last_lap = self.start_time
 
-    def lap(self):
-        last_lap_time = self.last_lap
-        self.last_lap = time.perf_counter()
-        return self.last_lap - last_lap_time
+def unfinished_jobs(jobs, current_folder):
+    """Return the jobs that still have to back up a folder, leaving out those that completed it in an interrupted run"""
+    return [job for job in jobs if job.journal is None or not job.journal.is_complete(current_folder)]
 
-    def elapsed(self):
-        return time.perf_counter() - self.start_time
 
+def queue_subfolders(jobs, source_path, current_folder, depth, pending_folders):
+    """Add the subfolders of a source folder to pending_folders for the jobs without processing the folder itself"""
+    job = jobs[0]
+    if job.args.depth is not None and depth + 1 > job.args.depth:
+        return
+    try:
+        entries = scan_folder(job, os.path.join(source_path, current_folder))
+    except OSError as e:
+        logger.warning("Cannot read contents of source folder ({}): '{}'".format(e, current_folder))
+        return
+    subfolders = [name for name, entry in entries.items() if entry.is_dir() and
+                  (job.filter_rules is None or not job.filter_rules.excluded(os.path.join(current_folder, name), True))]
+    for name in reversed(subfolders):
+        pending_folders.append((os.path.join(current_folder, name), depth + 1, jobs))
 
-LOG_FORMAT = "%(asctime)s:%(name)s:%(levelname)s: %(message)s"
-LOG_LEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR,
-              'CRITICAL': logging.CRITICAL}
 
-# Average file size copied
-# What determined whether each file should be copied
-info_data = {
-    'files': {
-        'num_processed': 0,
-        'num_copied': 0,
-        'size_copied': 0,
-        'num_skipped': 0,
-        'size_skipped': 0,
-        'num_deleted': 0,
-        'not_copied': 0,
-    },
-    'folders': {
-        'num_created': 0,
-        'num_deleted': 0,
-    },
-    'time_spent': {
-        'copying': 0,
-        'resolving': 0,
-        'scanning': 0,
-        'stats': 0,
-        'hashing': 0,
-    },
-    'misc': {
-        'conflicts_resolved': 0,
-        'hashes_made': 0,
-        'data_hashed': 0,
-    },
-    'errors': {
+def coalesce_changes(changes):
+    """
+    Return the changed folders in the order to sync them, dropping folders that are covered by syncing the whole tree
+    of a folder above them. Parent folders come before their subfolders.
+    """
+    tree_folders = [current_folder for current_folder, whole_tree in changes if whole_tree]
+    coalesced = []
+    for current_folder, whole_tree in sorted(changes):
+        if not whole_tree and current_folder in tree_folders:
+            continue
+        if any(tree_folder != current_folder and (not tree_folder or current_folder.startswith(tree_folder + os.sep))
+               for tree_folder in tree_folders):
+            continue
+        coalesced.append((current_folder, whole_tree))
+    return coalesced
 
-    },
-}
 
+def sync_changes(job, source_path, changes):
+    """Sync the changed folders, each on its own or with everything below it. Returns the status code of the sync"""
+    for current_folder, whole_tree in coalesce_changes(changes):
+        # A folder that has gone again is removed when its parent folder is synced
+        if not os.path.isdir(os.path.join(source_path, current_folder)):
+            continue
+        depth = len(current_folder.split(os.sep)) if current_folder else 0
+        if job.args.depth is not None and depth > job.args.depth:
+            continue
+        # Changes inside excluded folders are ignored
+        if job.filter_rules is not None and job.filter_rules.folder_excluded(current_folder):
+            continue
+        logger.debug("Syncing changed folder{}: '{}'".format(" tree" if whole_tree else "",
+                                                             os.path.join(source_path, current_folder)))
+        if whole_tree:
+            status = copy_tree([job], source_path, [(current_folder, depth, [job])])
+        else:
+            status = copy_folder([job], source_path, current_folder, depth, [])
+        if status != 0:
+            return status
+    if job.copy_pool is not None:
+        job.copy_pool.wait()
+    # Empty the trash after each sync rather than letting it pile up while watching
+    if job.trash_path is not None and os.path.isdir(job.trash_path):
+        purge_trash(job, job.trash_path)
+        os.makedirs(job.trash_path, exist_ok=True)
+    return 0
 
-def format_data_size(data_size):
-    data_size_values = [1, 1024, 1048576, 1073741824, 1099511627776]
-    data_size_names = ['B', 'KB', 'MB', 'GB', 'TB']
 
-    # Special case: if the size is empty, return 0B
-    if data_size == 0:
-        return "0B"
+def watch_tree(job, source_path):
+    """
+    Keeps the destination in sync with the source after the first full sync, until interrupted. Changed folders are
+    collected with inotify (or by polling if it can't be used), and synced once no more changes have come in for the
+    watch delay, so a burst of changes is handled in one small sync. Returns the status code of the last sync.
+    """
 
-    # Check each tier in reverse: If the data size is greater than one unit of that value, it will be used as the base
-    for i in range(len(data_size_values) - 1, 0, -1):
-        data_size_value = data_size_values[i]
-        if data_size >= data_size_value:
-            return "{:.3f}{}".format(
-                data_size / data_size_value,
-                data_size_names[i],
-            )
+    # Finish the first sync, and keep its manifest. The destination changes while watching, so the manifest is removed
+    # again once anything is synced, and later syncs scan the destination instead
+    if job.copy_pool is not None:
+        job.copy_pool.wait()
+    job.manifest.finish(success=True)
+    manifest_path = job.manifest.record_path
+    job.manifest = Manifest(job.compare_path)
 
+    try:
+        watcher = InotifyWatcher(job, source_path)
+        logger.info("Watching {} folders for changes".format(len(watcher.watches)))
+    except (OSError, AttributeError, TypeError) as e:
+        logger.warning("Cannot watch for changes with inotify, checking every {} seconds instead ({})".format(
+            job.args.watchinterval, e))
+        watcher = PollingWatcher(job, source_path, job.args.watchinterval)
 
-def sim_text():
-    """Return a string to signify that nothing has actually happened if set to simulate, otherwise return nothing"""
-    return "<Simulate>: " if args.simulate else ""
+    status = 0
+    pending_changes = set()
+    first_change_time = None
+    try:
+        while True:
+            changes = watcher.wait(job.args.watchdelay if pending_changes else None)
+            if changes:
+                if not pending_changes:
+                    first_change_time = time.monotonic()
+                pending_changes |= changes
+                # Wait for the changes to settle, but don't let files that keep changing hold off the sync forever
+                if time.monotonic() - first_change_time < job.args.watchdelay * WATCH_MAX_DELAY_FACTOR:
+                    continue
+            if not pending_changes:
+                continue
+            if os.path.exists(manifest_path) and not job.args.simulate:
+                os.remove(manifest_path)
+            start_time = time.perf_counter()
+            num_copied = job.info_data['files']['num_copied']
+            status = sync_changes(job, source_path, pending_changes)
+            logger.info("{}Synced {} changed folders, copying {} files, in {}".format(
+                sim_text(job),
+                len(pending_changes),
+                job.info_data['files']['num_copied'] - num_copied,
+                Timer.format_time(time.perf_counter() - start_time),
+            ))
+            pending_changes = set()
+            if status != 0:
+                break
+    except KeyboardInterrupt:
+        logger.info("Stopped watching for changes")
+    finally:
+        watcher.close()
+    return status
 
 
-def conflict_text(present_tense):
-    """Return a string to represent what type of conflict resolution was used"""
-    if args.conflictmode == 0:
-        return "ignoring" if present_tense else "ignored"
-    elif args.conflictmode == 1:
-        return "archiving" if present_tense else "archived"
-    else:  # args.conflictmode == 2
-        return "deleting" if present_tense else "deleted"
+def copy_folder(jobs, source_path, current_folder, depth, pending_folders):
+    """
+    Processes the contents of a source folder and copies them to the same folder in the destination of each job if
+    aplicable. The source folder is listed once, and a file needed by several destinations is read once for all of
+    them. Subfolders found are added to pending_folders as (relative folder, depth, jobs) to be processed afterwards.
+    """
+    current_source_path = os.path.join(source_path, current_folder)
+
+    # Get all files and folders in the current source and destination folders, using the scan made ahead if there is one
+    folder_scanner = jobs[0].folder_scanner
+    scan = folder_scanner.take(current_folder, jobs) if folder_scanner is not None else None
+    try:
+        if scan is not None:
+            scans = scan.result()
+        else:
+            scans = scan_folders(jobs, source_path, current_folder)
+    except PermissionError:  # If the source folder cannot be accessed, skip it and move on
+        logger.warning("Cannot read contents of source folder, access is denied: '{}'".format(current_source_path))
+        for job in jobs:
+            if job.journal is not None:
+                job.journal.folder_failed(current_folder)
+        return 0
+    except FileNotFoundError as e:
+        # Destination folder could not be found for some reason
+        if e.filename not in [os.path.join(job.compare_path, current_folder) for job in jobs]:
+            raise
+        # Something is really wrong. This should never happen
+        logger.critical("Destination folder could not be found: '{}'".format(e.filename))
+        return 1
 
+    # Bring the folder up to date in each destination. With several destinations, the files to copy are collected
+    # first, as the source file with the destinations needing it, so that each is read once
+    copies = {} if len(jobs) > 1 else None
+    subfolders = []
+    subfolder_jobs = []
+    for job, (source_entries, dest_entries, dest_missing) in zip(jobs, scans):
+        job_subfolders = update_folder(job, current_folder, depth, source_entries, dest_entries, dest_missing,
+                                       copies)
+        # The subfolders are the same in every destination, since they are filtered by the same rules
+        if job_subfolders is not None:
+            subfolders = job_subfolders
+            subfolder_jobs.append(job)
+    for source_item_stats, targets in (copies or {}).values():
+        if len(targets) == 1:
+            copy_file(targets[0][0], source_item_stats, targets[0][1])
+        else:
+            fan_out_file(targets, source_item_stats)
 
-def copy_file(source_file_stats, dest_file_stats):
-    """Copies a file from the source folder to the destination folder"""
-    logger.debug("{}Copying '{}'".format(sim_text(), source_file_stats.path_name))
-    if not args.simulate:
-        try:
-            timer.lap()
-            shutil.copy2(source_file_stats.path_name, dest_file_stats.path_name)
-            info_data['time_spent']['copying'] += timer.lap()
-            info_data['files']['num_copied'] += 1
-            info_data['files']['size_copied'] += source_file_stats.getsize()
-        except PermissionError:
-            logger.warning("Cannot copy file here, access denied: '{}'".format(dest_file_stats.path_name))
-            info_data['files']['not_copied'] += 1
-        except FileNotFoundError:
-            # If this error happens here, it's likely meaning that the destination file could not be found.
-            # This is likely due to the destination file path being too long for the OS to handle.
-            logger.warning("Cannot copy file here, destination path too long: '{}'".format(dest_file_stats.path_name))
-            info_data['files']['not_copied'] += 1
-    else:  # Simulate only
-        info_data['files']['num_copied'] += 1
-        info_data['files']['size_copied'] += source_file_stats.getsize()
+    # Queue the subfolders so they are popped in listing order
+    for source_item in reversed(subfolders):
+        pending_folders.append((os.path.join(current_folder, source_item), depth + 1, subfolder_jobs))
+    return 0
 
 
-def copy_folder(source_path, dest_path, archive_path, current_folder, depth):
+def update_folder(job, current_folder, depth, source_entries, dest_entries, dest_missing, copies=None):
     """
-    Processes the contents of a source folder and copies them to the destination folder if aplicable.
-    This method is called recursively for each subfolder found.
+    Brings a folder in the destination of a job up to date with the listing of the source folder: creates it if
+    needed, resolves its conflicts, and copies the files that need copying, or adds them to copies if given, as a
+    dict mapping the path of each source file to (source stats, [(job, destination stats)]). Returns the names of the
+    subfolders to process, or None if the folder had to be skipped along with everything below it.
     """
-    # If the current depth is too deep, skip the folder
-    if args.depth is not None and depth > args.depth:
-        logger.debug("Subfolder depth too deep, skipping")
-        return 0
-
-    # Create absolute paths for the source, destination, and archive using the current relative folder
-    current_source_path = os.path.join(source_path, current_folder)
-    current_dest_path = os.path.join(dest_path, current_folder)
+    # Create absolute paths for the destination and archive using the current relative folder
+    archive_path = job.archive_path
+    current_dest_path = os.path.join(job.compare_path, current_folder)
     current_archive_path = os.path.join(archive_path, current_folder)
 
-    # Create destination folder if it doesn't exist
-    if not os.path.exists(current_dest_path):
-        logger.debug("{}Creating destination folder: '{}'".format(sim_text(), current_dest_path))
-        if not args.simulate:
+    # Create destination folder if it doesn't exist. Snapshots are built in a new folder instead, leaving the previous
+    # snapshot they are compared against untouched
+    if job.snapshot_store is not None:
+        if not job.args.simulate:
+            job.snapshot_store.make_folder(current_dest_path)
+    elif dest_missing:
+        logger.debug("{}Creating destination folder: '{}'".format(sim_text(job), current_dest_path))
+        if not job.args.simulate:
             try:
-                os.mkdir(current_dest_path)
-                info_data['folders']['num_created'] += 1
+                job.filesystem.mkdir(current_dest_path)
+                job.info_data['folders']['num_created'] += 1
             except PermissionError:
                 logger.warning("Cannot create folder in destination, access denied: '{}'".format(current_dest_path))
                 logger.warning("Trying to continue...")
-                return 0
+                if job.journal is not None:
+                    job.journal.folder_failed(current_folder)
+                return None
+    if current_folder:
+        job.manifest.record_folder(current_dest_path)
 
-    # Get a list of all files and folders in the current source and destination folders
-    try:
-        timer.lap()
-        source_list = os.listdir(current_source_path)
-        info_data['time_spent']['scanning'] += timer.lap()
-    except PermissionError:  # If the source folder cannot be accessed, skip it and move on
-        logger.warning("Cannot read contents of source folder, access is denied: '{}'".format(current_source_path))
-        return 0
-    try:
-        timer.lap()
-        dest_list = os.listdir(current_dest_path)
-        info_data['time_spent']['scanning'] += timer.lap()
-    # Destination folder could not be found for some reason
-    except FileNotFoundError:
-        if args.simulate:
-            # If set to simulate, assume that the folder would have been created if not simulating, and ignore
-            dest_list = []
-        else:
-            # Something is really wrong. This should never happen
-            logger.critical("Destination folder could not be found: '{}'".format(current_dest_path))
-            return 1
+    # Pair up each source item with its destination item, and get all items present in the destination folder that
+    # are not in the source folder
+    item_pairs, conflict_list = diff_folders(source_entries, dest_entries)
+    # Items missing from the source are just left out of a new snapshot, so there are no conflicts to resolve
+    if job.snapshot_store is not None:
+        conflict_list = []
 
-    # Get a list of all files and folders present in the destination folder that are not in the source folder
-    conflict_list = list(set(dest_list) - set(source_list))
+    # Process each confliction. Conflicts to archive or delete are collected as (stats, archive path) and resolved
+    # together
+    conflict_batch = []
+    for conflict_entry in conflict_list:
+        # Temp files left by copies that never finished are removed, whatever the conflict mode
+        if conflict_entry.name.startswith(TEMP_PREFIX):
+            logger.debug("{}Removing unfinished copy: '{}'".format(sim_text(job), conflict_entry.path))
+            if not job.args.simulate:
+                try:
+                    job.filesystem.remove(conflict_entry.path)
+                except OSError as e:
+                    logger.warning("Cannot remove unfinished copy ({}): '{}'".format(e, conflict_entry.path))
+            continue
+
+        # Compressed files are resolved as they are stored, not as the original file
+        if getattr(conflict_entry, 'compressed', False):
+            conflict_entry = conflict_entry.entry
 
-    # Process each confliction
-    for conflict_item in conflict_list:
         # Get the absolute path of the conflict item
-        conflict_item_path = os.path.join(current_dest_path, conflict_item)
+        conflict_item_path = conflict_entry.path
+
+        # The manifest, trash and pack files in the destination root are not conflicts
+        if not current_folder and conflict_entry.name.startswith((MANIFEST_NAME, TRASH_NAME, PACK_NAME, JOURNAL_NAME)):
+            continue
 
-        # Get conflict stats
-        timer.lap()
-        conflict_item_stats = StatHelper(conflict_item_path)
-        info_data['time_spent']['stats'] += timer.lap()
+        # Packed files only exist in the pack index, so resolve them there
+        if isinstance(conflict_entry, PackEntry):
+            if job.args.conflictmode == 1:
+                if not job.filesystem.exists(current_archive_path):
+                    logger.debug("{}Creating archive directory: '{}'".format(sim_text(job), current_archive_path))
+                    if not job.args.simulate:
+                        job.filesystem.makedirs(current_archive_path)
+                        job.info_data['folders']['num_created'] += 1
+                    else:  # Simulate only
+                        job.info_data['folders']['num_created'] += 1
+                logger.debug("{}Archiving packed conflict: '{}'".format(sim_text(job), conflict_item_path))
+                if not job.args.simulate:
+                    job.pack_store.extract(conflict_item_path, os.path.join(current_archive_path, conflict_entry.name))
+                    job.pack_store.forget(conflict_item_path)
+            elif job.args.conflictmode == 2:
+                logger.debug("{}Deleting packed conflict: '{}'".format(sim_text(job), conflict_item_path))
+                job.pack_store.forget(conflict_item_path)
+            else:
+                logger.debug("Ignoring conflict: '{}'".format(conflict_item_path))
+            with job.info_lock:
+                job.info_data['misc']['conflicts_resolved'] += 1
+            continue
+
+        # Get conflict stats. If the destination listing came from the manifest, check the conflict is still there
+        job.timer.lap()
+        if isinstance(conflict_entry, ManifestEntry):
+            conflict_item_stats = StatHelper(conflict_item_path, filesystem=job.filesystem)
+        else:
+            conflict_item_stats = StatHelper(conflict_item_path, conflict_entry)
+        stats_time = job.timer.lap()
+        with job.info_lock:
+            job.info_data['time_spent']['stats'] += stats_time
+        if not conflict_item_stats.exists():
+            logger.debug("Conflict no longer exists: '{}'".format(conflict_item_path))
+            continue
 
-        if args.conflictmode == 0:
+        if job.args.conflictmode == 0:
             # Ignore the conflict
             logger.debug("Ignoring conflict: '{}'".format(conflict_item_path))
-            info_data['misc']['conflicts_resolved'] += 1
-        else:  # The conflict will need to be moved or deleted
-            # Make sure that the conflict has write permissions
-            if not conflict_item_stats.haswrite():
-                logger.debug("File does not have write access, setting it: '{}'".format(conflict_item_path))
-                os.chmod(conflict_item_path, stat.S_IWRITE)
-
-            if args.conflictmode == 1:
-                # Make sure the archive folder is not archived
-                if not conflict_item_path == archive_path:
-                    # Archive the conflict
-                    if not os.path.exists(current_archive_path):
-                        logger.debug("{}Creating archive directory: '{}'".format(sim_text(), current_archive_path))
-                        if not args.simulate:
-                            try:
-                                os.makedirs(current_archive_path)
-                                info_data['folders']['num_created'] += 1
-                            except PermissionError:
-                                logger.warning("Cannot create folder in archive, access denied: '{}'".format(
-                                    current_archive_path))
-                                logger.warning("Trying to continue...")
-                                return 0
-                        else:  # Simulate only
-                            info_data['folders']['num_created'] += 1
-                    logger.debug("{}Archiving conflict: '{}'".format(sim_text(), conflict_item_path))
-                    if not args.simulate:
+            with job.info_lock:
+                job.info_data['misc']['conflicts_resolved'] += 1
+            job.manifest.record(conflict_item_path, conflict_item_stats.stats)
+        elif job.args.conflictmode == 1:
+            # Make sure the archive folder is not archived
+            if not conflict_item_path == archive_path:
+                # Archive the conflict
+                if not job.filesystem.exists(current_archive_path):
+                    logger.debug("{}Creating archive directory: '{}'".format(sim_text(job), current_archive_path))
+                    if not job.args.simulate:
                         try:
-                            timer.lap()
-                            shutil.move(conflict_item_path, current_archive_path)
-                            info_data['time_spent']['resolving'] += timer.lap()
-                            info_data['misc']['conflicts_resolved'] += 1
+                            job.filesystem.makedirs(current_archive_path)
+                            job.info_data['folders']['num_created'] += 1
                         except PermissionError:
-                            logger.warning("Cannot archive conflict, access denied: '{}'".format(conflict_item_path))
-                            continue
+                            logger.warning("Cannot create folder in archive, access denied: '{}'".format(
+                                current_archive_path))
+                            logger.warning("Trying to continue...")
+                            if job.journal is not None:
+                                job.journal.folder_failed(current_folder)
+                            return None
                     else:  # Simulate only
-                        info_data['misc']['conflicts_resolved'] += 1
-            else:
-                # Delete the conflict. Use shutil.rmtree for directories and os.remove for files
-                logger.debug("{}Deleting conflict: '{}'".format(sim_text(), conflict_item_path))
-                if not args.simulate:
-                    try:
-                        timer.lap()
-                        if os.path.isdir(conflict_item_path):
-                            def remove_read_only(action, name, exc):
-                                os.chmod(name, stat.S_IWRITE)
-                            shutil.rmtree(conflict_item_path, onerror=remove_read_only)
-                        else:
-                            os.remove(conflict_item_path)
-                        info_data['time_spent']['resolving'] += timer.lap()
-                        info_data['misc']['conflicts_resolved'] += 1
-                    except PermissionError:
-                        logger.warning("Cannot delete conflict, access denied: '{}'".format(conflict_item_path))
-                        continue
+                        job.info_data['folders']['num_created'] += 1
+                logger.debug("{}Archiving conflict: '{}'".format(sim_text(job), conflict_item_path))
+                if not job.args.simulate:
+                    conflict_batch.append((conflict_item_stats,
+                                           os.path.join(current_archive_path, conflict_entry.name)))
                 else:  # Simulate only
-                    info_data['misc']['conflicts_resolved'] += 1
+                    with job.info_lock:
+                        job.info_data['misc']['conflicts_resolved'] += 1
+        else:
+            # Delete the conflict
+            logger.debug("{}Deleting conflict: '{}'".format(sim_text(job), conflict_item_path))
+            if not job.args.simulate:
+                conflict_batch.append((conflict_item_stats, None))
+            else:  # Simulate only
+                with job.info_lock:
+                    job.info_data['misc']['conflicts_resolved'] += 1
+
+    # Archive or delete the conflicts of this folder as one batch, in the background if there are workers
+    if conflict_batch:
+        if job.copy_pool is not None:
+            job.copy_pool.submit(resolve_conflicts, job, conflict_batch)
+        else:
+            resolve_conflicts(job, conflict_batch)
 
     # Process each item in the current source folder
-    for source_item in source_list:
-        # Get the absolute path of the source item
-        source_item_path = os.path.join(current_source_path, source_item)
-
-        # Get source stats
-        timer.lap()
-        source_item_stats = StatHelper(source_item_path)
-        info_data['time_spent']['stats'] += timer.lap()
-
-        # If we do not have read access to the current path, log and skip
-        if not source_item_stats.has_permission():
-            logger.warning("Access is denied: '{}'".format(source_item_stats.path_name))
-            return 0
+    subfolders = []
+    for source_entry, dest_entry in item_pairs:
+        # Get the name and absolute path of the source item
+        source_item = source_entry.name
+        source_item_path = source_entry.path
 
-        if source_item_stats.isdir():
-            # If it's a directory, recursively call this method with the source item as the new current folder, and
-            # the depth raised by 1.
-            logger.debug("Travelling into subfolder: '{}'".format(source_item_path))
-            res = copy_folder(source_path, dest_path, archive_path, os.path.join(current_folder, source_item), depth+1)
-            # If there's an error, abort
-            if res is not 0:
-                return res
+        # The directory listing already knows the item type, so directories never need to be stat'ed
+        if source_entry.is_dir():
+            # A packed file with the same name has been replaced by the folder
+            if getattr(dest_entry, 'packed', False):
+                job.pack_store.forget(dest_entry.path)
+            # If it's a directory, queue it to be processed once this folder is done, unless it is too deep
+            if job.args.depth is not None and depth + 1 > job.args.depth:
+                logger.debug("Subfolder depth too deep, skipping: '{}'".format(source_item_path))
+                continue
+            subfolders.append(source_item)
         else:
             # If it's a file, determine whether it should be copied and do so if applicable.
-            # Get the absolute path of the destination item
-            dest_item_path = os.path.join(current_dest_path, source_item)
+            # Get source stats
+            job.timer.lap()
+            source_item_stats = StatHelper(source_item_path, source_entry)
+            stats_time = job.timer.lap()
+            with job.info_lock:
+                job.info_data['time_spent']['stats'] += stats_time
+
+            # If we do not have read access to the current path, log and skip it. Only this file is skipped, since the
+            # subfolders of this folder are still to be queued
+            if not source_item_stats.has_permission():
+                logger.warning("Access is denied: '{}'".format(source_item_stats.path_name))
+                if job.journal is not None:
+                    job.journal.folder_failed(current_folder)
+                continue
+
+            # Get the absolute path of the destination item. It may be stored under another name, e.g. if compressed
+            dest_item_path = dest_entry.path if dest_entry is not None else os.path.join(current_dest_path, source_item)
 
-            # Get destination stats
-            timer.lap()
-            dest_item_stats = StatHelper(dest_item_path)
-            info_data['time_spent']['stats'] += timer.lap()
+            # Get destination stats, reusing the destination listing. Missing items need no syscall at all
+            job.timer.lap()
+            dest_item_stats = StatHelper(dest_item_path, dest_entry, exists=dest_entry is not None)
+            stats_time = job.timer.lap()
+            with job.info_lock:
+                job.info_data['time_spent']['stats'] += stats_time
 
+            # Decide whether the file needs to be copied
+            job.timer.lap()
             # If the destination file doesn't exist, or the copy mode is set to always copy without checking
-            if not dest_item_stats.exists() or args.copymode == 0:
-                copy_file(source_item_stats, dest_item_stats)
+            if not dest_item_stats.exists() or job.args.copymode == 0:
+                copy_needed = True
 
             # If copy mode is 1 or higher, check if the source file's modified date is not equal to the destination
-            elif args.copymode >= 1 and not source_item_stats.getmtime() == dest_item_stats.getmtime():
+            elif job.args.copymode >= 1 and not source_item_stats.getmtime() == dest_item_stats.getmtime():
                 # If the modified date of the destination is newer than the source, something is not right...
                 if dest_item_stats.getmtime() > source_item_stats.getmtime():
                     logger.debug("Destination file is newer than source: '{}'".format(dest_item_path))
@@ -370,187 +4036,802 @@ def copy_folder(source_path, dest_path, archive_path, current_folder, depth):
                     #                "with this, so the file will be skipped.")
                     logger.debug("Copying anyway...")
                 # Otherwise the source is newer than the destination, and should be copied
-                copy_file(source_item_stats, dest_item_stats)
+                copy_needed = True
 
             # If copy mode is 2 or higher and modified dates are equal, check if there is a difference in the file sizes
-            elif args.copymode >= 2 and source_item_stats.getsize() != dest_item_stats.getsize():
-                copy_file(source_item_stats, dest_item_stats)
+            elif job.args.copymode >= 2 and source_item_stats.getsize() != dest_item_stats.getsize():
+                copy_needed = True
 
-            # If copy mode is 3 and all else is inconclusive, check the file hashes to confirm the files are the same.
-            elif args.copymode == 3:
-                pass  # TODO: implement hash checking
+            # If copy mode is 3 and all else is inconclusive, compare the file contents to confirm they are the same.
+            elif job.args.copymode == 3 and not compare_files(job, source_item_stats, dest_item_stats):
+                logger.debug("File contents differ: '{}'".format(dest_item_path))
+                copy_needed = True
 
-            # If everything checks out, the files are considered to be the same, and will be skipped
+            # If everything checks out, the files are considered to be the same
+            else:
+                copy_needed = False
+            job.info_data['time_spent']['deciding'] += job.timer.lap()
+
+            if copy_needed:
+                # With several destinations, the file is copied once every destination has decided whether it needs it
+                if copies is not None:
+                    copies.setdefault(source_item_path, (source_item_stats, []))[1].append((job, dest_item_stats))
+                else:
+                    copy_file(job, source_item_stats, dest_item_stats)
+
+            # Files that are the same are skipped
             else:
                 logger.debug("Skipping file: '{}'".format(source_item_path))
-                info_data['files']['num_skipped'] += 1
-                info_data['files']['size_skipped'] += source_item_stats.getsize()
-            info_data['files']['num_processed'] += 1
+                # Unchanged files are linked from the previous snapshot into the new one
+                if job.snapshot_store is not None and not job.args.simulate:
+                    try:
+                        job.snapshot_store.link(dest_item_stats.path_name, dest_item_path)
+                        job.info_data['files']['num_linked'] += 1
+                    except OSError as e:
+                        logger.warning("Cannot link file into snapshot ({}): '{}'".format(e, dest_item_path))
+                # Packed files are kept in the pack index rather than the manifest
+                if not dest_item_stats.packed:
+                    job.manifest.record(dest_item_path, source_item_stats.stats)
+                if job.verifier is not None:
+                    if job.snapshot_store is not None:
+                        job.verifier.add(source_item_stats, job.snapshot_store.target_path(dest_item_path), False)
+                    else:
+                        job.verifier.add(source_item_stats, dest_item_path, False,
+                                     'packed' if dest_item_stats.packed else
+                                     'compressed' if dest_item_stats.compressed else None)
+                job.info_data['files']['num_skipped'] += 1
+                job.info_data['files']['size_skipped'] += source_item_stats.getsize()
+            job.info_data['files']['num_processed'] += 1
 
-    return 0
+    return subfolders
+
+
+def sibackup(args, filesystem=None):
+    """
+    Run the backups set up by the given command line options, through the given filesystem backend (local files by
+    default). Returns the status code of the run
+    """
+    status, _ = run_backups(args, filesystem if filesystem is not None else LocalFileSystem())
+    return status
+
+
+def run_backups(args, filesystem):
+    """
+    Back up the source to its destinations, followed by the jobs in the batch file if one is given, with a Job for each
+    destination, holding its own counters and summary. The copy workers and folder scanners are started once and handed
+    on from each backup to the next. Returns (status, results), where the status == 0 if every backup succeeded,
+    otherwise the status of the first one that didn't, and there is a result for each destination backed up, holding
+    its paths, status, total time and counters.
+    """
+
+    # Back up the source given on the command line, then the backups from the batch file
+    backups = []
+    if args.source is not None and args.destination:
+        backups.append((args.source, args.destination))
+    elif args.source is not None or args.batch is None:
+        logger.critical("A source and at least one destination are needed, unless they are given by --batch. Aborting")
+        return 1, []
+    if args.batch is not None:
+        try:
+            backups += read_batch_file(args.batch)
+        except (OSError, ValueError) as e:
+            logger.critical("Cannot read batch file ({}): '{}'. Aborting".format(e, args.batch))
+            return 1, []
+    if not backups:
+        logger.critical("The batch file has no backups to run. Aborting")
+        return 1, []
+
+    # Watching never finishes, so it would never get to the other backups
+    if args.watch and len(backups) > 1:
+        logger.critical("Watch mode can only be used with one backup, not with a batch of them. Aborting")
+        return 1, []
+
+    # Profile the whole run with cProfile if asked to
+    code_profile = None
+    if args.profileout is not None:
+        import cProfile
+        code_profile = cProfile.Profile()
+        code_profile.enable()
+
+    status = 0
+    results = []
+    jobs = []
+    try:
+        for index, (source, destinations) in enumerate(backups):
+            if len(backups) > 1:
+                logger.info("Backing up '{}' to {} (backup {} of {})".format(
+                    source, ", ".join("'{}'".format(destination) for destination in destinations), index + 1,
+                    len(backups)))
+            # The jobs of each backup take over the pools started by the one before
+            if not jobs:
+                jobs = [Job(args, filesystem) for _ in destinations]
+            else:
+                jobs = [Job(args, filesystem, jobs[0].copy_pool, jobs[0].folder_scanner) for _ in destinations]
+            statuses = backup_source(jobs, source, destinations)
+            for job, destination, backup_status in zip(jobs, destinations, statuses):
+                results.append({
+                    'source': os.path.abspath(source),
+                    'destination': os.path.abspath(destination),
+                    'status': backup_status,
+                    'total_time': job.timer.elapsed(),
+                    'info_data': job.info_data,
+                })
+                if status == 0:
+                    status = backup_status
+    finally:
+        # Stop the pools shared by the jobs. Each backup waited for its own copies, so nothing is left pending unless a
+        # backup was aborted
+        if jobs and jobs[0].folder_scanner is not None:
+            jobs[0].folder_scanner.shutdown()
+        if jobs and jobs[0].copy_pool is not None:
+            jobs[0].copy_pool.shutdown(cancel=True)
+        if code_profile is not None:
+            code_profile.disable()
+            write_code_profile(code_profile, args.profileout, args.profile)
+
+    # Sum up each destination after all the separate summaries
+    if len(results) > 1:
+        for result in results:
+            logger.info("{} -> {}: {} ({} files copied, {} files skipped, finished in {})".format(
+                result['source'],
+                result['destination'],
+                "complete" if result['status'] == 0 else "aborted with status {}".format(result['status']),
+                result['info_data']['files']['num_copied'],
+                result['info_data']['files']['num_skipped'],
+                Timer.format_time(result['total_time']),
+            ))
+
+    # Write the metrics report if requested
+    if args.report is not None:
+        try:
+            write_report(args.report, args.reportformat, results, args.simulate)
+        except OSError as e:
+            logger.error("Cannot write report '{}': {}".format(args.report, e))
 
+    return status, results
 
-# @profile()
-def sibackup():
-    # Start the timer
-    timer.start()
+
+def backup_source(jobs, source, destinations):
+    """
+    Back up a source to one or more destinations, each with a job of its own, then log the summary of each. The source
+    is walked and each file is read once, however many destinations there are, while each destination makes its own
+    decisions about what to copy and keeps its own counters. Returns a list with the status code of each destination
+    """
+    args = jobs[0].args
+    filesystem = jobs[0].filesystem
+
+    # Start the timers
+    for job in jobs:
+        job.timer.start()
 
     # Get source folder and make sure it exists
-    source_path = os.path.abspath(args.source)
-    if not os.path.exists(source_path):
+    source_path = os.path.abspath(source)
+    if not filesystem.exists(source_path):
         logger.critical("Source path does not exist. Aborting")
-        return 1
+        return [1] * len(jobs)
 
-    # Get destination folder
-    dest_path = os.path.abspath(args.destination)
-    if not os.path.exists(dest_path):
-        logger.debug("{}Destination path does not exist, creating it...".format(sim_text()))
-        if not args.simulate:
-            try:
-                os.makedirs(dest_path)
-                info_data['folders']['num_created'] += 1
-            except PermissionError:
-                # Would be very bad if this fails here
-                logger.critical("Cannot create destination folder, access denied. Aborting")
-                return 1
-        else:  # Simulate only
-            info_data['folders']['num_created'] += 1
+    # Restoring, calibrating and watching work on a single destination. Packed, compressed, snapshot and delta copies
+    # are each made from the source for one destination, so they can't share what is read from it with the others
+    if len(jobs) > 1:
+        for enabled, feature in ((args.restore, "Restoring"), (args.calibrate, "Calibration"),
+                                 (args.watch, "Watch mode"), (args.pack, "Packing"),
+                                 (args.compress is not None, "Compression"), (args.snapshot, "Snapshots"),
+                                 (args.delta, "Delta copies")):
+            if enabled:
+                logger.critical("{} can only be used with one destination. Aborting".format(feature))
+                return [1] * len(jobs)
+
+    # Features that keep files of their own in the destination, or read them back, need real files
+    if not filesystem.local:
+        for enabled, feature in ((args.restore, "Restoring"), (args.pack, "Packing"),
+                                 (args.compress is not None, "Compression"), (args.snapshot, "Snapshots"),
+                                 (args.delta, "Delta copies"), (args.trash, "The trash"),
+                                 (args.watch, "Watch mode"), (args.calibrate, "Calibration")):
+            if enabled:
+                logger.critical("{} can only be used on the local filesystem. Aborting".format(feature))
+                return [1] * len(jobs)
+
+    # Restoring reads the source as a backup instead of backing it up
+    if args.restore:
+        return [restore_backup(jobs[0], source_path, os.path.abspath(destinations[0]))]
 
     # If depth isn't none, make sure it isn't less than 0
     if args.depth is not None and args.depth < 0:
         logger.critical("Depth cannot be less than 0. Aborting")
-        return 1
+        return [1] * len(jobs)
+
+    # Make sure there is at least one copy worker and one scanner
+    if args.workers < 1:
+        logger.critical("Number of workers cannot be less than 1. Aborting")
+        return [1] * len(jobs)
+    if ((args.bwlimit is not None and args.bwlimit <= 0) or
+            (args.iopslimit is not None and args.iopslimit <= 0)):
+        logger.critical("I/O limits must be more than 0. Aborting")
+        return [1] * len(jobs)
+    if args.scanners < 1:
+        logger.critical("Number of scanners cannot be less than 1. Aborting")
+        return [1] * len(jobs)
 
     # Make sure copymode and conflict mode are valid
     if args.copymode not in [0, 1, 2, 3]:
         logger.critical("Invalid copy mode '{}'. Aborting".format(args.copymode))
-        return 1
+        return [1] * len(jobs)
     if args.conflictmode not in [0, 1, 2]:
         logger.critical("Invalid conflict mode '{}'. Aborting".format(args.copymode))
-        return 1
+        return [1] * len(jobs)
+
+    if args.verify is not None and not 0 < args.verifypercent <= 100:
+        logger.critical("Percentage of files to verify must be more than 0 and at most 100. Aborting")
+        return [1] * len(jobs)
+
+    if args.keepsnapshots is not None and args.keepsnapshots < 1:
+        logger.critical("Number of snapshots to keep cannot be less than 1. Aborting")
+        return [1] * len(jobs)
+
+    # Snapshots are made once per run, so they can't be kept up to date while watching
+    if args.snapshot and args.watch:
+        logger.critical("Snapshots cannot be made in watch mode. Aborting")
+        return [1] * len(jobs)
+
+    # Snapshots are made from whole files, so they can't be mixed with packing or compression
+    if args.snapshot and (args.pack or args.compress is not None):
+        logger.critical("Snapshots cannot be used together with packing or compression. Aborting")
+        return [1] * len(jobs)
+    if args.compress == 'zstd' and import_zstandard() is None:
+        logger.critical("Compressing with zstd needs the 'zstandard' module, which is not installed. Aborting")
+        return [1] * len(jobs)
+
+    if args.copybuffer is not None and args.copybuffer <= 0:
+        logger.critical("Copy buffer size must be more than 0. Aborting")
+        return [1] * len(jobs)
+
+    # Calibrating times copies to the destination instead of backing up to it
+    if args.calibrate:
+        dest_path = os.path.abspath(destinations[0])
+        status = make_destination(jobs[0], dest_path)
+        return [status if status != 0 else calibrate_copies(jobs[0], source_path, dest_path)]
+
+    # Open each destination. A destination that can't be backed up to is left out, and the others carry on without it
+    statuses = [0] * len(jobs)
+    open_jobs = []
+    for index, (job, destination) in enumerate(zip(jobs, destinations)):
+        statuses[index] = open_destination(job, source_path, destination)
+        if statuses[index] == 0 and len(jobs) > 1 and job.pack_store is not None:
+            logger.critical("Destination has packed files, which can only be kept up to date when backing up to one "
+                            "destination: '{}'".format(job.dest_path))
+            statuses[index] = 1
+        if statuses[index] != 0:
+            abandon_destination(job)
+        else:
+            open_jobs.append(job)
+    if not open_jobs:
+        return statuses
+
+    # Start the copy workers if copying in parallel. Pools started for an earlier batch job are kept running and
+    # reused, and are shut down by run_backups() once every job is done. The destinations share the pools
+    copy_pool = jobs[0].copy_pool
+    if args.workers > 1 and copy_pool is None:
+        logger.debug("Starting {} copy workers".format(args.workers))
+        copy_pool = CopyPool(args.workers)
+    # Start the folder scanners if scanning in parallel
+    folder_scanner = jobs[0].folder_scanner
+    if args.scanners > 1 and folder_scanner is None:
+        logger.debug("Starting {} folder scanners".format(args.scanners))
+        folder_scanner = FolderScanner(args.scanners)
+    for job in jobs:
+        job.copy_pool = copy_pool
+        job.folder_scanner = folder_scanner
+
+    # Start reporting progress if enabled, counting the source first if asked to so that an ETA can be given
+    progress_reporters = []
+    if args.progress is not None:
+        total_files = total_size = None
+        if args.precount:
+            start_time = time.perf_counter()
+            total_files, total_size = count_source(open_jobs[0], source_path)
+            logger.info("Found {} in {} files to process ({} to count)".format(
+                format_data_size(total_size), total_files, Timer.format_time(time.perf_counter() - start_time)))
+        for job in open_jobs:
+            progress_reporter = ProgressReporter(job, args.progress, total_files, total_size,
+                                                 job.dest_path if len(jobs) > 1 else None)
+            progress_reporter.start()
+            progress_reporters.append(progress_reporter)
+
+    num_mismatched = [0] * len(open_jobs)
+    try:
+        status = copy_tree(open_jobs, source_path)
+        # Read back what was backed up once all copies have finished. Only the first sync is verified when watching
+        for index, job in enumerate(open_jobs):
+            if job.verifier is not None and status == 0:
+                if copy_pool is not None:
+                    copy_pool.wait()
+                num_mismatched[index] = verify_backup(job)
+            job.verifier = None
+        # Keep syncing changes after the first sync if watching. The first sync is complete, so it won't be resumed
+        if args.watch and status == 0:
+            job = open_jobs[0]
+            if job.journal is not None:
+                if copy_pool is not None:
+                    copy_pool.wait()
+                job.journal.finish(success=True)
+                job.journal = None
+            status = watch_tree(job, source_path)
+    except BaseException:
+        for progress_reporter in progress_reporters:
+            progress_reporter.stop()
+        if folder_scanner is not None:
+            folder_scanner.shutdown()
+        # Aborting (e.g. Ctrl-C): let running copies finish so no half-written files are left, but drop the rest
+        if copy_pool is not None:
+            copy_pool.shutdown(cancel=True)
+        for job in jobs:
+            job.folder_scanner = None
+            job.copy_pool = None
+        for job in open_jobs:
+            abandon_destination(job)
+        raise
+    # Drop any scans left over if the backup stopped early, and wait for all queued copies to finish
+    if folder_scanner is not None:
+        folder_scanner.discard()
+    if copy_pool is not None:
+        copy_pool.wait()
+    for progress_reporter in progress_reporters:
+        progress_reporter.stop()
+
+    # Close each destination and sum it up
+    for index, job in enumerate(open_jobs):
+        if len(jobs) > 1:
+            logger.info("Finishing backup to '{}'".format(job.dest_path))
+        statuses[jobs.index(job)] = finish_destination(job, status, num_mismatched[index])
+    return statuses
+
+
+def make_destination(job, dest_path):
+    """Create the destination folder of a job if it doesn't exist. Returns the status code"""
+    if not job.filesystem.exists(dest_path):
+        logger.debug("{}Destination path does not exist, creating it...".format(sim_text(job)))
+        if not job.args.simulate:
+            try:
+                job.filesystem.makedirs(dest_path)
+                job.info_data['folders']['num_created'] += 1
+            except PermissionError:
+                # Would be very bad if this fails here
+                logger.critical("Cannot create destination folder, access denied. Aborting")
+                return 1
+        else:  # Simulate only
+            job.info_data['folders']['num_created'] += 1
+    return 0
+
+
+def open_destination(job, source_path, destination):
+    """
+    Get the destination of a job ready to be backed up to: create it, and open its manifest, journal, stores and caches
+    as the options ask for. Returns the status code
+    """
+    # For the errors of the databases kept for the run (the journal, the pack index and the hash cache)
+    import sqlite3
+
+    # Get destination folder
+    dest_path = os.path.abspath(destination)
+    job.dest_path = dest_path
+    status = make_destination(job, dest_path)
+    if status != 0:
+        return status
+
+    # Use the copy settings saved by --calibrate for these folders, unless they are given as options
+    job.copy_strategy = job.args.copystrategy
+    job.copy_buffer_size = int(job.args.copybuffer) if job.args.copybuffer is not None else COPY_LARGE_BUFFER_SIZE
+    if job.filesystem.local and (job.args.copystrategy == 'auto' or job.args.copybuffer is None):
+        try:
+            settings = read_calibrations(calibration_path(job)).get('{} -> {}'.format(source_path, dest_path))
+        except (OSError, ValueError) as e:
+            logger.warning("Cannot read copy calibration, using the default copy settings ({})".format(e))
+            settings = None
+        if settings is not None:
+            if job.args.copystrategy == 'auto' and settings['strategy'] in dict(COPY_STRATEGIES):
+                job.copy_strategy = settings['strategy']
+            if job.args.copybuffer is None:
+                job.copy_buffer_size = int(settings['buffer_size'])
+            logger.debug("Using calibrated copy settings: {} copies, {} buffer for userspace copies".format(
+                job.copy_strategy, format_data_size(job.copy_buffer_size)))
+
+    # Compile the filter rules. Rules from files come first, then excludes, then includes, and the last rule that
+    # matches an item wins, so --include can make exceptions to any exclude
+    job.filter_rules = None
+    rules = []
+    for filter_path in job.args.excludefrom or []:
+        try:
+            rules += read_filter_file(filter_path)
+        except OSError as e:
+            logger.critical("Cannot read filter rules ({}): '{}'. Aborting".format(e, filter_path))
+            return 1
+    rules += job.args.exclude or []
+    rules += ['!' + pattern for pattern in job.args.include or []]
+    limits = (job.args.minsize, job.args.maxsize, job.args.minage, job.args.maxage)
+    if rules or any(limit is not None for limit in limits):
+        try:
+            job.filter_rules = FilterRules(job, rules, *limits)
+        except re.error as e:
+            logger.critical("Invalid filter rule ({}). Aborting".format(e))
+            return 1
+        logger.debug("Filtering with {} rules".format(len(rules)))
 
     # Get archive path
-    archive_path = os.path.join(dest_path, args.archivepath)
+    job.archive_path = os.path.join(dest_path, job.args.archivepath)
     # Create the archive folder if using archive mode and it doesn't exist
-    if args.conflictmode == 1 and not os.path.exists(archive_path):
-        logger.debug("{}Archive path does not exist, creating it...".format(sim_text()))
-        if not args.simulate:
+    if job.args.conflictmode == 1 and not job.args.snapshot and not job.filesystem.exists(job.archive_path):
+        logger.debug("{}Archive path does not exist, creating it...".format(sim_text(job)))
+        if not job.args.simulate:
             try:
-                os.makedirs(archive_path)
-                info_data['folders']['num_created'] += 1
+                job.filesystem.makedirs(job.archive_path)
+                job.info_data['folders']['num_created'] += 1
             except PermissionError:
                 logger.critical("Cannot create archive folder, access denied. Aborting")
                 return 1
         else:  # Simulate only
-            info_data['folders']['num_created'] += 1
+            job.info_data['folders']['num_created'] += 1
+
+    # When making snapshots, the new snapshot is compared against the previous one in place of the destination
+    job.snapshot_store = None
+    job.compare_path = dest_path
+    if job.args.snapshot:
+        job.snapshot_store = SnapshotStore(job, dest_path)
+        if not job.args.simulate:
+            job.snapshot_store.start()
+        job.compare_path = job.snapshot_store.previous_path
+        logger.debug("{}Making snapshot '{}' based on '{}'".format(sim_text(job), job.snapshot_store.name,
+                                                                   job.compare_path))
+
+    # Keep a journal of the run so it can be resumed if interrupted. Snapshots are only kept once complete anyway
+    job.journal = None
+    interrupted = False
+    if job.args.journal and job.snapshot_store is None and not job.args.simulate and job.filesystem.local:
+        job.journal = Journal(job, dest_path)
+        try:
+            job.journal.open(source_path, resume=job.args.resume)
+            interrupted = job.journal.interrupted
+        except (OSError, sqlite3.DatabaseError) as e:
+            logger.warning("Cannot keep a journal, this run won't be resumable ({})".format(e))
+            job.journal = None
+    # The journal of an interrupted run isn't resumed without --journal. It is removed, so that a later run with
+    # --journal doesn't skip folders that have changed since
+    elif not job.args.simulate and job.filesystem.local and os.path.exists(os.path.join(dest_path, JOURNAL_NAME)):
+        logger.info("Not resuming the interrupted run without --journal, starting over")
+        os.remove(os.path.join(dest_path, JOURNAL_NAME))
+        interrupted = True
+
+    # Use the manifest from the last run in place of scanning the destination, unless asked to verify the destination.
+    # An interrupted run changed the destination since the manifest was written, so it is scanned instead. Record a
+    # new manifest as this run goes
+    if job.snapshot_store is not None:
+        job.manifest = Manifest(job.compare_path, job.snapshot_store.previous_manifest_path,
+                                job.snapshot_store.manifest_path(job.snapshot_store.name))
+    else:
+        job.manifest = Manifest(dest_path)
+    if interrupted:
+        logger.debug("Last run was interrupted, scanning the destination instead of using the manifest")
+    elif not job.args.verify_dest and job.filesystem.local and job.manifest.open_previous():
+        logger.debug("Using destination manifest: '{}'".format(job.manifest.path))
+    if not job.args.simulate and job.filesystem.local:
+        job.manifest.start()
+
+    # Open the pack files if packing small files. The pack index is also read without packing so that files packed by
+    # earlier runs are still known about
+    job.pack_store = None
+    if job.args.pack or (job.filesystem.local and os.path.exists(os.path.join(dest_path, PACK_NAME, 'index.db'))):
+        # Only this destination keeps packing. The options are shared with the other batch jobs
+        if not job.args.pack:
+            logger.warning("Destination has packed files, continuing to pack small files")
+        try:
+            job.pack_store = PackStore(dest_path, writable=not job.args.simulate)
+        except (OSError, sqlite3.DatabaseError) as e:
+            logger.critical("Cannot open pack files ({}). Aborting".format(e))
+            return 1
+
+    # Create the trash folder if deleted conflicts are to be moved there and purged at the end. Trash left behind by an
+    # interrupted run is purged first, so that nothing left in it can be in the way of the items trashed by this run
+    job.trash_path = None
+    if job.args.trash and job.args.conflictmode == 2 and not job.args.snapshot and not job.args.simulate:
+        job.trash_path = os.path.join(dest_path, TRASH_NAME)
+        try:
+            if os.path.isdir(job.trash_path):
+                purge_trash(job, job.trash_path)
+            os.makedirs(job.trash_path, exist_ok=True)
+        except OSError as e:
+            logger.warning("Cannot create trash folder, deleting conflicts directly ({})".format(e))
+            job.trash_path = None
 
-    status = copy_folder(source_path, dest_path, archive_path, current_folder='', depth=0)
+    # Open the hash cache if comparing file contents or hashing them for the snapshot object store
+    if (job.args.copymode == 3 or job.args.snapshot) and job.args.hashcachesize > 0 and job.filesystem.local:
+        hash_cache_path = job.args.hashcache
+        if hash_cache_path is None:
+            cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            hash_cache_path = os.path.join(cache_dir, 'sibackup', 'hashes.db')
+        try:
+            job.hash_cache = HashCache(job, os.path.abspath(hash_cache_path), job.args.hashcachesize)
+            logger.debug("Using hash cache: '{}'".format(job.hash_cache.path))
+        except (OSError, sqlite3.DatabaseError) as e:
+            logger.warning("Cannot open hash cache, file contents will always be read ({})".format(e))
+
+    # Collect detailed timings if profiling
+    job.profiler = Profiler(job.args.profileslowest) if job.args.profile else None
+
+    # Collect the files to read back once the backup is done if verifying. Nothing is written when simulating
+    if job.args.verify is not None and not job.args.simulate:
+        job.verifier = Verifier(job.args.verify, job.args.verifypercent)
+
+    # Limit the rate of I/O to the destination if asked to
+    job.throttle = None
+    if job.args.bwlimit is not None or job.args.iopslimit is not None:
+        job.throttle = Throttle(job, job.args.bwlimit, job.args.iopslimit, job.args.limitschedule, job.args.adaptive)
+        logger.debug("Limiting I/O to {}/s and {} operations/s".format(
+            format_data_size(job.args.bwlimit) if job.args.bwlimit is not None else "unlimited",
+            job.args.iopslimit if job.args.iopslimit is not None else "unlimited"))
+    elif job.args.adaptive or job.args.limitschedule is not None:
+        logger.warning("No I/O limits are set with --bwlimit or --iopslimit, so I/O will not be throttled")
+
+    return 0
+
+
+def abandon_destination(job):
+    """
+    Close the destination of a backup that was stopped early, keeping its journal to resume from. The new manifest is
+    thrown away, and what was packed is kept, since the files written so far are in the pack files either way
+    """
+    job.verifier = None
+    job.trash_path = None
+    job.snapshot_store = None
+    if job.journal is not None:
+        job.journal.abandon()
+        job.journal = None
+        logger.info("The next run will resume from the last checkpoint")
+    if job.manifest is not None:
+        job.manifest.finish(success=False)
+    if job.pack_store is not None:
+        job.pack_store.close()
+        job.pack_store = None
+    if job.hash_cache is not None:
+        job.hash_cache.close(save=False)
+        job.hash_cache = None
+
+
+def finish_destination(job, status, num_mismatched):
+    """
+    Close the destination of a backup once the source has been walked, keeping what the run recorded if it succeeded,
+    then log the summary of the backup. Returns the status code of the backup to the destination
+    """
+    dest_path = job.dest_path
+    # Empty the trash now that copying is done. Trash left behind by an interrupted run is purged as well
+    if not job.args.simulate and job.filesystem.local and os.path.isdir(os.path.join(dest_path, TRASH_NAME)):
+        purge_trash(job, os.path.join(dest_path, TRASH_NAME))
+    job.trash_path = None
+    # Keep the new manifest only if the whole destination was processed. A resumed run skips the folders that were
+    # already completed, so its manifest is incomplete and the next run scans the destination instead. Files that
+    # failed verification were removed after being recorded, so neither manifest can be trusted then either
+    if (job.journal is not None and job.journal.completed) or num_mismatched != 0:
+        job.manifest.finish(success=False)
+        if os.path.exists(job.manifest.path):
+            os.remove(job.manifest.path)
+    else:
+        job.manifest.finish(success=status == 0)
+    if job.journal is not None:
+        job.journal.finish(success=status == 0)
+        job.journal = None
+    if job.pack_store is not None:
+        job.pack_store.close()
+        job.pack_store = None
+    if job.snapshot_store is not None:
+        if not job.args.simulate:
+            job.snapshot_store.finish(success=status == 0)
+        job.snapshot_store = None
+    if job.hash_cache is not None:
+        job.hash_cache.close(save=not job.args.simulate)
+        job.hash_cache = None
 
-    if status is not 0:
+    if status != 0:
         logger.critical("Process aborted")
+    elif num_mismatched != 0:
+        logger.error("Process complete, but {} files did not match their source when verified. They will be copied "
+                     "again on the next run".format(num_mismatched))
+        status = 1
     else:
         logger.info("Process complete")
 
     # Record how long it took the whole process to finish
-    total_time_spent = timer.elapsed()
+    total_time_spent = job.timer.elapsed()
 
     # -----------------------
     # - Information logging -
     # -----------------------
     logger.info("-"*16)
-    logger.info("Processed {} files".format(info_data['files']['num_processed']))
+    logger.info("Processed {} files".format(job.info_data['files']['num_processed']))
 
-    total_files_copied_or_skipped = info_data['files']['num_copied'] + info_data['files']['num_skipped']
-    total_data_copied_or_skipped = info_data['files']['size_copied'] + info_data['files']['size_skipped']
+    total_files_copied_or_skipped = job.info_data['files']['num_copied'] + job.info_data['files']['num_skipped']
+    total_data_copied_or_skipped = job.info_data['files']['size_copied'] + job.info_data['files']['size_skipped']
 
     # Files copied
-    if info_data['files']['num_copied'] is not 0:
+    if job.info_data['files']['num_copied'] != 0:
         logger.info("{}Copied {} in {} files ({:.2f}% of total data, {:.2f}% of total files, {} average size)".format(
-            sim_text(),
-            format_data_size(info_data['files']['size_copied']),
-            info_data['files']['num_copied'],
-            100 * (info_data['files']['size_copied'] / total_data_copied_or_skipped),
-            100 * (info_data['files']['num_copied'] / total_files_copied_or_skipped),
-            format_data_size(info_data['files']['size_copied'] / info_data['files']['num_copied']),
+            sim_text(job),
+            format_data_size(job.info_data['files']['size_copied']),
+            job.info_data['files']['num_copied'],
+            100 * (job.info_data['files']['size_copied'] / total_data_copied_or_skipped),
+            100 * (job.info_data['files']['num_copied'] / total_files_copied_or_skipped),
+            format_data_size(job.info_data['files']['size_copied'] / job.info_data['files']['num_copied']),
         ))
     # Files skipped
-    if info_data['files']['num_skipped'] is not 0:
+    if job.info_data['files']['num_skipped'] != 0:
         logger.info("{}Skipped {} in {} files ({:.2f}% of total data, {:.2f}% of total files, {} average size)".format(
-            sim_text(),
-            format_data_size(info_data['files']['size_skipped']),
-            info_data['files']['num_skipped'],
-            100 * (info_data['files']['size_skipped'] / total_data_copied_or_skipped),
-            100 * (info_data['files']['num_skipped'] / total_files_copied_or_skipped),
-            format_data_size(info_data['files']['size_skipped'] / info_data['files']['num_skipped']),
+            sim_text(job),
+            format_data_size(job.info_data['files']['size_skipped']),
+            job.info_data['files']['num_skipped'],
+            100 * (job.info_data['files']['size_skipped'] / total_data_copied_or_skipped),
+            100 * (job.info_data['files']['num_skipped'] / total_files_copied_or_skipped),
+            format_data_size(job.info_data['files']['size_skipped'] / job.info_data['files']['num_skipped']),
+        ))
+    # Items left out by the filter rules
+    if job.info_data['files']['num_filtered'] + job.info_data['folders']['num_filtered'] != 0:
+        logger.info("Filtered out {} files and {} folders ({} in files left out by size or age)".format(
+            job.info_data['files']['num_filtered'],
+            job.info_data['folders']['num_filtered'],
+            format_data_size(job.info_data['files']['size_filtered']),
+        ))
+    # Copy strategies used
+    if sum(job.info_data['copy_strategies'].values()) != 0:
+        logger.info("Copy strategies used: {}".format(", ".join(
+            "{} {}".format(name, count) for name, count in job.info_data['copy_strategies'].items() if count != 0
+        )))
+    # Data actually written when delta copying
+    if job.info_data['files']['num_delta_copied'] != 0:
+        logger.info("Wrote {} to update {} copied ({:.2f}%, {} files delta copied)".format(
+            format_data_size(job.info_data['files']['size_written']),
+            format_data_size(job.info_data['files']['size_copied']),
+            100 * (job.info_data['files']['size_written'] / job.info_data['files']['size_copied']),
+            job.info_data['files']['num_delta_copied'],
+        ))
+    # Small files packed
+    if job.info_data['files']['num_packed'] != 0:
+        logger.info("{}Packed {} in {} small files".format(
+            sim_text(job),
+            format_data_size(job.info_data['files']['size_packed']),
+            job.info_data['files']['num_packed'],
+        ))
+    # Compression
+    if job.info_data['compression']['num_compressed'] != 0:
+        logger.info("Compressed {} in {} files to {} ({:.2f}% of original size, {} of CPU time, {} files not worth "
+                    "compressing)".format(
+                        format_data_size(job.info_data['compression']['size_original']),
+                        job.info_data['compression']['num_compressed'],
+                        format_data_size(job.info_data['compression']['size_compressed']),
+                        100 * (job.info_data['compression']['size_compressed'] /
+                               max(job.info_data['compression']['size_original'], 1)),
+                        Timer.format_time(job.info_data['compression']['cpu_time']),
+                        job.info_data['compression']['num_incompressible'],
+                    ))
+    # Files linked and deduplicated into a snapshot
+    if job.info_data['files']['num_linked'] != 0 or job.info_data['files']['num_deduplicated'] != 0:
+        logger.info("Linked {} unchanged files from the previous snapshot, {} new files ({}) were already "
+                    "stored".format(
+            job.info_data['files']['num_linked'],
+            job.info_data['files']['num_deduplicated'],
+            format_data_size(job.info_data['files']['size_deduplicated']),
         ))
     # Files not copied due to errors
-    if info_data['files']['not_copied'] is not 0:
+    if job.info_data['files']['not_copied'] != 0:
         logger.info("{}{} files not copied due to errors".format(
-            sim_text(),
-            info_data['files']['not_copied'],
+            sim_text(job),
+            job.info_data['files']['not_copied'],
         ))
 
     # Folders created
-    if info_data['folders']['num_created'] is not 0:
+    if job.info_data['folders']['num_created'] != 0:
         logger.info("{}Created {} folders".format(
-            sim_text(),
-            info_data['folders']['num_created'],
+            sim_text(job),
+            job.info_data['folders']['num_created'],
         ))
 
-    if info_data['misc']['conflicts_resolved'] is not 0:
+    if job.info_data['misc']['conflicts_resolved'] != 0:
         logger.info("{}{} conflicts {}".format(
-            sim_text(),
-            info_data['misc']['conflicts_resolved'],
-            conflict_text(present_tense=False),
+            sim_text(job),
+            job.info_data['misc']['conflicts_resolved'],
+            conflict_text(job, present_tense=False),
         ))
 
     # Total time spent
     logger.info("Finished in {}".format(Timer.format_time(total_time_spent)))
     # Time spent copying
-    if info_data['time_spent']['copying'] is not 0:
+    if job.info_data['time_spent']['copying'] != 0:
         logger.info("Spent {} copying files ({:.2f}% of total time)".format(
-            Timer.format_time(info_data['time_spent']['copying']),
-            100 * (info_data['time_spent']['copying'] / total_time_spent)
+            Timer.format_time(job.info_data['time_spent']['copying']),
+            100 * (job.info_data['time_spent']['copying'] / total_time_spent)
         ))
     # Time spent resolving conflicts
-    if info_data['time_spent']['resolving'] is not 0:
+    if job.info_data['time_spent']['resolving'] != 0:
         logger.info("Spent {} {} files ({:.2f}% of total time)".format(
-            Timer.format_time(info_data['time_spent']['resolving']),
-            conflict_text(present_tense=True),
-            100 * (info_data['time_spent']['resolving'] / total_time_spent)
+            Timer.format_time(job.info_data['time_spent']['resolving']),
+            conflict_text(job, present_tense=True),
+            100 * (job.info_data['time_spent']['resolving'] / total_time_spent)
         ))
     # Time spent scanning directories
-    if info_data['time_spent']['scanning'] is not 0:
+    if job.info_data['time_spent']['scanning'] != 0:
         logger.info("Spent {} scanning directories ({:.2f}% of total time)".format(
-            Timer.format_time(info_data['time_spent']['scanning']),
-            100 * (info_data['time_spent']['scanning'] / total_time_spent)
+            Timer.format_time(job.info_data['time_spent']['scanning']),
+            100 * (job.info_data['time_spent']['scanning'] / total_time_spent)
         ))
     # Time spent checking file stats
-    if info_data['time_spent']['stats'] is not 0:
+    if job.info_data['time_spent']['stats'] != 0:
         logger.info("Spent {} checking file stats ({:.2f}% of total time)".format(
-            Timer.format_time(info_data['time_spent']['stats']),
-            100 * (info_data['time_spent']['stats'] / total_time_spent)
+            Timer.format_time(job.info_data['time_spent']['stats']),
+            100 * (job.info_data['time_spent']['stats'] / total_time_spent)
+        ))
+    # Time spent deciding which files to copy
+    if job.info_data['time_spent']['deciding'] != 0:
+        logger.info("Spent {} deciding which files to copy ({:.2f}% of total time)".format(
+            Timer.format_time(job.info_data['time_spent']['deciding']),
+            100 * (job.info_data['time_spent']['deciding'] / total_time_spent)
         ))
     # Time spent hashing
-    if info_data['time_spent']['hashing'] is not 0:
-        logger.info("Spent {} hashing files ({:.2f}% of total time)".format(
-            Timer.format_time(info_data['time_spent']['hashing']),
-            100 * (info_data['time_spent']['hashing'] / total_time_spent)
+    if job.info_data['time_spent']['hashing'] != 0:
+        logger.info("Spent {} hashing files ({:.2f}% of total time, {} read from {} files)".format(
+            Timer.format_time(job.info_data['time_spent']['hashing']),
+            100 * (job.info_data['time_spent']['hashing'] / total_time_spent),
+            format_data_size(job.info_data['misc']['data_hashed']),
+            job.info_data['misc']['hashes_made'],
+        ))
+    # Time spent waiting on the I/O limits
+    if job.info_data['time_spent']['throttled'] != 0:
+        logger.info("Spent {} waiting on the I/O limits, across all threads ({} times backed off)".format(
+            Timer.format_time(job.info_data['time_spent']['throttled']),
+            job.info_data['misc']['throttle_backoffs'],
+        ))
+    # Files read back to verify them
+    if job.info_data['verify']['num_verified'] + job.info_data['verify']['num_failed'] != 0:
+        logger.info("Verified {} files in {} ({} read, {}/s): {}{}".format(
+            job.info_data['verify']['num_verified'],
+            Timer.format_time(job.info_data['time_spent']['verifying']),
+            format_data_size(job.info_data['verify']['size_verified']),
+            format_data_size(job.info_data['verify']['size_verified'] / max(job.info_data['time_spent']['verifying'],
+                                                                        PROFILE_MIN_LATENCY)),
+            "all match" if job.info_data['verify']['num_failed'] == 0 else
+            "{} did not match".format(job.info_data['verify']['num_failed']),
+            "" if job.info_data['verify']['num_changed'] == 0 else
+            ", {} not verified as their source changed".format(job.info_data['verify']['num_changed']),
+        ))
+    # Time spent making journal checkpoints
+    if job.info_data['misc']['checkpoints'] != 0:
+        logger.info("Spent {} making {} journal checkpoints ({:.2f}% of total time)".format(
+            Timer.format_time(job.info_data['time_spent']['checkpointing']),
+            job.info_data['misc']['checkpoints'],
+            100 * (job.info_data['time_spent']['checkpointing'] / total_time_spent),
+        ))
+    # Hash cache usage
+    hash_cache_lookups = job.info_data['misc']['hash_cache_hits'] + job.info_data['misc']['hash_cache_misses']
+    if hash_cache_lookups != 0:
+        logger.info("Hash cache: {} hits, {} misses ({:.2f}% hit rate)".format(
+            job.info_data['misc']['hash_cache_hits'],
+            job.info_data['misc']['hash_cache_misses'],
+            100 * (job.info_data['misc']['hash_cache_hits'] / hash_cache_lookups),
         ))
 
+    # Detailed timings
+    if job.profiler is not None:
+        job.profiler.log_report(job.info_data, total_time_spent)
+        job.profiler = None
+
     logger.info("-"*16)
 
     return status
 
 
-if __name__ == '__main__':
-    # Setup the arguments used by the program
+def build_parser():
+    """Setup the arguments used by the program"""
     parser = argparse.ArgumentParser(description="Description")
     # Positional
-    parser.add_argument('source', type=str,
-                        help="Source folder where files will be copied from")
-    parser.add_argument('destination', type=str,
-                        help="Destination folder where files will be copied to")
+    parser.add_argument('source', type=str, nargs='?',
+                        help="Source folder where files will be copied from. Can be left out when using --batch.")
+    parser.add_argument('destination', type=str, nargs='*',
+                        help="Destination folder where files will be copied to. Several destinations can be given, "
+                             "and the source is read once for all of them. Can be left out when using --batch.")
     # Optional
     parser.add_argument('-d', '--depth', type=int, default=None,
                         help="Limit the number of subfolders to copy. '0' will copy only files in the source folder, "
@@ -558,17 +4839,154 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--copymode', type=int, default=2,
                         help="How to check if a file should be copied. Checks are done in order, and break when one "
                              "succeeds. '3' will check modified date first, then file size if dates are the same, "
-                             "then file hashes if sizes are the same. [0: Always copy, 1: Check modified date, "
-                             "2: Check file size, 3: Compare file hash (NOT IMPLEMENTED)]")
+                             "then file contents if sizes are the same. [0: Always copy, 1: Check modified date, "
+                             "2: Check file size, 3: Compare file contents]")
     parser.add_argument('-M', '--conflictmode', type=int, default=2,
                         help="How to handle conflicts in the destination folder. [0: Do nothing, 1: Move the file to "
                              "the archive folder, 2: Delete the file]")
+    parser.add_argument('--trash', action='store_true',
+                        help="When deleting conflicts, move them to a trash folder in the destination instead, and "
+                             "delete the trash once copying is done. Keeps large deletions from holding up copying.")
     parser.add_argument('-a', '--archivepath', type=str, default='!!archive',
                         help="Folder to use for archiving if enabled. Path will be relative to the destination "
                              "folder, but an absolute path will also work.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of files to copy at the same time. '1' copies files one at a time.")
+    parser.add_argument('--delta', action='store_true',
+                        help="Update large files that already exist in the destination in place, only rewriting the "
+                             "parts that changed.")
+    parser.add_argument('--pack', action='store_true',
+                        help="Store files smaller than --packthreshold in a few large pack files in the destination "
+                             "instead of one destination file each. Use --restore to get the files back out.")
+    parser.add_argument('--packthreshold', type=int, default=4096,
+                        help="Size in bytes below which files are packed when --pack is used")
+    parser.add_argument('--compress', type=str, default=None, choices=list(COMPRESSION_CODECS),
+                        help="Compress copied files with this codec, on the copy workers. Files that are already "
+                             "compressed are stored as they are. 'zstd' needs the zstandard module.")
+    parser.add_argument('--compresslevel', type=int, default=None,
+                        help="Compression level to use. Defaults to the codec's usual default.")
+    parser.add_argument('--restore', action='store_true',
+                        help="Restore a backup made with --pack or --compress: the source is the backup and the "
+                             "destination is the folder to restore it to")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="Make a new dated snapshot of the source in the destination on each run, instead of "
+                             "keeping a single mirror. Unchanged files are hardlinked from the previous snapshot, and "
+                             "file contents are stored once no matter how many snapshots or files have them.")
+    parser.add_argument('--keepsnapshots', type=int, default=None,
+                        help="Number of snapshots to keep when using --snapshot. Older snapshots are removed, along "
+                             "with contents no longer used by any snapshot. Keeps all snapshots if not given.")
+    parser.add_argument('--copystrategy', type=str, default='auto',
+                        choices=['auto', 'reflink', 'copy_file_range', 'sendfile', 'userspace'],
+                        help="How to copy file contents. 'auto' tries a reflink clone, then copy_file_range, then "
+                             "sendfile, then a userspace copy, using the first one that works for each file. Any "
+                             "other choice falls back to a userspace copy if it doesn't work.")
+    parser.add_argument('--copybuffer', type=parse_data_size, default=None,
+                        help="Size of the buffer that large files are copied through when copied in userspace, e.g. "
+                             "'16M'. Defaults to the size found by --calibrate for the folders, or else {}.".format(
+                                 format_data_size(COPY_LARGE_BUFFER_SIZE)))
+    parser.add_argument('--calibrate', action='store_true',
+                        help="Instead of backing up, time copying a large file of the source to the destination with "
+                             "each copy strategy and buffer size, and save the fastest for later backups between the "
+                             "two folders")
+    parser.add_argument('--calibrationfile', type=str, default=None,
+                        help="File the settings found by --calibrate are saved to and read from. Defaults to a file in "
+                             "the user's config folder.")
+    parser.add_argument('--hashcache', type=str, default=None,
+                        help="File used to cache file digests between runs for copymode 3. Defaults to a file in the "
+                             "user's cache folder.")
+    parser.add_argument('--hashcachesize', type=int, default=1000000,
+                        help="Maximum number of files kept in the hash cache. '0' disables the cache.")
+    parser.add_argument('--verify-dest', action='store_true',
+                        help="Scan the destination folder instead of trusting the manifest written by the last run. "
+                             "Use if the destination may have been changed by something other than this program.")
+    parser.add_argument('--verify', type=str, default=None, choices=['full', 'sample', 'changed'],
+                        help="After the backup, read files back from the destination and compare their digests with "
+                             "the source, to catch copies corrupted on the way to storage. 'full' checks every file, "
+                             "'sample' a random --verifypercent of them, and 'changed' only the files copied by this "
+                             "run. Files are checked on --workers threads. Files that don't match are removed so the "
+                             "next run copies them again, and the run fails.")
+    parser.add_argument('--verifypercent', type=float, default=10,
+                        help="Percentage of files checked by --verify sample")
+    parser.add_argument('-S', '--scanners', type=int, default=1,
+                        help="Number of folders to scan at the same time, ahead of processing them. Helps on network "
+                             "filesystems where listing a folder is slow. '1' scans folders one at a time.")
+    parser.add_argument('--watch', action='store_true',
+                        help="After copying, keep running and copy changes in the source as they happen, until "
+                             "interrupted. Uses inotify where available, or else checks the source for changes every "
+                             "--watchinterval seconds.")
+    parser.add_argument('--watchdelay', type=float, default=2,
+                        help="Seconds to wait for changes to settle before syncing them in watch mode")
+    parser.add_argument('--watchinterval', type=float, default=30,
+                        help="Seconds between checks for changes in watch mode when inotify can't be used")
+    parser.add_argument('--journal', action='store_true',
+                        help="Keep a journal of the run's progress in the destination, so that the next run resumes "
+                             "where this one left off if it is interrupted. Costs a flush of the destination to disk "
+                             "at every checkpoint.")
+    parser.add_argument('--noresume', dest='resume', action='store_false',
+                        help="Start over instead of resuming when the last --journal run was interrupted")
+    parser.add_argument('--checkpointinterval', type=float, default=10,
+                        help="Seconds between journal checkpoints. Each checkpoint waits for queued copies and flushes "
+                             "the destination to disk, so an interrupted run loses at most this much progress.")
+    parser.add_argument('--batch', type=str, default=None,
+                        help="File listing more backups to run, one per line: a source followed by its destinations. "
+                             "They run one after another in this process with the same options, sharing the copy "
+                             "workers and folder scanners, so a cron job backing up many folders starts only once.")
     parser.add_argument('-s', '--simulate', action='store_true',
                         help="Simulate copying the folder without actually doing anything. Useful for debugging or "
                              "estimating how much will be copied.")
+    # Filtering
+    filter_group = parser.add_argument_group('filtering', 'Options related to leaving items out of the backup')
+    filter_group.add_argument('--exclude', type=str, action='append', default=None,
+                              help="Leave out items matching this gitignore-style pattern, e.g. 'node_modules/' or "
+                                   "'*.tmp'. Excluded folders are not scanned at all. Can be given more than once.")
+    filter_group.add_argument('--include', type=str, action='append', default=None,
+                              help="Keep items matching this pattern even if an exclude matches them. Can be given "
+                                   "more than once.")
+    filter_group.add_argument('--excludefrom', type=str, action='append', default=None,
+                              help="Read rules from a gitignore-style file, with '!' before patterns to include. Can "
+                                   "be given more than once.")
+    filter_group.add_argument('--minsize', type=parse_data_size, default=None,
+                              help="Leave out files smaller than this, e.g. '1K'")
+    filter_group.add_argument('--maxsize', type=parse_data_size, default=None,
+                              help="Leave out files larger than this, e.g. '2G'")
+    filter_group.add_argument('--minage', type=parse_duration, default=None,
+                              help="Leave out files modified more recently than this, e.g. '10m', '12h' or '30d'")
+    filter_group.add_argument('--maxage', type=parse_duration, default=None,
+                              help="Leave out files last modified longer ago than this, e.g. '1w' or '365d'")
+    # Throttling
+    throttle_group = parser.add_argument_group('throttling', 'Options related to limiting the rate of I/O')
+    throttle_group.add_argument('--bwlimit', type=parse_data_size, default=None,
+                                help="Limit the data read and written to this much per second, e.g. '20M'")
+    throttle_group.add_argument('--iopslimit', type=float, default=None,
+                                help="Limit the number of I/O operations (folder listings and blocks read or "
+                                     "written) per second")
+    throttle_group.add_argument('--limitschedule', type=parse_schedule, default=None,
+                                help="Only apply the limits at these times of day, e.g. '08:00-12:00,13:00-18:00'. "
+                                     "Windows may wrap past midnight. Limits always apply if not given.")
+    throttle_group.add_argument('--adaptive', action='store_true',
+                                help="Lower the limits while I/O is slower than usual, e.g. because other programs "
+                                     "are using the disk or network, and raise them again once it recovers")
+    # Progress and metrics
+    progress_group = parser.add_argument_group('progress', 'Options related to progress and metrics reporting')
+    progress_group.add_argument('--progress', type=float, default=None,
+                                help="Log the progress of the run every this many seconds")
+    progress_group.add_argument('--precount', action='store_true',
+                                help="Count the files in the source before starting, so progress can include the "
+                                     "amount left and an ETA")
+    progress_group.add_argument('--profile', action='store_true',
+                                help="Show detailed timings at the end: time spent in each phase, copy latency "
+                                     "percentiles by file size, and the slowest folders and files")
+    progress_group.add_argument('--profileslowest', type=int, default=10,
+                                help="Number of slowest folders and files to show with --profile")
+    progress_group.add_argument('--profileout', type=str, default=None,
+                                help="Profile the run with cProfile and save the results to this file, for pstats "
+                                     "or another profile viewer. Only the main thread is profiled, so use "
+                                     "--workers 1 to include the copies.")
+    progress_group.add_argument('--report', type=str, default=None,
+                                help="File to write the counters of the run to once it is finished")
+    progress_group.add_argument('--reportformat', type=str, default='json', choices=['json', 'prometheus'],
+                                help="Format of the report file. 'prometheus' writes the text format read by the "
+                                     "node exporter's textfile collector")
     # Logging
     logging_group = parser.add_argument_group('logging', 'Options related to the output log')
     logging_group.add_argument('--loglevel', type=str, default="INFO",
@@ -579,6 +4997,12 @@ if __name__ == '__main__':
                                help="File writing mode. 'a' to append onto the existing log, 'w' to overwrite each "
                                     "time the program is run")
 
+    return parser
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+
     # Parse the arguments provided by the user
     args = parser.parse_args()
 
@@ -608,16 +5032,12 @@ if __name__ == '__main__':
 
     # logging.basicConfig(**logger_config)
 
-    logger = logging.getLogger(__name__)
-
     logger.debug("------------------------")
     logger.debug("- Application starting -")
     logger.debug("------------------------")
 
-    timer = Timer()
-
     try:
-        application_status = sibackup()
+        application_status = sibackup(args)
     except KeyboardInterrupt:
         logger.info("Process cancelled by user, exiting...")
         application_status = 130
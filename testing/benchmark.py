@@ -0,0 +1,163 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sibackup
+
+"""
+Benchmarks sibackup on synthetic trees. Each run generates a tree from a preset, then backs it up in several scenarios:
+a full copy to an empty destination, a no-op run where nothing changed, an incremental run after a share of the files
+were changed and deleted, and a simulated run after another round of changes. One JSON object is written per scenario,
+holding the wall clock time and the full info_data counters (including the time_spent categories), so runs of
+different versions can be compared for regressions.
+"""
+
+# Shapes of the trees that can be generated. A tree has 'depth' levels of 'width' subfolders per folder, with 'files'
+# files of between 'min_size' and 'max_size' bytes in each folder, plus 'huge_files' files of 'huge_size' bytes in the
+# root folder
+TREE_PRESETS = {
+    'tiny': {'depth': 2, 'width': 10, 'files': 100, 'min_size': 0, 'max_size': 4096, 'huge_files': 0,
+             'huge_size': 0},
+    'huge': {'depth': 0, 'width': 0, 'files': 0, 'min_size': 0, 'max_size': 0, 'huge_files': 4,
+             'huge_size': 268435456},
+    'deep': {'depth': 200, 'width': 1, 'files': 5, 'min_size': 0, 'max_size': 16384, 'huge_files': 0,
+             'huge_size': 0},
+    'wide': {'depth': 1, 'width': 2000, 'files': 10, 'min_size': 0, 'max_size': 16384, 'huge_files': 0,
+             'huge_size': 0},
+    'mixed': {'depth': 3, 'width': 6, 'files': 40, 'min_size': 0, 'max_size': 262144, 'huge_files': 2,
+              'huge_size': 67108864},
+}
+
+# Block size used to write generated file contents
+WRITE_CHUNK_SIZE = 1048576
+
+
+def write_random_file(path_name, size, rng):
+    """Write a file of the given size filled with random data"""
+    with open(path_name, 'wb') as file:
+        while size > 0:
+            chunk_size = min(size, WRITE_CHUNK_SIZE)
+            file.write(rng.randbytes(chunk_size))
+            size -= chunk_size
+
+
+def make_tree(root, preset, rng):
+    """Generate a tree shaped by a preset in the root folder"""
+    pending_folders = [(root, 0)]
+    while pending_folders:
+        folder_path, level = pending_folders.pop()
+        for i in range(preset['files']):
+            write_random_file(os.path.join(folder_path, 'f{}'.format(i)),
+                              rng.randint(preset['min_size'], preset['max_size']), rng)
+        if level < preset['depth']:
+            for i in range(preset['width']):
+                subfolder_path = os.path.join(folder_path, 'd{}'.format(i))
+                os.mkdir(subfolder_path)
+                pending_folders.append((subfolder_path, level + 1))
+    for i in range(preset['huge_files']):
+        write_random_file(os.path.join(root, 'huge{}'.format(i)), preset['huge_size'], rng)
+
+
+def change_tree(root, changed_percent, deleted_percent, rng):
+    """Rewrite and delete a share of the files in a tree. Returns the number of files changed and deleted"""
+    file_paths = sorted(os.path.join(folder_path, name)
+                        for folder_path, _, names in os.walk(root) for name in names)
+    rng.shuffle(file_paths)
+    num_changed = len(file_paths) * changed_percent // 100
+    num_deleted = len(file_paths) * deleted_percent // 100
+    for path_name in file_paths[:num_changed]:
+        write_random_file(path_name, os.path.getsize(path_name), rng)
+    for path_name in file_paths[num_changed:num_changed + num_deleted]:
+        os.remove(path_name)
+    return num_changed, num_deleted
+
+
+def run_backup(source_path, dest_path, extra_args):
+    """Run a backup in this process. Returns the status, the elapsed time and the counters of the backup"""
+    backup_args = sibackup.build_parser().parse_args([source_path, dest_path] + extra_args)
+    start_time = time.perf_counter()
+    status, results = sibackup.run_backups(backup_args, sibackup.LocalFileSystem())
+    return status, time.perf_counter() - start_time, results[0]['info_data']
+
+
+def benchmark(preset_name, args, rng, temp_path, run):
+    """Run every scenario once on a newly generated tree, writing one result per scenario"""
+    source_path = os.path.join(temp_path, 'source')
+    dest_path = os.path.join(temp_path, 'backup')
+    os.mkdir(source_path)
+    make_tree(source_path, TREE_PRESETS[preset_name], rng)
+    # Keep the hash cache with the benchmark so copymode 3 runs don't depend on earlier ones
+    extra_args = ['--loglevel', 'WARNING', '--hashcache', os.path.join(temp_path, 'hashes.db')] + args.extra
+
+    for scenario in ['full', 'noop', 'incremental', 'simulate']:
+        num_changed = num_deleted = 0
+        scenario_args = extra_args
+        if scenario in ('incremental', 'simulate'):
+            num_changed, num_deleted = change_tree(source_path, args.changed, args.deleted, rng)
+        if scenario == 'simulate':
+            scenario_args = extra_args + ['--simulate']
+        status, elapsed_time, info_data = run_backup(source_path, dest_path, scenario_args)
+        result = {
+            'tree': preset_name,
+            'run': run,
+            'scenario': scenario,
+            'status': status,
+            'elapsed': elapsed_time,
+            'files_changed': num_changed,
+            'files_deleted': num_deleted,
+            'args': args.extra,
+            'info_data': info_data,
+        }
+        args.output.write(json.dumps(result, sort_keys=True) + '\n')
+        args.output.flush()
+
+    shutil.rmtree(source_path)
+    shutil.rmtree(dest_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark sibackup on synthetic trees",
+                                     epilog="Options after '--' are passed on to sibackup, e.g. '-- --workers 4 -m 3'")
+    parser.add_argument('trees', type=str, nargs='*', default=['tiny', 'mixed'],
+                        help="Tree presets to benchmark. One or more of ({})".format(', '.join(TREE_PRESETS)))
+    parser.add_argument('--changed', type=int, default=10,
+                        help="Percentage of files rewritten before the incremental and simulated runs")
+    parser.add_argument('--deleted', type=int, default=5,
+                        help="Percentage of files deleted before the incremental and simulated runs")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Number of times to run each tree")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed for generating trees and changes, so runs are reproducible")
+    parser.add_argument('--tempdir', type=str, default=None,
+                        help="Folder to generate trees in. Defaults to the system temp folder.")
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help="File to write results to, one JSON object per line. Defaults to stdout.")
+
+    # Split off the options meant for sibackup
+    argv = sys.argv[1:]
+    extra_argv = []
+    if '--' in argv:
+        extra_argv = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    args.extra = extra_argv
+
+    for preset_name in args.trees:
+        if preset_name not in TREE_PRESETS:
+            parser.error("Unknown tree preset '{}'".format(preset_name))
+
+    logging.basicConfig(level=logging.WARNING, format=sibackup.LOG_FORMAT)
+    sibackup.logger = logging.getLogger('sibackup')
+
+    for preset_name in args.trees:
+        for run in range(args.repeat):
+            rng = random.Random('{}:{}:{}'.format(args.seed, preset_name, run))
+            with tempfile.TemporaryDirectory(dir=args.tempdir) as temp_path:
+                benchmark(preset_name, args, rng, temp_path, run)
@@ -0,0 +1,66 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sibackup
+
+"""
+Measures how sibackup copes with a slow filesystem, without needing one. A tree is generated in memory, then backed up
+through a filesystem that waits before every call, with each combination of workers and scanners. Both a full copy and
+a no-op run where nothing changed are timed.
+"""
+
+
+def make_tree(file_system, root, depth, width, files_per_folder, file_size):
+    """Create a tree of 'depth' levels of 'width' subfolders, each holding a few files"""
+    pending_folders = [(root, 0)]
+    file_system.makedirs(root)
+    while pending_folders:
+        folder_path, level = pending_folders.pop()
+        for i in range(files_per_folder):
+            with file_system.open(os.path.join(folder_path, 'f{}'.format(i)), 'wb') as file:
+                file.write(b'x' * file_size)
+        if level < depth:
+            for i in range(width):
+                subfolder_path = os.path.join(folder_path, 'd{}'.format(i))
+                file_system.mkdir(subfolder_path)
+                pending_folders.append((subfolder_path, level + 1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark sibackup on a simulated high latency filesystem")
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help="Seconds each filesystem call takes")
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help="Bytes per second that file contents are read and written at. Unlimited by default.")
+    parser.add_argument('--depth', type=int, default=2,
+                        help="Number of levels of subfolders in the tree")
+    parser.add_argument('--width', type=int, default=5,
+                        help="Number of subfolders in each folder")
+    parser.add_argument('--files', type=int, default=10,
+                        help="Number of files in each folder")
+    parser.add_argument('--size', type=int, default=4096,
+                        help="Size of each file in bytes")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16],
+                        help="Numbers of copy workers to try")
+    parser.add_argument('--scanners', type=int, nargs='+', default=[1, 4],
+                        help="Numbers of folder scanners to try")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format=sibackup.LOG_FORMAT)
+
+    for workers in args.workers:
+        for scanners in args.scanners:
+            memory = sibackup.MemoryFileSystem()
+            make_tree(memory, '/source', args.depth, args.width, args.files, args.size)
+            file_system = sibackup.LatencyFileSystem(memory, args.latency, args.bandwidth)
+            for scenario in ['full', 'noop']:
+                start_time = time.perf_counter()
+                stats = sibackup.Backup('/source', '/backup', filesystem=file_system, workers=workers,
+                                        scanners=scanners).run()
+                elapsed_time = time.perf_counter() - start_time
+                print("workers={} scanners={} scenario={} status={} copied={} time={:.2f}s".format(
+                    workers, scanners, scenario, stats.status, stats.info_data['files']['num_copied'], elapsed_time))
@@ -0,0 +1,76 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Measures the peak memory used by sibackup when walking synthetic deep and wide trees. The backup is simulated, so only
+the walk itself (scanning, stats and copy decisions) is measured.
+"""
+
+SIBACKUP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sibackup.py')
+
+
+def make_deep_tree(root, depth, files_per_folder):
+    """Create a single chain of nested folders, each holding a few files"""
+    current_path = root
+    for level in range(depth):
+        current_path = os.path.join(current_path, 'd')
+        os.mkdir(current_path)
+        for i in range(files_per_folder):
+            with open(os.path.join(current_path, 'f{}'.format(i)), 'w') as file:
+                file.write('x')
+
+
+def remove_deep_tree(root, depth):
+    """Remove a deep tree from the bottom up, since shutil.rmtree recurses and can't remove it either"""
+    for level in range(depth, 0, -1):
+        current_path = os.path.join(root, *(['d'] * level))
+        for name in os.listdir(current_path):
+            os.remove(os.path.join(current_path, name))
+        os.rmdir(current_path)
+
+
+def make_wide_tree(root, width, files_per_folder):
+    """Create a single level of many folders, each holding many files"""
+    for folder in range(width):
+        folder_path = os.path.join(root, 'w{}'.format(folder))
+        os.mkdir(folder_path)
+        for i in range(files_per_folder):
+            with open(os.path.join(folder_path, 'f{}'.format(i)), 'w') as file:
+                file.write('x')
+
+
+def measure(source_path, dest_path):
+    """Simulate a backup of the source folder in a child process. Returns (status, seconds, peak RSS in KB)"""
+    start_time = time.perf_counter()
+    process = subprocess.Popen([sys.executable, SIBACKUP_PATH, source_path, dest_path, '-s', '--loglevel', 'WARNING'])
+    # Wait with wait4() to get the resource usage of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed_time = time.perf_counter() - start_time
+    return process.returncode, elapsed_time, usage.ru_maxrss
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure sibackup memory use on deep and wide trees")
+    parser.add_argument('--depth', type=int, default=1500,
+                        help="Number of nested folders in the deep tree (more than the default recursion limit)")
+    parser.add_argument('--width', type=int, default=500,
+                        help="Number of folders in the wide tree")
+    parser.add_argument('--files', type=int, default=200,
+                        help="Number of files in each folder of the wide tree")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        for name, make_tree, size, files in [('deep', make_deep_tree, args.depth, 2),
+                                             ('wide', make_wide_tree, args.width, args.files)]:
+            source_path = os.path.join(temp_path, name)
+            os.mkdir(source_path)
+            make_tree(source_path, size, files)
+            status, elapsed_time, peak = measure(source_path, os.path.join(temp_path, name + '_backup'))
+            print("{}: size={} files_per_folder={} status={} time={:.2f}s peak_rss={}KB".format(
+                name, size, files, status, elapsed_time, peak))
+        remove_deep_tree(os.path.join(temp_path, 'deep'), args.depth)
@@ -0,0 +1,82 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Measures how long sibackup takes to start, which matters most when it is run often from cron on trees where little
+has changed. The time to show the help and to back up a tiny tree that is already up to date are compared against a
+budget, on top of the time the interpreter itself takes to start. Running many small jobs as separate invocations is
+also compared with running them as one --batch invocation.
+"""
+
+SIBACKUP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sibackup.py')
+
+# Seconds sibackup may take to start on top of the interpreter, before it is considered a regression
+STARTUP_BUDGET = 0.15
+
+
+def time_command(command, runs):
+    """Run a command several times. Returns the median number of seconds it took"""
+    elapsed_times = []
+    for run in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed_times.append(time.perf_counter() - start_time)
+    return statistics.median(elapsed_times)
+
+
+def make_jobs(root, num_jobs):
+    """Create a tiny source tree for each job and a batch file listing them. Returns the jobs and the batch file path"""
+    jobs = []
+    for job in range(num_jobs):
+        source_path = os.path.join(root, 'source{}'.format(job))
+        os.mkdir(source_path)
+        for i in range(3):
+            with open(os.path.join(source_path, 'f{}'.format(i)), 'w') as file:
+                file.write('x')
+        jobs.append((source_path, os.path.join(root, 'backup{}'.format(job))))
+    batch_path = os.path.join(root, 'jobs.txt')
+    with open(batch_path, 'w') as batch_file:
+        for source_path, dest_path in jobs:
+            batch_file.write('"{}" "{}"\n'.format(source_path, dest_path))
+    return jobs, batch_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure how long sibackup takes to start")
+    parser.add_argument('--runs', type=int, default=10,
+                        help="Number of times to run each command. The median time is reported.")
+    parser.add_argument('--jobs', type=int, default=20,
+                        help="Number of tiny jobs to compare separate invocations with --batch on")
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET,
+                        help="Seconds sibackup may take to start on top of the interpreter")
+    args = parser.parse_args()
+
+    quiet = ['--loglevel', 'WARNING']
+    with tempfile.TemporaryDirectory() as temp_path:
+        jobs, batch_path = make_jobs(temp_path, args.jobs)
+        # Back everything up once so the timed runs have nothing to do
+        subprocess.run([sys.executable, SIBACKUP_PATH, '--batch', batch_path] + quiet, check=True)
+
+        interpreter_time = time_command([sys.executable, '-c', 'pass'], args.runs)
+        help_time = time_command([sys.executable, SIBACKUP_PATH, '--help'], args.runs)
+        noop_time = time_command([sys.executable, SIBACKUP_PATH, jobs[0][0], jobs[0][1]] + quiet, args.runs)
+        separate_time = sum(time_command([sys.executable, SIBACKUP_PATH, source_path, dest_path] + quiet, 1)
+                            for source_path, dest_path in jobs)
+        batch_time = time_command([sys.executable, SIBACKUP_PATH, '--batch', batch_path] + quiet, 1)
+
+    print("interpreter: {:.1f}ms".format(interpreter_time * 1000))
+    print("help: {:.1f}ms ({:.1f}ms over the interpreter)".format(help_time * 1000,
+                                                                   (help_time - interpreter_time) * 1000))
+    print("noop: {:.1f}ms ({:.1f}ms over the interpreter)".format(noop_time * 1000,
+                                                                   (noop_time - interpreter_time) * 1000))
+    print("{} jobs: {:.1f}ms as separate runs, {:.1f}ms with --batch".format(args.jobs, separate_time * 1000,
+                                                                             batch_time * 1000))
+    startup_time = noop_time - interpreter_time
+    if startup_time > args.budget:
+        print("Over the startup budget of {:.1f}ms".format(args.budget * 1000))
+        sys.exit(1)
@@ -1,2 +1,800 @@
+import errno
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sibackup
+
+"""
+Behaviour tests for sibackup, run through the Backup API. Most tests back up a tree held in a MemoryFileSystem, so they
+don't need a disk. Features that only work on local files, such as those keeping files of their own in the destination,
+are tested in temporary folders. Run with 'python testing/test.py'.
+"""
+
+# Modified time given to files whose times matter to a test, in seconds
+OLD_MTIME = 1000000000
+
+
+def write_file(file_system, path_name, data, mtime=None):
+    """Write a file through a filesystem backend, then set its modified time if one is given"""
+    with file_system.open(path_name, 'wb') as file:
+        file.write(data)
+    if mtime is not None:
+        if isinstance(file_system, sibackup.MemoryFileSystem):
+            file_system.utime(path_name, (mtime, mtime))
+        else:
+            os.utime(path_name, (mtime, mtime))
+
+
+def read_file(file_system, path_name):
+    """Return the contents of a file read through a filesystem backend"""
+    with file_system.open(path_name, 'rb') as file:
+        return file.read()
+
+
+def tree_contents(path):
+    """Return a dict mapping the path of each file in a local folder, relative to the folder, to its contents"""
+    contents = {}
+    for folder_path, _, names in os.walk(path):
+        for name in names:
+            path_name = os.path.join(folder_path, name)
+            with open(path_name, 'rb') as file:
+                contents[os.path.relpath(path_name, path)] = file.read()
+    return contents
+
+
+class MemoryBackupTest(unittest.TestCase):
+    """Base for tests backing up '/source' to '/backup' in a MemoryFileSystem"""
+    def setUp(self):
+        self.file_system = sibackup.MemoryFileSystem()
+        self.file_system.makedirs('/source/folder')
+        write_file(self.file_system, '/source/file', b'file', OLD_MTIME)
+        write_file(self.file_system, '/source/folder/nested', b'nested', OLD_MTIME)
+
+    def backup(self, **options):
+        """Back up the source with the given options. Returns the counters, after checking the backup succeeded"""
+        stats = sibackup.Backup('/source', '/backup', filesystem=self.file_system, **options).run()
+        self.assertEqual(stats.status, 0)
+        return stats.info_data
+
+    def read(self, path_name):
+        return read_file(self.file_system, path_name)
+
+
+class CopyTest(MemoryBackupTest):
+    def test_copies_tree(self):
+        info_data = self.backup(workers=4, scanners=2)
+        self.assertEqual(info_data['files']['num_copied'], 2)
+        self.assertEqual(self.read('/backup/file'), b'file')
+        self.assertEqual(self.read('/backup/folder/nested'), b'nested')
+        self.assertEqual(self.file_system.stat('/backup/file').st_mtime, OLD_MTIME)
+
+    def test_skips_unchanged_files(self):
+        self.backup()
+        info_data = self.backup()
+        self.assertEqual(info_data['files']['num_copied'], 0)
+        self.assertEqual(info_data['files']['num_skipped'], 2)
+
+    def test_depth_limit(self):
+        self.backup(depth=0)
+        self.assertTrue(self.file_system.exists('/backup/file'))
+        self.assertFalse(self.file_system.exists('/backup/folder'))
+
+    def test_simulate_writes_nothing(self):
+        info_data = self.backup(simulate=True)
+        self.assertEqual(info_data['files']['num_copied'], 2)
+        self.assertFalse(self.file_system.exists('/backup/file'))
+
+
+class CopyModeTest(MemoryBackupTest):
+    """Each copy mode adds a check to those of the modes below it, and copies a file when any of its checks differ"""
+    def change_source(self, data, mtime):
+        self.backup()
+        write_file(self.file_system, '/source/file', data, mtime)
+
+    def assertCopied(self, copymode, copied):
+        info_data = self.backup(copymode=copymode)
+        self.assertEqual(info_data['files']['num_copied'], 1 if copied else 0)
+        self.assertEqual(self.read('/backup/file') == self.read('/source/file'), copied)
+
+    def test_mode_0_always_copies(self):
+        self.backup()
+        info_data = self.backup(copymode=0)
+        self.assertEqual(info_data['files']['num_copied'], 2)
+
+    def test_mode_1_copies_on_modified_time(self):
+        self.change_source(b'newer', OLD_MTIME + 10)
+        self.assertCopied(1, True)
+
+    def test_mode_1_ignores_size(self):
+        self.change_source(b'longer file', OLD_MTIME)
+        self.assertCopied(1, False)
+
+    def test_mode_2_copies_on_size(self):
+        self.change_source(b'longer file', OLD_MTIME)
+        self.assertCopied(2, True)
+
+    def test_mode_2_ignores_contents(self):
+        self.change_source(b'FILE', OLD_MTIME)
+        self.assertCopied(2, False)
+
+    def test_mode_3_copies_on_contents(self):
+        self.change_source(b'FILE', OLD_MTIME)
+        self.assertCopied(3, True)
+
+    def test_mode_3_skips_same_contents(self):
+        self.backup()
+        info_data = self.backup(copymode=3)
+        self.assertEqual(info_data['files']['num_copied'], 0)
+        self.assertEqual(info_data['files']['num_skipped'], 2)
+
+
+class ConflictTest(MemoryBackupTest):
+    """Items in the destination that are not in the source are conflicts"""
+    def setUp(self):
+        super().setUp()
+        self.backup()
+        write_file(self.file_system, '/backup/extra', b'extra')
+        self.file_system.makedirs('/backup/folder/extra_folder')
+        write_file(self.file_system, '/backup/folder/extra_folder/inside', b'inside')
+
+    def test_mode_0_leaves_conflicts(self):
+        info_data = self.backup(conflictmode=0)
+        self.assertEqual(info_data['misc']['conflicts_resolved'], 2)
+        self.assertTrue(self.file_system.exists('/backup/extra'))
+        self.assertTrue(self.file_system.exists('/backup/folder/extra_folder/inside'))
+
+    def test_mode_1_archives_conflicts(self):
+        info_data = self.backup(conflictmode=1, workers=4)
+        self.assertEqual(info_data['misc']['conflicts_resolved'], 2)
+        self.assertFalse(self.file_system.exists('/backup/extra'))
+        self.assertFalse(self.file_system.exists('/backup/folder/extra_folder'))
+        self.assertEqual(self.read('/backup/!!archive/extra'), b'extra')
+        self.assertEqual(self.read('/backup/!!archive/folder/extra_folder/inside'), b'inside')
+        # The archive itself is not a conflict on the next run
+        self.backup(conflictmode=1)
+        self.assertTrue(self.file_system.exists('/backup/!!archive/extra'))
+
+    def test_mode_2_deletes_conflicts(self):
+        info_data = self.backup(conflictmode=2, workers=4)
+        self.assertEqual(info_data['misc']['conflicts_resolved'], 2)
+        self.assertFalse(self.file_system.exists('/backup/extra'))
+        self.assertFalse(self.file_system.exists('/backup/folder/extra_folder'))
+        self.assertEqual(self.read('/backup/folder/nested'), b'nested')
+
+    def test_simulate_deletes_nothing(self):
+        self.backup(conflictmode=2, simulate=True)
+        self.assertTrue(self.file_system.exists('/backup/extra'))
+        self.assertTrue(self.file_system.exists('/backup/folder/extra_folder/inside'))
+
+
+class FilterTest(MemoryBackupTest):
+    def setUp(self):
+        super().setUp()
+        self.file_system.makedirs('/source/cache')
+        write_file(self.file_system, '/source/cache/entry', b'entry')
+        write_file(self.file_system, '/source/scratch.tmp', b'scratch')
+        write_file(self.file_system, '/source/keep.tmp', b'keep')
+
+    def test_exclude_single_pattern(self):
+        # A single string is one rule, not a rule per character
+        info_data = self.backup(exclude='*.tmp')
+        self.assertEqual(info_data['files']['num_filtered'], 2)
+        self.assertTrue(self.file_system.exists('/backup/file'))
+        self.assertFalse(self.file_system.exists('/backup/scratch.tmp'))
+
+    def test_exclude_folder_and_include_exception(self):
+        self.backup(exclude=['*.tmp', 'cache/'], include=['keep.tmp'])
+        self.assertFalse(self.file_system.exists('/backup/cache'))
+        self.assertFalse(self.file_system.exists('/backup/scratch.tmp'))
+        self.assertEqual(self.read('/backup/keep.tmp'), b'keep')
+        self.assertEqual(self.read('/backup/folder/nested'), b'nested')
+
+    def test_size_filters(self):
+        self.backup(minsize=5, maxsize='6')
+        self.assertEqual(sorted(entry.name for entry in self.file_system.scandir('/backup')), ['cache', 'folder'])
+        self.assertTrue(self.file_system.exists('/backup/cache/entry'))
+        self.assertTrue(self.file_system.exists('/backup/folder/nested'))
+
+    def test_excluded_items_are_not_conflicts(self):
+        self.backup()
+        self.backup(exclude=['*.tmp', 'cache/'], conflictmode=2)
+        self.assertTrue(self.file_system.exists('/backup/scratch.tmp'))
+        self.assertTrue(self.file_system.exists('/backup/cache/entry'))
+
+
+class LocalBackupTest(unittest.TestCase):
+    """Base for tests backing up a source folder to a backup folder in a temporary folder"""
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_path)
+        self.source_path = os.path.join(self.temp_path, 'source')
+        self.backup_path = os.path.join(self.temp_path, 'backup')
+        self.file_system = sibackup.LocalFileSystem()
+        os.makedirs(os.path.join(self.source_path, 'folder'))
+        for name in ['a', 'b', os.path.join('folder', 'c')]:
+            write_file(self.file_system, os.path.join(self.source_path, name), name.encode() * 100, OLD_MTIME)
+
+    def backup(self, status=0, **options):
+        """Back up the source with the given options. Returns the counters, after checking the status of the backup"""
+        stats = sibackup.Backup(self.source_path, self.backup_path, **options).run()
+        self.assertEqual(stats.status, status)
+        return stats.info_data
+
+    def restore(self, **options):
+        """Restore the backup to a new folder. Returns the path of the folder"""
+        restore_path = os.path.join(self.temp_path, 'restored')
+        if os.path.exists(restore_path):
+            shutil.rmtree(restore_path)
+        stats = sibackup.Backup(self.backup_path, restore_path, restore=True, **options).run()
+        self.assertEqual(stats.status, 0)
+        return restore_path
+
+    def read(self, name):
+        return read_file(self.file_system, os.path.join(self.backup_path, name))
+
+
+class OptionTest(unittest.TestCase):
+    def test_strings_are_parsed(self):
+        config = sibackup.Backup('/source', '/backup', bwlimit='20M', workers='4', exclude='*.tmp').config
+        self.assertEqual(config.bwlimit, 20971520)
+        self.assertEqual(config.workers, 4)
+        self.assertEqual(config.exclude, ['*.tmp'])
+
+    def test_invalid_options(self):
+        for options, error in [({'bogus': 1}, TypeError), ({'exclude': 5}, TypeError), ({'simulate': 'yes'}, TypeError),
+                               ({'workers': 2.5}, TypeError), ({'verify': 'everything'}, ValueError),
+                               ({'bwlimit': 'lots'}, ValueError)]:
+            with self.subTest(options=options):
+                with self.assertRaises(error):
+                    sibackup.Backup('/source', '/backup', **options)
+
+
+class ConcurrentTest(unittest.TestCase):
+    def test_jobs_on_separate_threads(self):
+        file_systems = [sibackup.MemoryFileSystem(), sibackup.MemoryFileSystem()]
+        for count, file_system in enumerate(file_systems, 2):
+            file_system.makedirs('/source')
+            for index in range(count):
+                write_file(file_system, '/source/file{}'.format(index), str(index).encode() * count)
+        # Each job waits in its first copy until the other job is copying too, so both are in the middle of a run
+        barrier = threading.Barrier(2, timeout=10)
+        waiting_jobs = set()
+        copy_file_data = sibackup.copy_file_data
+
+        def waiting_copy_file_data(job, *args):
+            if job not in waiting_jobs:
+                waiting_jobs.add(job)
+                barrier.wait()
+            return copy_file_data(job, *args)
+
+        results = [None, None]
+
+        def run(index):
+            backup = sibackup.Backup('/source', '/backup', filesystem=file_systems[index], workers=1)
+            results[index] = backup.run()
+
+        with mock.patch.object(sibackup, 'copy_file_data', waiting_copy_file_data):
+            threads = [threading.Thread(target=run, args=(index,)) for index in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        for count, file_system, stats in zip([2, 3], file_systems, results):
+            self.assertEqual(stats.status, 0)
+            self.assertEqual(stats.info_data['files']['num_copied'], count)
+            self.assertEqual(read_file(file_system, '/backup/file1'), b'1' * count)
+        self.assertFalse(file_systems[0].exists('/backup/file2'))
+
+
+class FanOutTest(MemoryBackupTest):
+    def fan_out(self, status=0, **options):
+        """Back up the source to '/backup' and '/other' together. Returns the counters of each destination"""
+        stats = sibackup.Backup('/source', ['/backup', '/other'], filesystem=self.file_system, **options).run()
+        self.assertEqual(stats.status, status)
+        self.assertEqual([result['destination'] for result in stats.results], ['/backup', '/other'])
+        return [result['info_data'] for result in stats.results]
+
+    def test_source_is_read_once(self):
+        source_calls = []
+        open_file, scandir = self.file_system.open, self.file_system.scandir
+
+        def counting_open(path, mode):
+            if path.startswith('/source'):
+                source_calls.append(('open', path))
+            return open_file(path, mode)
+
+        def counting_scandir(path):
+            if path.startswith('/source'):
+                source_calls.append(('scandir', os.path.normpath(path)))
+            return scandir(path)
+
+        with mock.patch.object(self.file_system, 'open', counting_open), \
+                mock.patch.object(self.file_system, 'scandir', counting_scandir):
+            counters = self.fan_out(workers=2, scanners=2)
+        self.assertEqual(sorted(source_calls), [('open', '/source/file'), ('open', '/source/folder/nested'),
+                                                ('scandir', '/source'), ('scandir', '/source/folder')])
+        for dest_path, info_data in zip(['/backup', '/other'], counters):
+            self.assertEqual(info_data['files']['num_copied'], 2)
+            self.assertEqual(self.read(dest_path + '/folder/nested'), b'nested')
+            self.assertEqual(self.file_system.stat(dest_path + '/file').st_mtime, OLD_MTIME)
+
+    def test_each_destination_decides_for_itself(self):
+        self.backup()
+        self.file_system.makedirs('/other')
+        write_file(self.file_system, '/other/extra', b'extra')
+        first, second = self.fan_out(conflictmode=2)
+        self.assertEqual(first['files']['num_copied'], 0)
+        self.assertEqual(first['files']['num_skipped'], 2)
+        self.assertEqual(first['misc']['conflicts_resolved'], 0)
+        self.assertEqual(second['files']['num_copied'], 2)
+        self.assertEqual(second['misc']['conflicts_resolved'], 1)
+        self.assertFalse(self.file_system.exists('/other/extra'))
+
+    def test_failing_destination_does_not_stop_the_others(self):
+        open_file = self.file_system.open
+
+        def failing_open(path, mode):
+            if mode == 'wb' and path.startswith('/other/folder/'):
+                raise PermissionError(errno.EACCES, "Permission denied", path)
+            return open_file(path, mode)
+
+        with mock.patch.object(self.file_system, 'open', failing_open), self.assertLogs('sibackup', logging.WARNING):
+            first, second = self.fan_out()
+        self.assertEqual(first['files']['num_copied'], 2)
+        self.assertEqual(second['files']['num_copied'], 1)
+        self.assertEqual(second['files']['not_copied'], 1)
+        self.assertEqual(self.read('/backup/folder/nested'), b'nested')
+        self.assertEqual(self.file_system.scandir('/other/folder'), [])
+
+    def test_single_destination_features_are_refused(self):
+        with self.assertLogs('sibackup', logging.CRITICAL):
+            self.fan_out(status=1, pack=True)
+        self.assertFalse(self.file_system.exists('/backup'))
+
+
+class ManifestTest(LocalBackupTest):
+    def test_manifest_is_used_in_place_of_the_destination(self):
+        self.backup()
+        self.assertTrue(os.path.exists(os.path.join(self.backup_path, sibackup.MANIFEST_NAME)))
+        # The manifest still lists the file, so it isn't copied again
+        os.remove(os.path.join(self.backup_path, 'a'))
+        info_data = self.backup()
+        self.assertEqual(info_data['files']['num_copied'], 0)
+        self.assertFalse(os.path.exists(os.path.join(self.backup_path, 'a')))
+        # Checking the destination itself finds it missing
+        info_data = self.backup(verify_dest=True)
+        self.assertEqual(info_data['files']['num_copied'], 1)
+        self.assertEqual(self.read('a'), b'a' * 100)
+
+    def test_manifest_follows_changes(self):
+        self.backup()
+        write_file(self.file_system, os.path.join(self.source_path, 'a'), b'changed', OLD_MTIME + 10)
+        os.remove(os.path.join(self.source_path, 'b'))
+        self.backup()
+        info_data = self.backup()
+        self.assertEqual(info_data['files']['num_copied'], 0)
+        self.assertEqual(info_data['files']['num_skipped'], 2)
+        self.assertEqual(self.read('a'), b'changed')
+        self.assertFalse(os.path.exists(os.path.join(self.backup_path, 'b')))
+
+
+class ReportTest(LocalBackupTest):
+    def setUp(self):
+        super().setUp()
+        self.report_path = os.path.join(self.temp_path, 'report')
+
+    def test_json_report(self):
+        self.backup(report=self.report_path)
+        with open(self.report_path, encoding='utf8') as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report['source'], self.source_path)
+        self.assertEqual(report['destination'], self.backup_path)
+        self.assertEqual(report['status'], 0)
+        self.assertFalse(report['simulate'])
+        self.assertEqual(report['info_data']['files']['num_copied'], 3)
+        self.assertEqual(report['info_data']['files']['size_copied'], 1000)
+
+    def test_prometheus_report(self):
+        self.backup(report=self.report_path, reportformat='prometheus')
+        with open(self.report_path, encoding='utf8') as report_file:
+            lines = report_file.read().splitlines()
+        labels = '{{source="{}",destination="{}"}}'.format(self.source_path, self.backup_path)
+        self.assertIn('sibackup_status{} 0'.format(labels), lines)
+        self.assertIn('sibackup_files_num_copied{} 3'.format(labels), lines)
+        self.assertIn('sibackup_files_size_copied{} 1000'.format(labels), lines)
+        self.assertTrue(all(line.startswith('sibackup_') and labels in line for line in lines))
+        self.assertFalse(os.path.exists(self.report_path + '.tmp'))
+
+    def test_one_report_per_destination(self):
+        other_path = os.path.join(self.temp_path, 'other')
+        sibackup.Backup(self.source_path, [self.backup_path, other_path], report=self.report_path).run()
+        with open(self.report_path, encoding='utf8') as report_file:
+            reports = json.load(report_file)
+        self.assertEqual([report['destination'] for report in reports], [self.backup_path, other_path])
+        self.assertEqual([report['info_data']['files']['num_copied'] for report in reports], [3, 3])
+
+
+class TrashTest(LocalBackupTest):
+    def test_leftover_trash_does_not_block_deletes(self):
+        self.backup()
+        # Trash left behind by an interrupted run, named like the items trashed by another run
+        trash_path = os.path.join(self.backup_path, sibackup.TRASH_NAME)
+        for name in ['0', '1', '{}.0'.format(os.getpid())]:
+            os.makedirs(os.path.join(trash_path, name, 'inside'))
+        os.makedirs(os.path.join(self.backup_path, 'extra_folder'))
+        write_file(self.file_system, os.path.join(self.backup_path, 'extra'), b'extra')
+        # The manifest doesn't know about the conflicts, so check the destination itself
+        info_data = self.backup(trash=True, verify_dest=True)
+        self.assertEqual(info_data['misc']['conflicts_resolved'], 2)
+        self.assertEqual(sorted(os.listdir(self.backup_path)), sorted([sibackup.MANIFEST_NAME, 'a', 'b', 'folder']))
+
+
+class SnapshotTest(LocalBackupTest):
+    def test_snapshots_hold_the_source(self):
+        self.backup(snapshot=True)
+        write_file(self.file_system, os.path.join(self.source_path, 'a'), b'changed', OLD_MTIME + 10)
+        self.backup(snapshot=True)
+        snapshots_path = os.path.join(self.backup_path, sibackup.SNAPSHOTS_NAME)
+        first, second = sorted(name for name in os.listdir(snapshots_path) if not name.startswith('.'))
+        # Nothing but the files of the source is in a snapshot
+        self.assertEqual(sorted(os.listdir(os.path.join(snapshots_path, second))), ['a', 'b', 'folder'])
+        self.assertEqual(self.read(os.path.join(sibackup.SNAPSHOTS_NAME, first, 'a')), b'a' * 100)
+        self.assertEqual(self.read(os.path.join(sibackup.SNAPSHOTS_NAME, second, 'a')), b'changed')
+        # Unchanged files are linked from the previous snapshot
+        self.assertTrue(os.path.samefile(os.path.join(snapshots_path, first, 'b'),
+                                         os.path.join(snapshots_path, second, 'b')))
+
+
+class HashCacheTest(LocalBackupTest):
+    def test_rerun_uses_cached_digests(self):
+        hash_cache_path = os.path.join(self.temp_path, 'hashes.db')
+        self.backup(copymode=3, hashcache=hash_cache_path)
+        # The first comparison reads both files and caches their digests
+        info_data = self.backup(copymode=3, hashcache=hash_cache_path)
+        self.assertEqual(info_data['misc']['hash_cache_misses'], 6)
+        self.assertEqual(info_data['misc']['data_hashed'], 2000)
+        # Nothing changed since, so nothing is read again
+        info_data = self.backup(copymode=3, hashcache=hash_cache_path)
+        self.assertEqual(info_data['misc']['hash_cache_hits'], 6)
+        self.assertEqual(info_data['misc']['data_hashed'], 0)
+        self.assertEqual(info_data['files']['num_skipped'], 3)
+
+    def test_changed_file_is_not_taken_from_the_cache(self):
+        hash_cache_path = os.path.join(self.temp_path, 'hashes.db')
+        self.backup(copymode=3, hashcache=hash_cache_path)
+        self.backup(copymode=3, hashcache=hash_cache_path)
+        # Same size and modified time, but other contents
+        write_file(self.file_system, os.path.join(self.source_path, 'a'), b'A' * 100, OLD_MTIME)
+        info_data = self.backup(copymode=3, hashcache=hash_cache_path)
+        self.assertEqual(info_data['files']['num_copied'], 1)
+        self.assertEqual(self.read('a'), b'A' * 100)
+
+    def test_without_cache(self):
+        self.backup()
+        write_file(self.file_system, os.path.join(self.source_path, 'a'), b'A' * 100, OLD_MTIME)
+        info_data = self.backup(copymode=3, hashcachesize=0)
+        self.assertEqual(info_data['misc']['hash_cache_hits'] + info_data['misc']['hash_cache_misses'], 0)
+        self.assertEqual(info_data['files']['num_copied'], 1)
+        self.assertEqual(info_data['files']['num_skipped'], 2)
+
+
+
+class DeltaTest(LocalBackupTest):
+    def setUp(self):
+        super().setUp()
+        # A file large enough to be delta copied, of distinct blocks
+        self.large_path = os.path.join(self.source_path, 'large')
+        self.block_size = sibackup.COMPARE_CHUNK_SIZE
+        self.num_blocks = sibackup.DELTA_MIN_SIZE // self.block_size + 1
+        write_file(self.file_system, self.large_path,
+                   b''.join(bytes([index]) * self.block_size for index in range(self.num_blocks)), OLD_MTIME)
+        self.backup()
+
+    def change_blocks(self, blocks):
+        """Change a byte in each of the given blocks of the large file"""
+        with open(self.large_path, 'r+b') as large_file:
+            for block in blocks:
+                large_file.seek(block * self.block_size + 10)
+                large_file.write(b'X')
+        os.utime(self.large_path, (OLD_MTIME + 10, OLD_MTIME + 10))
+
+    def test_only_changed_blocks_are_written(self):
+        self.change_blocks([3, 7])
+        info_data = self.backup(delta=True)
+        self.assertEqual(info_data['files']['num_delta_copied'], 1)
+        self.assertEqual(info_data['files']['size_written'], 2 * self.block_size)
+        self.assertEqual(self.read('large'), read_file(self.file_system, self.large_path))
+        self.assertEqual(os.stat(os.path.join(self.backup_path, 'large')).st_mtime, OLD_MTIME + 10)
+
+    def test_mostly_changed_file_is_written_in_full(self):
+        self.change_blocks(range(self.num_blocks))
+        info_data = self.backup(delta=True)
+        self.assertEqual(info_data['files']['size_written'], self.num_blocks * self.block_size)
+        self.assertEqual(self.read('large'), read_file(self.file_system, self.large_path))
+
+    def test_shorter_file_is_truncated(self):
+        with open(self.large_path, 'r+b') as large_file:
+            large_file.truncate((self.num_blocks - 1) * self.block_size + 5)
+        os.utime(self.large_path, (OLD_MTIME + 10, OLD_MTIME + 10))
+        info_data = self.backup(delta=True)
+        self.assertEqual(info_data['files']['size_written'], 5)
+        self.assertEqual(self.read('large'), read_file(self.file_system, self.large_path))
+
+
+class CopyStrategyTest(LocalBackupTest):
+    def write_source(self, name, size):
+        write_file(self.file_system, os.path.join(self.source_path, name), os.urandom(size), OLD_MTIME)
+
+    def test_small_files_are_copied_in_one_go(self):
+        info_data = self.backup()
+        self.assertEqual(info_data['copy_strategies']['userspace'], 3)
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), "needs sendfile()")
+    def test_larger_files_are_copied_by_the_kernel(self):
+        self.write_source('larger', sibackup.COPY_SMALL_SIZE * 4)
+        info_data = self.backup()
+        self.assertEqual(info_data['copy_strategies']['userspace'], 3)
+        self.assertEqual(sum(info_data['copy_strategies'].values()), 4)
+        self.assertEqual(self.read('larger'), read_file(self.file_system, os.path.join(self.source_path, 'larger')))
+
+    def test_unsupported_strategy_falls_back(self):
+        self.write_source('larger', sibackup.COPY_SMALL_SIZE * 4)
+        self.write_source('other', sibackup.COPY_SMALL_SIZE * 4)
+        attempts = []
+
+        def unsupported(job, source_file, dest_file, size):
+            attempts.append(size)
+            dest_file.write(b'partial')
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        strategies = [('reflink', unsupported), ('userspace', sibackup.copy_with_userspace)]
+        with mock.patch.object(sibackup, 'COPY_STRATEGIES', strategies), \
+                mock.patch.object(sibackup, 'unsupported_copy_strategies', set()):
+            info_data = self.backup()
+        # The strategy is only tried once between the same two filesystems
+        self.assertEqual(len(attempts), 1)
+        self.assertEqual(info_data['copy_strategies']['userspace'], 5)
+        self.assertEqual(self.read('larger'), read_file(self.file_system, os.path.join(self.source_path, 'larger')))
+        self.assertEqual(self.read('other'), read_file(self.file_system, os.path.join(self.source_path, 'other')))
+
+    def test_large_files_use_the_copy_buffer(self):
+        self.write_source('large', sibackup.COPY_LARGE_SIZE + 5)
+        info_data = self.backup(copystrategy='userspace', copybuffer='2M')
+        self.assertEqual(info_data['copy_strategies']['userspace'], 4)
+        self.assertEqual(self.read('large'), read_file(self.file_system, os.path.join(self.source_path, 'large')))
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), "needs sendfile()")
+    def test_calibrated_strategy_is_used_for_small_files(self):
+        calibration_path = os.path.join(self.temp_path, 'calibration.json')
+        with open(calibration_path, 'w') as calibration_file:
+            json.dump({'{} -> {}'.format(self.source_path, self.backup_path): {'strategy': 'sendfile',
+                                                                                 'buffer_size': 1048576}},
+                      calibration_file)
+        info_data = self.backup(calibrationfile=calibration_path)
+        self.assertEqual(info_data['copy_strategies']['sendfile'], 3)
+        self.assertEqual(self.read('a'), b'a' * 100)
+
+
+class RestoreTest(LocalBackupTest):
+    def test_packed_files_are_restored(self):
+        self.backup(pack=True)
+        self.assertFalse(os.path.exists(os.path.join(self.backup_path, 'a')))
+        self.assertEqual(tree_contents(self.restore()), tree_contents(self.source_path))
+
+    def test_only_the_source_is_restored(self):
+        os.makedirs(os.path.join(self.backup_path, 'folder'))
+        write_file(self.file_system, os.path.join(self.backup_path, 'folder', 'old'), b'old')
+        self.backup(pack=True, conflictmode=1)
+        self.assertTrue(os.path.exists(os.path.join(self.backup_path, '!!archive', 'folder', 'old')))
+        # A temp file left behind by a copy that never finished
+        write_file(self.file_system, os.path.join(self.backup_path, 'folder', sibackup.TEMP_PREFIX + '1.0'), b'half')
+        self.assertEqual(tree_contents(self.restore()), tree_contents(self.source_path))
+
+
+class CompressTest(LocalBackupTest):
+    def test_round_trip(self):
+        for codec in ['zlib', 'lzma']:
+            with self.subTest(codec=codec):
+                shutil.rmtree(self.backup_path, ignore_errors=True)
+                info_data = self.backup(compress=codec)
+                self.assertEqual(info_data['compression']['num_compressed'], 3)
+                self.assertEqual(sorted(os.listdir(self.backup_path)),
+                                 sorted([sibackup.MANIFEST_NAME, 'a' + sibackup.COMPRESSED_SUFFIX,
+                                         'b' + sibackup.COMPRESSED_SUFFIX, 'folder']))
+                self.assertLess(os.path.getsize(os.path.join(self.backup_path, 'a' + sibackup.COMPRESSED_SUFFIX)), 100)
+                self.assertEqual(tree_contents(self.restore()), tree_contents(self.source_path))
+
+    def test_compressed_files_are_compared_with_the_source(self):
+        self.backup(compress='zlib')
+        info_data = self.backup(compress='zlib', copymode=3, verify_dest=True, hashcachesize=0)
+        self.assertEqual(info_data['files']['num_skipped'], 3)
+        write_file(self.file_system, os.path.join(self.source_path, 'a'), b'A' * 100, OLD_MTIME)
+        info_data = self.backup(compress='zlib', copymode=3, verify_dest=True, hashcachesize=0)
+        self.assertEqual(info_data['files']['num_copied'], 1)
+        self.assertEqual(tree_contents(self.restore()), tree_contents(self.source_path))
+
+    def test_incompressible_files_are_stored_as_they_are(self):
+        write_file(self.file_system, os.path.join(self.source_path, 'random'), os.urandom(100000), OLD_MTIME)
+        write_file(self.file_system, os.path.join(self.source_path, 'photo.jpg'), b'j' * 1000, OLD_MTIME)
+        info_data = self.backup(compress='zlib')
+        self.assertEqual(info_data['compression']['num_incompressible'], 2)
+        self.assertTrue(os.path.exists(os.path.join(self.backup_path, 'random')))
+        self.assertTrue(os.path.exists(os.path.join(self.backup_path, 'photo.jpg')))
+
+    def test_stopping_compression_stores_files_plainly(self):
+        self.backup(compress='zlib')
+        write_file(self.file_system, os.path.join(self.source_path, 'a'), b'changed', OLD_MTIME + 10)
+        self.backup()
+        self.assertEqual(self.read('a'), b'changed')
+        self.assertFalse(os.path.exists(os.path.join(self.backup_path, 'a' + sibackup.COMPRESSED_SUFFIX)))
+        self.assertEqual(tree_contents(self.restore()), tree_contents(self.source_path))
+
+
+class JournalTest(LocalBackupTest):
+    def interrupt_at(self, name, fail=None):
+        """Back up the source with a checkpoint after every folder, interrupting the run when it gets to copy a file"""
+        copy_file = sibackup.copy_file
+        copy_file_data = sibackup.copy_file_data
+
+        def interrupting_copy_file(job, source_file_stats, dest_file_stats):
+            if os.path.basename(source_file_stats.path_name) == name:
+                raise KeyboardInterrupt
+            copy_file(job, source_file_stats, dest_file_stats)
+
+        def failing_copy_file_data(job, source_file_stats, *rest):
+            if os.path.basename(source_file_stats.path_name) == fail:
+                raise PermissionError(errno.EACCES, "Permission denied")
+            return copy_file_data(job, source_file_stats, *rest)
+
+        with mock.patch.object(sibackup, 'copy_file', interrupting_copy_file), \
+                mock.patch.object(sibackup, 'copy_file_data', failing_copy_file_data):
+            with self.assertRaises(KeyboardInterrupt):
+                self.backup(journal=True, checkpointinterval=0)
+        self.assertTrue(os.path.exists(os.path.join(self.backup_path, sibackup.JOURNAL_NAME)))
+
+    def test_interrupted_run_is_resumed(self):
+        self.interrupt_at('c')
+        self.assertEqual(sorted(os.listdir(self.backup_path)), sorted([sibackup.JOURNAL_NAME, 'a', 'b', 'folder']))
+        # The root folder was completed, so only the rest is done again
+        info_data = self.backup(journal=True)
+        self.assertEqual(info_data['files']['num_processed'], 1)
+        self.assertEqual(info_data['files']['num_copied'], 1)
+        self.assertEqual(self.read(os.path.join('folder', 'c')), b'folder/c' * 100)
+        self.assertFalse(os.path.exists(os.path.join(self.backup_path, sibackup.JOURNAL_NAME)))
+
+    def test_folders_with_failed_copies_are_not_completed(self):
+        self.interrupt_at('c', fail='b')
+        self.assertFalse(os.path.exists(os.path.join(self.backup_path, 'b')))
+        # The file that failed is tried again along with the rest
+        info_data = self.backup(journal=True)
+        self.assertEqual(info_data['files']['num_processed'], 3)
+        self.assertEqual(info_data['files']['num_copied'], 2)
+        self.assertEqual(self.read('b'), b'b' * 100)
+
+    def test_runs_without_journal_start_over(self):
+        self.interrupt_at('c')
+        info_data = self.backup()
+        self.assertEqual(info_data['files']['num_processed'], 3)
+        self.assertEqual(info_data['misc']['checkpoints'], 0)
+        self.assertFalse(os.path.exists(os.path.join(self.backup_path, sibackup.JOURNAL_NAME)))
+        # The journal of the interrupted run is gone, so a later run with a journal starts over as well
+        os.utime(os.path.join(self.source_path, 'a'), (OLD_MTIME + 10, OLD_MTIME + 10))
+        info_data = self.backup(journal=True)
+        self.assertEqual(info_data['files']['num_copied'], 1)
+
+
+class ThrottleTest(LocalBackupTest):
+    def setUp(self):
+        super().setUp()
+        write_file(self.file_system, os.path.join(self.source_path, 'large'), b'l' * 300000, OLD_MTIME)
+
+    def test_copies_are_held_to_the_limit(self):
+        # The first second's worth goes through at once, the rest has to wait for the limit
+        start = time.monotonic()
+        info_data = self.backup(bwlimit=200000)
+        self.assertGreater(time.monotonic() - start, 0.4)
+        self.assertGreater(info_data['time_spent']['throttled'], 0.4)
+        self.assertEqual(self.read('large'), b'l' * 300000)
+
+    def test_limits_only_apply_on_schedule(self):
+        # A window starting an hour from now
+        now = time.localtime()
+        start = (now.tm_hour * 60 + now.tm_min + 60) % 1440
+        schedule = '{:02}:{:02}-{:02}:{:02}'.format(start // 60, start % 60, (start + 60) % 1440 // 60, start % 60)
+        info_data = self.backup(bwlimit=200000, limitschedule=schedule)
+        self.assertEqual(info_data['time_spent']['throttled'], 0)
+
+
+class BatchTest(LocalBackupTest):
+    def test_packing_stays_with_its_destination(self):
+        self.backup(pack=True)
+        batch_path = os.path.join(self.temp_path, 'batch.txt')
+        other_path = os.path.join(self.temp_path, 'other')
+        with open(batch_path, 'w') as batch_file:
+            batch_file.write('"{}" "{}"\n'.format(self.source_path, other_path))
+        # The first destination has packed files and keeps packing, but the batch job after it doesn't pack
+        with self.assertLogs('sibackup', logging.WARNING):
+            self.backup(batch=batch_path)
+        self.assertFalse(os.path.exists(os.path.join(other_path, sibackup.PACK_NAME)))
+        self.assertEqual(read_file(self.file_system, os.path.join(other_path, 'a')), b'a' * 100)
+
+    def test_line_with_several_destinations(self):
+        batch_path = os.path.join(self.temp_path, 'batch.txt')
+        other_paths = [os.path.join(self.temp_path, name) for name in ['other', 'another']]
+        with open(batch_path, 'w') as batch_file:
+            batch_file.write('"{}" "{}" "{}"\n'.format(self.source_path, *other_paths))
+        stats = sibackup.Backup(self.source_path, self.backup_path, batch=batch_path).run()
+        self.assertEqual(stats.status, 0)
+        self.assertEqual([result['destination'] for result in stats.results], [self.backup_path] + other_paths)
+        for other_path, result in zip(other_paths, stats.results[1:]):
+            self.assertEqual(result['info_data']['files']['num_copied'], 3)
+            contents = tree_contents(other_path)
+            del contents[sibackup.MANIFEST_NAME]
+            self.assertEqual(contents, tree_contents(self.source_path))
+
+
+class VerifyTest(LocalBackupTest):
+    def corrupt(self, name):
+        """Change a byte of a backed up file, keeping its size and modified time"""
+        path_name = os.path.join(self.backup_path, name)
+        with open(path_name, 'r+b') as file:
+            file.write(b'X')
+        os.utime(path_name, (OLD_MTIME, OLD_MTIME))
+
+    def test_matching_backup(self):
+        info_data = self.backup(verify='full')
+        self.assertEqual(info_data['verify']['num_verified'], 3)
+        self.assertEqual(info_data['verify']['num_failed'], 0)
+
+    def test_mismatch_is_copied_again(self):
+        self.backup()
+        self.corrupt('b')
+        with self.assertLogs('sibackup', logging.ERROR):
+            info_data = self.backup(status=1, verify='full')
+        self.assertEqual(info_data['verify']['num_failed'], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.backup_path, 'b')))
+        info_data = self.backup()
+        self.assertEqual(info_data['files']['num_copied'], 1)
+        self.assertEqual(self.read('b'), b'b' * 100)
+
+    def test_changed_source_is_not_verified(self):
+        self.backup()
+        verify_backup = sibackup.verify_backup
+
+        def change_then_verify(job):
+            # The source changes after it was backed up, but before it is verified
+            write_file(self.file_system, os.path.join(self.source_path, 'a'), b'edited', OLD_MTIME + 10)
+            return verify_backup(job)
+
+        with mock.patch.object(sibackup, 'verify_backup', change_then_verify):
+            info_data = self.backup(verify='full')
+        self.assertEqual(info_data['verify']['num_changed'], 1)
+        self.assertEqual(info_data['verify']['num_failed'], 0)
+        self.assertEqual(self.read('a'), b'a' * 100)
+
+    def test_changed_mode_checks_copied_files(self):
+        self.backup()
+        write_file(self.file_system, os.path.join(self.source_path, 'a'), b'changed', OLD_MTIME + 10)
+        info_data = self.backup(verify='changed')
+        self.assertEqual(info_data['verify']['num_verified'], 1)
+
+    def test_memory_filesystem(self):
+        file_system = sibackup.MemoryFileSystem()
+        file_system.makedirs('/source')
+        write_file(file_system, '/source/file', b'file' * 1000)
+        stats = sibackup.Backup('/source', '/backup', filesystem=file_system, verify='full', workers=2).run()
+        self.assertEqual(stats.status, 0)
+        self.assertEqual(stats.info_data['verify']['num_verified'], 1)
+
+
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    unittest.main()